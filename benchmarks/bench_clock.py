@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark batched clock comparison (harmony.clock.compare_many) against
+per-entry Clock.compare() on randomized clocks.
+
+Usage: python -m benchmarks.bench_clock [number of clocks] [number of locations]
+"""
+
+import sys
+import time
+import random
+
+from harmony.clock import Clock, compare_many
+
+def random_clocks(rnd, n, locations):
+    return [
+        Clock(**{
+            l: rnd.randint(0, 20) for l in locations
+            if rnd.random() < 0.5
+        })
+        for _ in range(n)
+    ]
+
+def main(n, n_locations):
+    rnd = random.Random(42)
+    locations = ['{:032x}'.format(rnd.getrandbits(128)) for _ in range(n_locations)]
+    clocks = random_clocks(rnd, n, locations)
+    others = random_clocks(rnd, n, locations)
+    print('{} clock pairs, {} locations'.format(n, n_locations))
+
+    start = time.perf_counter()
+    expected = [a.compare(b) for a, b in zip(clocks, others)]
+    t_single = time.perf_counter() - start
+    print('Clock.compare: {:.3f}s'.format(t_single))
+
+    start = time.perf_counter()
+    r = compare_many(clocks, others)
+    t_many = time.perf_counter() - start
+    print('compare_many:  {:.3f}s ({:.1f}x)'.format(t_many, t_single / t_many))
+
+    assert r == expected, 'Results differ!'
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    )
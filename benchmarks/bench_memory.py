@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the memory used by a loaded repository state and location
+states (one location state, sharing the paths of the repository state).
+
+Usage: python -m benchmarks.bench_memory [number of files]
+"""
+
+import gc
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from harmony.location_states import LocationStates
+from harmony.repository_state import RepositoryState
+from benchmarks.bench_serialization import make_states
+
+def main(n):
+    d = Path(tempfile.mkdtemp(prefix = 'harmony-bench-memory'))
+    try:
+        repository_state, location_states = make_states(d, n)
+        repository_state.save()
+        location_states.save()
+        del repository_state, location_states
+        # Start from scratch, as a freshly started process would (the
+        # interned paths go with the states)
+        gc.collect()
+
+        print('{} files'.format(n))
+        tracemalloc.start()
+        start = time.perf_counter()
+        repository_state = RepositoryState.load(d / 'repository_state')
+        location_states = LocationStates.load(d / 'location_states')
+        for id_ in location_states.get_locations():
+            location_states.items[id_]
+        t = time.perf_counter() - start
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('load: {:6.2f}s  memory: {:.1f}MB ({:.0f} bytes per file)  peak: {:.1f}MB'.format(
+            t, current / 1e6, current / n, peak / 1e6
+        ))
+    finally:
+        shutil.rmtree(str(d))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
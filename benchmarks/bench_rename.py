@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark rename detection in file_state_logic.commit() by moving all
+files of one directory into another.
+
+Usage: python -m benchmarks.bench_rename [number of files]
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+from harmony import file_state_logic
+from harmony.location_states import LocationStates
+from harmony.repository_state import RepositoryState
+from harmony.ruleset import Ruleset
+from harmony.working_directory import WorkingDirectory
+
+ID = 'benchmark'
+
+def main(n):
+    d = Path(tempfile.mkdtemp(prefix = 'harmony-bench-rename'))
+    try:
+        (d / 'a').mkdir()
+        for i in range(n):
+            (d / 'a' / 'file{}.txt'.format(i)).write_text('This is file {}'.format(i))
+
+        wd = WorkingDirectory(d, Ruleset(d))
+        location_states = LocationStates(None)
+        repository_state = RepositoryState(None)
+
+        start = time.perf_counter()
+        file_state_logic.commit(ID, wd, location_states, repository_state)
+        print('initial commit of {} files: {:.2f}s'.format(n, time.perf_counter() - start))
+
+        (d / 'a').rename(d / 'b')
+
+        start = time.perf_counter()
+        file_state_logic.commit(ID, wd, location_states, repository_state)
+        t = time.perf_counter() - start
+
+        wiped = sum(1 for e in repository_state.files.values() if e.wipe)
+        print('commit after moving {} files: {:.2f}s ({} renames detected)'.format(n, t, wiped))
+    finally:
+        shutil.rmtree(str(d))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for Ruleset.get_rule().
+
+Usage: python -m benchmarks.bench_ruleset [number of paths]
+"""
+
+import sys
+import time
+import random
+
+from harmony.ruleset import Ruleset
+
+def make_ruleset():
+    r = Ruleset(None)
+    r.add_rule(match = {}, commit = True, action = 'continue')
+    r.add_rule(match = {'path': '/.harmony/**'}, commit = False, action = 'stop')
+    r.add_rule(match = {'filename': ['*.swp', '*.bak', '*~', '*.pyc']}, commit = False, action = 'stop')
+    for i in range(10):
+        r.add_rule(match = {'dirname': 'build{}'.format(i)}, commit = False, action = 'stop')
+        r.add_rule(match = {'filename': '*.tmp{}'.format(i)}, commit = False, action = 'stop')
+        r.add_rule(match = {'path': 'media/**/cache{}/**'.format(i)}, commit = False, action = 'stop')
+    return r
+
+def make_paths(n):
+    rnd = random.Random(42)
+    directories = [
+        'media/{}/{}/{}'.format(y, m, rnd.choice(['a', 'b', 'cache3', 'c']))
+        for y in range(2000, 2020) for m in range(12)
+    ] + ['src/build{}/x'.format(i) for i in range(10)] + ['.harmony/location_states']
+    extensions = ['jpg', 'png', 'mp3', 'tmp3', 'bak', 'flac']
+    return [
+        '{}/file{}.{}'.format(rnd.choice(directories), i, rnd.choice(extensions))
+        for i in range(n)
+    ]
+
+def main(n):
+    ruleset = make_ruleset()
+    paths = make_paths(n)
+    print('{} rules, {} paths'.format(len(ruleset.rules), len(paths)))
+
+    for label in ('cold', 'warm'):
+        if label == 'cold':
+            ruleset.invalidate()
+        start = time.perf_counter()
+        committable = sum(1 for p in paths if ruleset.get_rule(p)['commit'])
+        t = time.perf_counter() - start
+        print('{:5s}: {:.3f}s, {:.2f}s per million paths ({} committable)'.format(
+            label, t, t / n * 1e6, committable
+        ))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
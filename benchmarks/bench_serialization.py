@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark saving and loading a repository state and a location state in
+each serialization format.
+
+Usage: python -m benchmarks.bench_serialization [number of files]
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+from harmony import serialization
+from harmony.clock import Clock
+from harmony.location_states import LocationStates, LocationState
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.working_directory import FileState
+
+LOCATIONS = ['{:032x}'.format(i) for i in range(3)]
+
+def make_states(d, n):
+    repository_state = RepositoryState(d / 'repository_state', files = {
+        'dir{}/file{}.txt'.format(i % 100, i): RepositoryFileState(
+            path = 'dir{}/file{}.txt'.format(i % 100, i),
+            digest = 'sha1:{:040x}'.format(i),
+            clock = Clock(**{ l: i % 7 + 1 for l in LOCATIONS }),
+        )
+        for i in range(n)
+    })
+
+    (d / 'location_states').mkdir()
+    location_states = LocationStates(d / 'location_states', {
+        LOCATIONS[0]: LocationState(
+            files = {
+                Path(p): FileState(path = p, digest = e.digest, size = 1000, mtime = 1500000000.123)
+                for p, e in repository_state.files.items()
+            },
+            location = LOCATIONS[0],
+        )
+    })
+    return repository_state, location_states
+
+def measure(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+def main(n):
+    d = Path(tempfile.mkdtemp(prefix = 'harmony-bench-serialization'))
+    default_format = serialization.DEFAULT_FORMAT
+    try:
+        repository_state, location_states = make_states(d, n)
+        print('{} files'.format(n))
+
+        for name in serialization.FORMATS:
+            serialization.DEFAULT_FORMAT = name
+            t_save = measure(lambda: (repository_state.save(), location_states.save()))
+            t_load = measure(lambda: (
+                RepositoryState.load(d / 'repository_state'),
+                LocationStates.load(d / 'location_states'),
+            ))
+            size = (d / 'repository_state').stat().st_size \
+                + sum(f.stat().st_size for f in (d / 'location_states').iterdir())
+            print('{:5s} save: {:6.2f}s  load: {:6.2f}s  size: {:.1f}MB'.format(
+                name, t_save, t_load, size / 1e6
+            ))
+    finally:
+        serialization.DEFAULT_FORMAT = default_format
+        shutil.rmtree(str(d))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark FileProtocol's ways of copying a file (see
+protocols.COPY_STRATEGIES), each on its own and as a whole transfer with
+hashing of the received data (FileProtocol.receive_file()).
+
+Usage: python -m benchmarks.bench_transfer [size in GB] [directory]
+
+The directory (default: a temporary one) decides the filesystem, reflinks
+for example only work on btrfs, XFS and the like. Note that the source
+file is likely in the page cache for all but the first run.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+from harmony import hashers
+from harmony.protocols import FileProtocol, COPY_STRATEGIES
+
+BLOCK = b'\0' * (1024 ** 2)
+
+def make_file(path, size):
+    with path.open('wb') as f:
+        for _ in range(size // len(BLOCK)):
+            # Different blocks, so the filesystem can not deduplicate them
+            f.write(os.urandom(16) + BLOCK[16:])
+        os.fsync(f.fileno())
+
+def measure(f, destination):
+    if destination.exists():
+        destination.unlink()
+    start = time.perf_counter()
+    try:
+        f()
+    except OSError as e:
+        return None, e
+    with destination.open('rb+') as g:
+        os.fsync(g.fileno())
+    return time.perf_counter() - start, None
+
+def main(size, directory = None):
+    d = Path(tempfile.mkdtemp(prefix = 'harmony-bench-transfer', dir = directory))
+    try:
+        (d / 'source').mkdir()
+        (d / 'target').mkdir()
+        source = d / 'source' / 'file'
+        destination = d / 'target' / 'file'
+        make_file(source, size)
+        print('{:.2f}GB in {}'.format(size / 1e9, d))
+
+        runs = [
+            ('shutil.copyfile', lambda: shutil.copyfile(str(source), str(destination))),
+        ]
+        runs.extend(
+            (name, lambda f = f: f(str(source), str(destination)))
+            for name, f in sorted(COPY_STRATEGIES.items())
+        )
+
+        failed = set()
+        p = FileProtocol(d / 'source')
+        for strategy in sorted(COPY_STRATEGIES) + ['copy']:
+            def receive(strategy = strategy):
+                if strategy in failed:
+                    # Would just fall back to 'copy'
+                    raise OSError('{} failed before'.format(strategy))
+                p.strategies = (strategy, )
+                p.receive_file('file', destination, hashers.DEFAULT)
+            runs.append(('receive_file {}'.format(strategy), receive))
+
+        for name, f in runs:
+            t, error = measure(f, destination)
+            if error is not None:
+                failed.add(name)
+                print('{:30s} failed: {}'.format(name, error))
+            else:
+                print('{:30s} {:7.2f}s {:8.1f}MB/s'.format(name, t, size / t / 1e6))
+    finally:
+        shutil.rmtree(str(d))
+
+if __name__ == '__main__':
+    main(
+        int(float(sys.argv[1]) * 1e9) if len(sys.argv) > 1 else 2 * 10 ** 9,
+        sys.argv[2] if len(sys.argv) > 2 else None
+    )
@@ -1,6 +1,11 @@
 
+import logging
+
+from harmony import serialization
 from harmony.repository import Repository
 
+logger = logging.getLogger(__name__)
+
 class Command:
     aliases = ()
 
@@ -17,7 +22,11 @@ class Command:
         return Repository.find(ns.cwd)
 
     def run(self, parser, ns):
-        return self.execute(ns)
+        serialization.statistics.reset()
+        with serialization.group_commit():
+            r = self.execute(ns)
+        logger.info('{}: {}'.format(self.command, serialization.statistics))
+        return r
 
 class CommandGroup:
     aliases = ()
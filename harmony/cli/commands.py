@@ -3,7 +3,9 @@
 from harmony.repository import Repository
 from harmony.cli.command import Command, CommandGroup
 from harmony.cli import console
+from harmony.state_backends import BACKENDS
 import logging
+from pathlib import Path
 
 class InitCommand(Command):
     command = 'init'
@@ -11,17 +13,26 @@ class InitCommand(Command):
 
     def setup_parser(self, p):
         p.add_argument('--name', default = None, required = False)
+        p.add_argument('--state-backend', choices = sorted(BACKENDS), default = None,
+                       help = 'how to store repository state (default: files)')
 
     def execute(self, ns):
-        Repository.init( working_directory = ns.cwd, name = ns.name )
+        Repository.init( working_directory = ns.cwd, name = ns.name,
+                         state_backend = ns.state_backend )
 
 class CommitCommand(Command):
     command = 'commit'
     help = 'record current repository state into history'
 
+    def setup_parser(self, p):
+        p.add_argument('-j', '--jobs', type = int, default = None,
+                       help = 'number of files to hash in parallel')
+        p.add_argument('--executor', choices = ('thread', 'process'), default = None,
+                       help = 'hash in threads (large files) or processes (many small files)')
+
     def execute(self, ns):
         r = self.make_repository(ns)
-        any_change = r.commit()
+        any_change = r.commit(jobs = ns.jobs, executor = ns.executor)
         if not any_change:
             print('Nothing to commit.')
 
@@ -42,11 +53,14 @@ class CloneCommand(Command):
 
     def setup_parser(self, p):
         p.add_argument('location', help = 'location of the repository to clone')
+        p.add_argument('--state-backend', choices = sorted(BACKENDS), default = None,
+                       help = 'how to store repository state (default: files)')
 
     def execute(self, ns):
         r = Repository.clone(
                 working_directory = ns.cwd,
-                location = ns.location
+                location = ns.location,
+                state_backend = ns.state_backend
                 )
 
 class StatusCommand(Command):
@@ -54,13 +68,23 @@ class StatusCommand(Command):
     aliases = ('st', )
     help = 'list working directory files for which a newer version is available'
 
+    def setup_parser(self, p):
+        p.add_argument('path', nargs = '?', default = None,
+                       help = 'directory (or file) to show, relative to repository root')
+        p.add_argument('--summary', action = 'store_true',
+                       help = 'show file counts and sizes per directory instead of files')
+
     def execute(self, ns):
         logger = logging.getLogger(__name__)
 
         r = self.make_repository(ns)
+        if ns.summary:
+            self.write_summary(r, ns.path)
+            return
+
         # 1. find all them outdated files and their recent digests
         # 2. find locations that have them and file sizes
-        files = r.get_file_stats()
+        files = r.get_file_stats(ns.path)
         logger.debug(f'file stats: {files}')
 
         def status(f):
@@ -91,14 +115,31 @@ class StatusCommand(Command):
 
             return s
 
-        console.write_table([(status(f), f.path) for f in files])
+        if files:
+            console.write_table([(status(f), f.path) for f in files])
+
+    def write_summary(self, r, path):
+        if path is not None:
+            path = str(Path(path))
+        node = r.get_path_index().find(path)
+        if node is None:
+            logging.getLogger(__name__).error('{} is not a directory in the repository'.format(path))
+            return
+
+        prefix = '{}/'.format(path) if path is not None else ''
+        rows = [
+            (n.count, n.size, n.missing, n.outdated, '{}{}/'.format(prefix, name))
+            for name, n in sorted(node.children.items())
+        ]
+        rows.append((node.count, node.size, node.missing, node.outdated, prefix or '.'))
+        console.write_table(rows, headers = ('Files', 'Size', 'Missing', 'Outdated', 'Directory'))
 
 class GetCommand(Command):
     # TODO: Write test ensuring this gets the most recent version in the
     # presence of multiple versions
 
     command = 'get'
-    help = 'get current version of given file into this repository'
+    help = 'get current version of given files (or directories, or glob patterns) into this repository'
 
     # TODO
     #     Think more about how the user interface of this should be like.
@@ -108,12 +149,16 @@ class GetCommand(Command):
     #         Get the latest version from any available remote
 
     def setup_parser(self, p):
-        p.add_argument('path', help = 'path of file (relative to repository root)')
+        p.add_argument('paths', nargs = '+',
+                       help = 'paths of files or directories or glob patterns (relative to repository root)')
         p.add_argument('remote_spec', help = 'Location to pull from')
+        p.add_argument('-j', '--jobs', type = int, default = None,
+                       help = 'number of files to transfer in parallel')
 
     def execute(self, ns):
         r = self.make_repository(ns)
-        r.pull_file(ns.path, ns.remote_spec)
+        statistics = r.pull_files(ns.paths, ns.remote_spec, jobs = ns.jobs)
+        print('Got {}'.format(statistics))
 
 class RemoteCommand(CommandGroup):
     command = 'remote'
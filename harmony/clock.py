@@ -1,5 +1,11 @@
 
 import logging
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from harmony.serialization import Serializable
 
@@ -8,8 +14,79 @@ logger = logging.getLogger(__name__)
 def cmp_(a, b):
     return (a > b) - (a < b)
 
+def compare_matrices(a, b):
+    """
+    Compare two clock matrices (numpy arrays of the same shape with one row
+    per clock and one column per location id) row by row like
+    Clock.compare().
+
+    return:
+        A pair (sign, comparable) of arrays, sign is -1, 0 or 1 where
+        comparable is True.
+    """
+    greater = (a > b).any(axis = 1)
+    lower = (a < b).any(axis = 1)
+    comparable = ~(greater & lower)
+    sign = greater.astype(numpy.int8) - lower.astype(numpy.int8)
+    return sign, comparable
+
+def compare_many(clocks, others):
+    """
+    Compare clocks pairwise, equivalent to
+    [a.compare(b) for a, b in zip(clocks, others)]
+    but (if numpy is available) as a single vectorized operation
+    with location ids mapped to matrix columns.
+
+    Building the matrices from the Clock objects costs more than the
+    comparison saves once there are many location ids, code that holds
+    clocks as matrices anyway (like columnar.merge()) should use
+    compare_matrices() directly.
+
+    return:
+        A list with -1, 0, 1 or None for each pair.
+    """
+    clocks = list(clocks)
+    others = list(others)
+    assert len(clocks) == len(others)
+
+    if numpy is None:
+        return [a.compare(b) for a, b in zip(clocks, others)]
+
+    # Map location ids to columns
+    keys = set()
+    for clock in chain(clocks, others):
+        keys.update(clock.values)
+    columns = { k: i for i, k in enumerate(keys) }
+
+    # Build the matrices from flattened (row, column, value) triples,
+    # iterating over the individual values in C rather than Python
+    r = []
+    for cs in (clocks, others):
+        dicts = [c.values for c in cs]
+        lengths = numpy.fromiter(map(len, dicts), dtype = numpy.int64, count = len(dicts))
+        rows = numpy.repeat(numpy.arange(len(dicts)), lengths)
+        cols = numpy.fromiter(
+            map(columns.__getitem__, chain.from_iterable(dicts)),
+            dtype = numpy.int64, count = len(rows)
+        )
+        values = numpy.fromiter(
+            chain.from_iterable(map(dict.values, dicts)),
+            dtype = numpy.int64, count = len(rows)
+        )
+        m = numpy.zeros((len(dicts), len(columns)), dtype = numpy.int64)
+        m[rows, cols] = values
+        r.append(m)
+
+    sign, comparable = compare_matrices(*r)
+    return [
+        s if c else None
+        for s, c in zip(sign.tolist(), comparable.tolist())
+    ]
+
 class Clock(Serializable):
 
+    __slots__ = ('values', )
+
     @classmethod
     def from_dict(class_, d):
         return class_(**d)
@@ -51,8 +128,8 @@ class Clock(Serializable):
 
     def update(self, other):
         """
-        Update based on other clock instance.
-        Return a new clock instance with values being the maximum of self and other.
+        Update based on other clock instance,
+        setting each value to the maximum of self and other.
         """
         for k in set(self.values.keys()) | set(other.values.keys()):
             self.values[k] = max(
@@ -63,6 +140,31 @@ class Clock(Serializable):
     def increase(self, k):
         self.values[k] = self.values.get(k, 0) + 1
 
+    # Non-mutating variants of the above, for clocks shared between
+    # (copy-on-write) state entries
+
+    def merged(self, other):
+        """
+        Return a new clock instance with values being the maximum of self and other.
+        """
+        r = Clock(**self.values)
+        r.update(other)
+        return r
+
+    def increased(self, k):
+        """
+        Return a new clock instance with the value for $k increased by one.
+        """
+        return self.with_value(k, self.values.get(k, 0) + 1)
+
+    def with_value(self, k, v):
+        """
+        Return a new clock instance with the value for $k set to $v.
+        """
+        r = Clock(**self.values)
+        r.values[k] = v
+        return r
+
     def comparable(self, other):
         return self.compare(other) is not None
 
@@ -0,0 +1,319 @@
+
+"""
+Columnar (NumPy based) representation of repository and location states.
+
+Instead of one Python object per file (with its own Clock dict), the state
+is held in a few arrays indexed by row, with paths and location ids interned
+to integers:
+
+    path ids:  int64
+    digests:   fixed width bytes
+    sizes:     int64 (-1 for files that do not exist)
+    mtimes:    int64 nanoseconds
+    clocks:    int64 matrix (rows x locations)
+
+This allows merge and status computations to run as vectorized array
+operations. NumPy is an optional dependency, use available() to check.
+"""
+
+import logging
+from pathlib import Path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from harmony.clock import Clock, compare_matrices
+from harmony.repository_state import RepositoryState, RepositoryFileState
+
+logger = logging.getLogger(__name__)
+
+def available():
+    return numpy is not None
+
+def mtime_to_ns(mtime):
+    # FileState.mtime is a float (st_mtime), convert the same way on both
+    # sides of any comparison so equal floats give equal integers.
+    return int(round(mtime * 1e9)) if mtime is not None else -1
+
+class Interner:
+    """
+    Bidirectional mapping between hashable values and consecutive integer
+    ids.
+    """
+
+    def __init__(self, values = ()):
+        self.ids = {}
+        self.values = []
+        for v in values:
+            self.intern(v)
+
+    def intern(self, value):
+        r = self.ids.get(value)
+        if r is None:
+            r = len(self.values)
+            self.ids[value] = r
+            self.values.append(value)
+        return r
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, id_):
+        return self.values[id_]
+
+class RepositoryColumns:
+    """
+    Columnar copy of a RepositoryState, rows sorted by path id.
+    """
+
+    def __init__(self, paths, locations, path_ids, digests, wipe, clocks):
+        self.paths = paths
+        self.locations = locations
+        self.path_ids = path_ids
+        self.digests = digests
+        self.wipe = wipe
+        self.clocks = clocks
+
+    @classmethod
+    def from_repository_state(class_, state, paths = None, locations = None):
+        """
+        paths, locations:
+            Interner instances for paths and location ids, pass the same
+            ones for states that are going to be compared with each other.
+        """
+        paths = paths if paths is not None else Interner()
+        locations = locations if locations is not None else Interner()
+
+        entries = list(state.files.items())
+        n = len(entries)
+        path_ids = numpy.fromiter(
+            (paths.intern(str(p)) for p, _ in entries),
+            dtype = numpy.int64, count = n
+        )
+        order = numpy.argsort(path_ids, kind = 'stable')
+        entries = [entries[i] for i in order]
+
+        digests = numpy.array(
+            [(e.digest or '').encode('ascii') for _, e in entries],
+            dtype = bytes
+        ) if n else numpy.zeros(0, dtype = 'S1')
+        wipe = numpy.fromiter((e.wipe for _, e in entries), dtype = bool, count = n)
+
+        rows, columns, values = [], [], []
+        for row, (_, e) in enumerate(entries):
+            for k, v in e.clock.values.items():
+                rows.append(row)
+                columns.append(locations.intern(k))
+                values.append(v)
+        clocks = numpy.zeros((n, len(locations)), dtype = numpy.int64)
+        clocks[rows, columns] = values
+
+        return class_(paths, locations, path_ids[order], digests, wipe, clocks)
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def widen(self):
+        """
+        Add zero columns for locations interned after this instance was
+        created.
+        """
+        missing = len(self.locations) - self.clocks.shape[1]
+        if missing > 0:
+            self.clocks = numpy.pad(self.clocks, ((0, 0), (0, missing)))
+
+    def clock(self, row):
+        return Clock(**{
+            self.locations[c]: int(v)
+            for c, v in enumerate(self.clocks[row]) if v
+        })
+
+    def entry(self, row):
+        path = self.paths[int(self.path_ids[row])]
+        return RepositoryFileState(
+            path = path,
+            digest = self.digests[row].decode('ascii') or None,
+            clock = self.clock(row),
+            wipe = bool(self.wipe[row]),
+        )
+
+class LocationColumns:
+    """
+    Columnar copy of the files of a LocationState, rows sorted by path id.
+    """
+
+    def __init__(self, paths, path_ids, digests, sizes, mtimes):
+        self.paths = paths
+        self.path_ids = path_ids
+        self.digests = digests
+        self.sizes = sizes
+        self.mtimes = mtimes
+
+    @classmethod
+    def from_file_states(class_, file_states, paths = None):
+        paths = paths if paths is not None else Interner()
+        file_states = list(file_states)
+        n = len(file_states)
+
+        path_ids = numpy.fromiter(
+            (paths.intern(str(f.path)) for f in file_states),
+            dtype = numpy.int64, count = n
+        )
+        order = numpy.argsort(path_ids, kind = 'stable')
+        file_states = [file_states[i] for i in order]
+
+        digests = numpy.array(
+            [(f.digest or '').encode('ascii') for f in file_states],
+            dtype = bytes
+        ) if n else numpy.zeros(0, dtype = 'S1')
+        sizes = numpy.fromiter(
+            (f.size if f.size is not None else -1 for f in file_states),
+            dtype = numpy.int64, count = n
+        )
+        mtimes = numpy.fromiter(
+            (mtime_to_ns(f.mtime) for f in file_states),
+            dtype = numpy.int64, count = n
+        )
+        return class_(paths, path_ids[order], digests, sizes, mtimes)
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def lookup(self, path_ids):
+        """
+        Return an array with the row of each of the given path ids,
+        -1 where there is none.
+        """
+        if not len(self.path_ids):
+            return numpy.full(len(path_ids), -1, dtype = numpy.int64)
+        rows = numpy.searchsorted(self.path_ids, path_ids)
+        rows = numpy.minimum(rows, len(self.path_ids) - 1)
+        return numpy.where(self.path_ids[rows] == path_ids, rows, -1)
+
+def merge(local_state, remote_state, merger_id):
+    """
+    Vectorized equivalent of file_state_logic.merge() with the same
+    parameters and return value.
+    """
+    paths = Interner()
+    locations = Interner([merger_id])
+    local = RepositoryColumns.from_repository_state(local_state, paths, locations)
+    remote = RepositoryColumns.from_repository_state(remote_state, paths, locations)
+    local.widen()
+    remote.widen()
+
+    _, li, ri = numpy.intersect1d(
+        local.path_ids, remote.path_ids,
+        assume_unique = True, return_indices = True
+    )
+    sign, comparable = compare_matrices(local.clocks[li], remote.clocks[ri])
+    same_content = local.digests[li] == remote.digests[ri]
+
+    merged = RepositoryState(None)
+    merged.files = dict(local_state.files)
+    conflicts = {}
+
+    remote_only = numpy.ones(len(remote), dtype = bool)
+    remote_only[ri] = False
+    for row in numpy.nonzero(remote_only)[0]:
+        path = paths[int(remote.path_ids[row])]
+        merged.files[path] = remote_state.files[path]
+
+    for row in numpy.nonzero(comparable & (sign < 0))[0]:
+        path = paths[int(remote.path_ids[ri[row]])]
+        logger.debug('merge: {} newer on remote'.format(path))
+        merged.files[path] = remote_state.files[path]
+
+    for row in numpy.nonzero(~comparable & ~same_content)[0]:
+        path = paths[int(local.path_ids[li[row]])]
+        logger.debug('merge: {} in conflict'.format(path))
+        conflicts[Path(path)] = (local_state.files[path], remote_state.files[path])
+        del merged.files[path]
+
+    automerge = numpy.nonzero(~comparable & same_content)[0]
+    if len(automerge):
+        clocks = numpy.maximum(local.clocks[li[automerge]], remote.clocks[ri[automerge]])
+        clocks[:, locations.ids[merger_id]] += 1
+        for row, clock in zip(automerge, clocks):
+            path = paths[int(local.path_ids[li[row]])]
+            logger.debug('merge: {} automerged (same content)'.format(path))
+            entry = local_state.files[path]
+            merged.files[path] = RepositoryFileState(
+                path = entry.path,
+                digest = entry.digest,
+                clock = Clock(**{
+                    locations[c]: int(v) for c, v in enumerate(clock) if v
+                }),
+                wipe = entry.wipe,
+            )
+
+    return conflicts, merged
+
+def maybe_modified(sizes, mtimes, stats):
+    """
+    Vectorized equivalent of WorkingDirectory.file_maybe_modified().
+
+    sizes, mtimes:
+        Recorded sizes and mtimes (ns) as in LocationColumns.
+    stats:
+        A sequence with an os.stat_result (or None if the file does not
+        exist) for each entry of $sizes.
+    """
+    n = len(sizes)
+    exists_now = numpy.fromiter((s is not None for s in stats), dtype = bool, count = n)
+    current_sizes = numpy.fromiter(
+        (s.st_size if s is not None else -1 for s in stats),
+        dtype = numpy.int64, count = n
+    )
+    current_mtimes = numpy.fromiter(
+        (mtime_to_ns(s.st_mtime) if s is not None else -1 for s in stats),
+        dtype = numpy.int64, count = n
+    )
+    exists_before = sizes >= 0
+    both = exists_before & exists_now
+    return (exists_before != exists_now) \
+        | (both & ((mtimes != current_mtimes) | (sizes != current_sizes)))
+
+def status(repository_state, file_states, stats):
+    """
+    Compute per file status flags for all files of the repository as
+    needed by Repository.get_file_stats().
+
+    file_states:
+        The FileState instances of the local location.
+    stats:
+        A sequence with an os.stat_result (or None if the file does not
+        exist) for each path in repository_state.files (same order).
+
+    return:
+        A dict of boolean arrays with one entry per path in
+        repository_state.files (same order): 'exists_in_location_state',
+        'maybe_modified', 'is_most_recent'.
+    """
+    # Path ids are assigned in the order of repository_state.files, so
+    # the rows of $repository are in that order, too.
+    paths = Interner(str(p) for p in repository_state.files)
+    repository = RepositoryColumns.from_repository_state(repository_state, paths)
+    location = LocationColumns.from_file_states(file_states, paths)
+
+    rows = location.lookup(repository.path_ids)
+    has_row = rows >= 0
+    rows = numpy.maximum(rows, 0)
+
+    if len(location):
+        sizes = numpy.where(has_row, location.sizes[rows], -1)
+        mtimes = numpy.where(has_row, location.mtimes[rows], -1)
+        digests_differ = location.digests[rows] != repository.digests
+    else:
+        sizes = mtimes = numpy.full(len(repository), -1, dtype = numpy.int64)
+        digests_differ = numpy.zeros(len(repository), dtype = bool)
+
+    exists = sizes >= 0
+    return {
+        'exists_in_location_state': exists,
+        'maybe_modified': maybe_modified(sizes, mtimes, stats),
+        'is_most_recent': ~exists | ~digests_differ,
+    }
+
@@ -1,14 +1,16 @@
 
 import logging
 import os
-from copy import deepcopy
+from pathlib import Path
+from collections import defaultdict
 
-from harmony.util import shortened_id
+from harmony.util import shortened_id, intern_path
 from harmony.repository_state import RepositoryState
 
 logger = logging.getLogger(__name__)
 
-def commit(local_location_id, working_directory, location_states, repository_state):
+def commit(local_location_id, working_directory, location_states, repository_state,
+           paths = None, digests = None):
     """
     Scan the given working directory for changes and commit them to local
     state storage.
@@ -34,6 +36,14 @@ def commit(local_location_id, working_directory, location_states, repository_sta
         RepositoryState instance representing the local repository state
         storage. Will (possibly) be modified.
 
+    paths:
+        Only look at these (normalized, relative) paths instead of scanning
+        the whole working directory. Renames are only detected among them.
+
+    digests:
+        Optional dict { path: digest } of already known digests of the
+        current contents of files, see WorkingDirectory.generate_file_states().
+
     return:
         True iff any change was recorded.
     """
@@ -41,8 +51,13 @@ def commit(local_location_id, working_directory, location_states, repository_sta
     id_ = local_location_id
     short_id = shortened_id(id_)
 
-    paths = set(working_directory.get_filenames()) \
-            | set(location_states.get_all_paths(id_))
+    if paths is None:
+        wd_stats = working_directory.scan()
+        paths = set(wd_stats.keys()) \
+                | set(location_states.get_all_paths(id_))
+    else:
+        paths = set(map(intern_path, paths))
+        wd_stats = working_directory.stat_files(paths)
 
 
     # 1. update location state
@@ -61,21 +76,31 @@ def commit(local_location_id, working_directory, location_states, repository_sta
     #      no change in hash or clock
 
 
-    # Do all the file scanning before so we can be sure to do it at most
-    # once per file in the WD
-    wd_states = {
-        path: working_directory.generate_file_state(path)
-        for path in paths
-        if working_directory.file_maybe_modified(
-            location_states.get_file_state(id_, path)
-        )
-    }
-
     location_state_cache = {
         path: location_states.get_file_state(id_, path)
         for path in paths
     }
 
+    # Do all the file scanning before so we can be sure to do it at most
+    # once per file in the WD
+    wd_states = working_directory.generate_file_states(
+        (
+            path for path in paths
+            if working_directory.file_maybe_modified(
+                location_state_cache[path], wd_stats.get(path)
+            )
+        ),
+        stats = wd_stats,
+        digests = digests
+    )
+
+
+    # Files that just appeared by digest, these are the candidates for
+    # being the target of a rename
+    appeared = defaultdict(list)
+    for path, new_file_state in wd_states.items():
+        if new_file_state.exists() and not location_state_cache[path].exists():
+            appeared[new_file_state.digest].append(path)
 
     any_change = False
     for path in paths:
@@ -94,27 +119,21 @@ def commit(local_location_id, working_directory, location_states, repository_sta
                 if not new_file_state.exists():
                     logger.debug('{} vanished'.format(new_file_state.path))
 
-                    # Iterate over paths to find a possible rename target
-                    for path2 in paths:
-                        # Rename to itself does not make sense
-                        # Rename to a file that has not changed (or better: just appeared) does not make sense
-                        if path2 == path or path2 not in wd_states:
-                            continue
-
-                        path2_state = location_state_cache[path2]
-                        new_path2_state = wd_states[path2]
-                        logger.debug('{} rename candidate {} ex before={} ex now={} self.digest={} candidate.digest={}'.format(
-                            path, path2, path2_state.exists(),
-                            new_path2_state.exists(),
-                            file_state.digest, new_path2_state.digest
-                        ))
-
-                        if not path2_state.exists() \
-                           and new_path2_state.exists() \
-                           and new_path2_state.digest == file_state.digest:
+                    if repository_state[path].wipe:
+                        # Already recorded as gone (e.g. moved away by
+                        # auto_rename()), replacing the WIPE by a plain
+                        # deletion would lose its meaning
+                        logger.debug('{} already wiped'.format(path))
+                        continue
+
+                    # Rename to itself does not make sense
+                    for path2 in appeared.get(file_state.digest, ()):
+                        if path2 != path:
                             logger.info('Detected rename: {} -> {}'.format(path, path2))
-                            new_file_state.wipe = True
-                            new_file_state.digest = file_state.digest
+                            new_file_state = new_file_state.replace(
+                                wipe = True,
+                                digest = file_state.digest
+                            )
                             break
 
                 repository_state.update_file_state(
@@ -172,7 +191,9 @@ def merge(local_state, remote_state, merger_id):
 
     # conflicts can only arise in paths that are specified in both state
     # files
-    paths = set(local_state.get_paths()) & set(remote_state.get_paths())
+    # (Compared one by one: batching with clock.compare_many() does not pay
+    # off for clocks that are not in columnar form already, see columnar)
+    paths = local_paths & remote_paths
 
     for path in paths:
         local = local_state[path]
@@ -187,10 +208,9 @@ def merge(local_state, remote_state, merger_id):
                 conflicts[path] = (local, remote)
             else:
                 logger.debug('merge: {} automerged (same content)'.format(path))
-                m = deepcopy(local)
-                m.clock.update(remote.clock)
-                m.clock.increase(merger_id)
-                merged[path] = m
+                merged[path] = local.replace(
+                    clock = local.clock.merged(remote.clock).increased(merger_id)
+                )
 
         elif c < 0:
             logger.debug('merge: {} newer on remote'.format(path))
@@ -204,44 +224,141 @@ def merge(local_state, remote_state, merger_id):
 
 
 
-def auto_rename(working_directory, repository_state):
-    from harmony.working_directory import WorkingDirectory
-
-    assert isinstance(working_directory, WorkingDirectory)
+def auto_rename(working_directory, repository_state, location_states = None, id_ = None,
+                temporary_directory = None):
     """
     Apply automatic renaming in the given working_directory.
     That is, if working dir contains files that are WIPEd in $repository_state but
     are present under a different name, automatically rename those to obtain
     the repository file at a low cost.
 
+    If $location_states and the local location id $id_ are given, files whose
+    recorded local content is outdated but wanted under a different path are
+    moved as well, but only if another rename fills their path with its
+    current version. That way chains (A -> B, B -> C) and swaps (A <-> B)
+    are resolved without overwriting content that is still needed, and
+    without an outdated file ever looking deleted.
+
     Repository.commit() should be called after calling this to commit the
     changes to the working directory.
 
+    temporary_directory:
+        Where files are moved while renaming, see apply_renames().
+
     precondition: WD clean
+
+    return:
+        A dict { source path: target path } of the renames applied.
     """
+    from harmony.working_directory import WorkingDirectory
+
+    assert isinstance(working_directory, WorkingDirectory)
 
     # Automatically apply auto-renaming
     # Auto-renaming
     # -------------
-    # 1. Find any files $A with a WIPE entry.
+    # 1. Find any files $A with a WIPE entry (or outdated content, see
+    #    above).
     # 2. Compute/get their digest (from location state)
-    # 3. Find a non-wiped file $B in repo that does not exist in the WD
-    # 4. Rename $A to $B
+    # 3. Find a non-wiped file $B in repo with that digest that does not
+    #    exist in the WD (or is itself going to be moved away)
+    # 4. Rename all $A to their $B at once
 
-    for path, entry in repository_state.files.items():
-        logger.debug('auto_rename: {}: path={} wipe={} in_wd={}'.format(path, entry.path, entry.wipe, (entry.path in working_directory)))
-        if entry.wipe and (entry.path in working_directory):
-            possible_targets = {
-                e.path for e in repository_state.files.values()
-                if e.path != path and e.digest == entry.digest and not e.wipe
-            }
-            logger.info(
-                '{} could be auto-renamed to any of {}'.format(
-                    path, possible_targets
-                )
-            )
-            if possible_targets:
-                (working_directory.path / path).rename(working_directory.path / possible_targets.pop())
+    # Digest -> non-wiped paths
+    targets = defaultdict(list)
 
+    # Path -> digest of the current content of files that may be moved
+    sources = {}
 
+    for path, entry in repository_state.files.items():
+        if not entry.wipe:
+            targets[entry.digest].append(entry.path)
+
+        if location_states is not None:
+            local_digest = location_states.get_file_state(id_, entry.path).digest
+            if local_digest is None or local_digest == entry.digest and not entry.wipe:
+                continue
+        else:
+            if not entry.wipe:
+                continue
+            local_digest = entry.digest
+
+        if entry.path in working_directory:
+            sources[entry.path] = local_digest
+
+    # Plan renames, then drop the ones that would overwrite sources that
+    # are not moved away themselves or move away outdated (not wiped)
+    # files whose path is not filled again. Dropping a rename can block
+    # others and frees its target for other sources, so plan again
+    # without the dropped sources until nothing is blocked.
+    excluded = set()
+    while True:
+        renames = plan_renames(working_directory, sources, targets, excluded)
+        filled = set(renames.values())
+        blocked = {
+            source for source, target in renames.items()
+            if (target in sources and target not in renames)
+            or (not repository_state[source].wipe and source not in filled)
+        }
+        if not blocked:
+            break
+        excluded.update(blocked)
+
+    apply_renames(working_directory, renames, temporary_directory)
+    return renames
+
+def plan_renames(working_directory, sources, targets, excluded):
+    """
+    Return { source: target } assigning each source in $sources (except
+    $excluded) a path from $targets with its digest that is free, i.e.
+    not in the working directory or about to be moved away. Each target
+    is assigned at most once.
+    """
+    movable = sources.keys() - excluded
+    claimed = set()
+    renames = {}
+    for source in sorted(movable):
+        candidates = [
+            target for target in targets.get(sources[source], ())
+            if target != source and target not in claimed
+            and (target in movable or target not in working_directory)
+        ]
+        if candidates:
+            renames[source] = candidates[0]
+            claimed.add(candidates[0])
+            logger.info('{} could be auto-renamed to any of {}'.format(source, candidates))
+    return renames
+
+
+def apply_renames(working_directory, renames, temporary_directory = None):
+    """
+    Rename files in the working directory according to the dict
+    { source: target }.
+    Targets may be sources of other renames (as for A -> B, B -> C or swaps),
+    so all sources are moved to a temporary name first.
+
+    temporary_directory:
+        Where the files are moved first, should be on the same filesystem
+        as the working directory but not tracked (default: next to the
+        sources, hidden).
+    """
+    temporary = {}
+    for source in renames:
+        s = working_directory.path / source
+        if temporary_directory is None:
+            t = s.with_name('.{}.harmony-rename'.format(s.name))
+        else:
+            # (Unique, but keeping the name in case it needs to be found)
+            t = Path(temporary_directory) / '{}-{}.harmony-rename'.format(
+                os.urandom(8).hex(), s.name
+            )
+        logger.debug('auto_rename: {} -> {}'.format(s, t))
+        s.rename(t)
+        temporary[source] = t
+
+    for source, target in renames.items():
+        t = working_directory.path / target
+        logger.info('auto_rename: {} -> {}'.format(source, target))
+        t.parent.mkdir(parents = True, exist_ok = True)
+        temporary[source].rename(t)
 
@@ -0,0 +1,116 @@
+
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from harmony.serialization import FileSerializable, JournaledSerializable
+
+logger = logging.getLogger(__name__)
+
+class HashCache(JournaledSerializable, FileSerializable):
+    """
+    Remembers digests of files by their identity on disk, that is
+    (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns).
+    As long as none of these change, a file does not need to be read again to
+    determine its digest, even if the location state knows nothing about it
+    (eg. after a clone into an existing tree or a location state reset).
+
+    The cache is bounded to max_entries entries, the least recently used ones
+    are evicted first.
+
+    Added and evicted entries are saved to a journal, the whole cache is
+    only written when the journal is compacted. (The recency of lookups
+    is not saved, so after loading, entries are ordered by when they were
+    added.)
+    """
+
+    RELATIVE_PATH = 'hash_cache'
+    DEFAULT_MAX_ENTRIES = 500000
+    # The cache can be much larger than the number of changes per commit,
+    # compact less often than the state files
+    COMPACT_JOURNAL_RECORDS = 50000
+
+    @staticmethod
+    def key(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+    @classmethod
+    def load(class_, path, read_only = False):
+        # Repositories created before the cache existed simply start with an
+        # empty one.
+        if not Path(path).exists():
+            return class_(path)
+        return super().load(path, read_only)
+
+    @classmethod
+    def from_dict(class_, d):
+        return class_(
+            d['path'],
+            entries = OrderedDict(
+                (tuple(e[:-1]), e[-1]) for e in d['entries']
+            )
+        )
+
+    def to_dict(self):
+        return {
+            'entries': [list(k) + [v] for k, v in self.entries.items()],
+        }
+
+    def __init__(self, path, entries = None, max_entries = DEFAULT_MAX_ENTRIES):
+        super().__init__(path)
+        self.entries = entries if entries else OrderedDict()
+        self.max_entries = max_entries
+        # Keys added, changed or evicted since the last save, in the order
+        # of their last change so replaying keeps the order of entries
+        self._dirty = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, stat, hasher_name):
+        """
+        Return the cached digest for the file with the given stat result or
+        None if it is unknown or was produced by a different hasher.
+        """
+        key = self.key(stat)
+        digest = self.entries.get(key)
+        if digest is None or not digest.startswith(hasher_name + ':'):
+            return None
+        self.entries.move_to_end(key)
+        return digest
+
+    def put(self, stat, digest):
+        key = self.key(stat)
+        if self.entries.get(key) != digest:
+            self.entries[key] = digest
+            self._mark_dirty(key)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last = False)
+            self._mark_dirty(evicted)
+
+    def _mark_dirty(self, key):
+        self._dirty.pop(key, None)
+        self._dirty[key] = True
+
+    def take_journal_records(self):
+        r = [
+            {
+                'key': list(k),
+                'digest': self.entries.get(k),
+            }
+            for k in self._dirty
+        ]
+        self._dirty = OrderedDict()
+        return r
+
+    def replay(self, records):
+        for record in records:
+            key = tuple(record['key'])
+            if record['digest'] is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = record['digest']
+                self.entries.move_to_end(key)
+
@@ -5,27 +5,40 @@ import warnings
 DEFAULT = 'sha1'
 BLOCKSIZE = 1024 ** 2
 
-def get_hasher(h):
-    if h == 'default':
-        h = DEFAULT
+class Digester:
+    """
+    Incremental form of a hasher (see get_hasher()): feed the data with
+    update(), digest() returns the digest in the same format.
+    """
+
+    def __init__(self, h):
+        if h == 'default':
+            h = DEFAULT
+
+        try:
+            self.hashlib_hasher = getattr(hashlib, h)()
+        except AttributeError:
+            raise ValueError('Hasher "{}" not found in hashlib.'.format(h))
+        self.name = h
 
-    try:
-        hashlib_hasher = getattr(hashlib, h)()
-    except AttributeError:
-        raise ValueError('Hasher "{}" not found in hashlib.'.format(h))
+    def update(self, data):
+        self.hashlib_hasher.update(data)
 
+    def digest(self):
+        return '{}:{}'.format(self.name, self.hashlib_hasher.hexdigest())
+
+def get_hasher(h):
+    digester = Digester(h)
 
     def hasher(s):
         if hasattr(s, 'read'):
             for block in iter(lambda: s.read(BLOCKSIZE), b''):
-                hashlib_hasher.update(block)
-            digest = hashlib_hasher.hexdigest()
+                digester.update(block)
         else:
             warnings.warn('You should call a hasher with a file-like.', DeprecationWarning)
-            hashlib_hasher.update(s)
-            digest = hashlib_hasher.hexdigest()
+            digester.update(s)
 
-        return '{}:{}'.format(h, digest)
+        return digester.digest()
 
     return hasher
 
@@ -1,12 +1,14 @@
 
 import datetime
-from copy import deepcopy
 import logging
+from collections import defaultdict
 from pathlib import Path
 
 from harmony.working_directory import FileState
-from harmony.serialization import Serializable, DirectorySerializable
-from harmony.util import datetime_to_iso, iso_to_datetime, shortened_id
+from harmony import serialization
+from harmony.serialization import Serializable, DirectorySerializable, JournaledSerializable, \
+    LazyItems, loaded_items
+from harmony.util import datetime_to_iso, iso_to_datetime, shortened_id, intern_path
 
 logger = logging.getLogger(__name__)
 
@@ -31,16 +33,75 @@ class LocationState(Serializable):
     def from_dict(class_, d):
         r = super().from_dict(d)
         r.files = {
-            Path(k): FileState.from_dict(v)
+            intern_path(k): FileState.from_dict(v)
             for k, v in r.files.items()
         }
         return r
 
 
-class LocationStates(DirectorySerializable):
+class DigestIndex:
+    """
+    Inverted index from digests to the locations that have a file with
+    that content.
+    """
+
+    def __init__(self):
+        # { digest: { location id: number of files } }
+        self.locations = defaultdict(dict)
+        # { digest: size }
+        self.sizes = {}
+
+    def add(self, id_, file_state):
+        if not file_state.exists() or file_state.digest is None:
+            return
+        counts = self.locations[file_state.digest]
+        counts[id_] = counts.get(id_, 0) + 1
+        self.sizes[file_state.digest] = file_state.size
+
+    def remove(self, id_, file_state):
+        if not file_state.exists() or file_state.digest is None:
+            return
+        counts = self.locations[file_state.digest]
+        counts[id_] -= 1
+        if not counts[id_]:
+            del counts[id_]
+        if not counts:
+            del self.locations[file_state.digest]
+            del self.sizes[file_state.digest]
+
+    def get(self, digest):
+        """
+        Return { location id: size } for all locations with a file with
+        content $digest.
+        """
+        counts = self.locations.get(digest)
+        if counts is None:
+            return {}
+        size = self.sizes[digest]
+        return { id_: size for id_ in counts }
+
+
+class LocationStates(JournaledSerializable, DirectorySerializable):
+    """
+    The LocationState of each known location, one file per location.
+
+    When loaded from disk, the file of a location is only read when the
+    location is accessed. Clock and last modification time of all
+    locations are also kept in a small summary file next to the directory
+    (see summary_path()), so they can be known without reading the location
+    files.
+    Summary entries carry inode, size and mtime of the location file they
+    describe and are ignored if that does not match anymore.
+    """
 
     RELATIVE_PATH = 'location_states'
     Item = LocationState
+    LAZY = True
+    SUMMARY_SUFFIX = '.summary'
+
+    @classmethod
+    def summary_path(class_, path):
+        return Path(str(path) + class_.SUMMARY_SUFFIX)
 
     @staticmethod
     def now():
@@ -48,9 +109,93 @@ class LocationStates(DirectorySerializable):
 
     def __init__(self, path, items = None):
         super(LocationStates, self).__init__(path, items if items else {})
-        assert not items or type(list(items.values())[0]) is not dict
+        assert isinstance(self.items, LazyItems) or not items \
+            or type(list(items.values())[0]) is not dict
+        # (location id, path) of file states and location ids of
+        # clocks changed since the last save
+        self._dirty_files = set()
+        self._dirty_items = set()
+        # Ids of locations replaced as a whole by update() before they
+        # were loaded, journaled as a whole, too
+        self._replaced_items = set()
+        # Location ids whose files lag behind the journal
+        self._stale_files = set()
+
+        # Journal records for locations that have not been loaded yet,
+        # applied when they are
+        self._deferred = defaultdict(list)
+        # { location id: (clock, last_modification) }
+        # for locations that have not been loaded yet
+        self._clocks = {}
+        # Valid entries of the summary file
+        self._summary = {}
+        self._summary_modified = False
+        # DigestIndex over all locations, built by locations_with_digest()
+        # and kept up to date from then on
+        self._digest_index = None
+        self._observer = None
+
+        if isinstance(self.items, LazyItems):
+            self._summary = self.read_summary()
+            self._clocks = {
+                id_: (e['clock'], e['last_modification'])
+                for id_, e in self._summary.items()
+            }
+            load = self.items.load
+            self.items.load = lambda id_: self._load_item(load, id_)
+
+    def observe(self, callback):
+        """
+        Call $callback(id_, path) for every file state that changes from
+        now on, path is None if the whole location was replaced.
+        """
+        self._observer = callback
+
+    def _file_signature(self, id_):
+        try:
+            st = serialization.stat(self.path / id_)
+        except FileNotFoundError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def read_summary(self):
+        try:
+            summary = serialization.read(self.summary_path(self.path))
+        except FileNotFoundError:
+            return {}
+
+        return {
+            id_: entry for id_, entry in summary.items()
+            if id_ in self.items and self._file_signature(id_) == entry['file']
+        }
+
+    def _summarize(self, id_, item):
+        # Call right after $item has been read from / written to its file
+        self._summary[id_] = {
+            'clock': item.clock,
+            'last_modification': item.last_modification,
+            'file': self._file_signature(id_),
+        }
+        self._summary_modified = True
+
+    def write_summary(self):
+        if self._summary_modified:
+            serialization.write(self._summary, self.summary_path(self.path), self.FORMAT)
+            self._summary_modified = False
+
+    def _load_item(self, load, id_):
+        logger.debug('loading location state {}'.format(shortened_id(id_)))
+        item = load(id_)
+        if id_ not in self._summary:
+            self._summarize(id_, item)
+        for record in self._deferred.pop(id_, ()):
+            self._apply(item, record)
+        self._clocks.pop(id_, None)
+        return item
 
     def get_clock(self, id_):
+        if id_ in self._clocks:
+            return self._clocks[id_][0]
         return self.items[id_].clock
 
     def item_to_dict(self, item):
@@ -60,12 +205,111 @@ class LocationStates(DirectorySerializable):
         item.modified = False
         return r
 
+    def save(self):
+        super().save()
+        # Locations that do not have a file of their own yet get one right
+        # away (their changes are in the journal, too, so this is just a
+        # head start for the next compaction)
+        for id_, item in loaded_items(self.items):
+            p = self.path / id_
+            if not serialization.exists(p):
+                serialization.write(self.item_to_dict(item), p, self.FORMAT)
+                self._summarize(id_, item)
+        self.write_summary()
+
+    def items_to_save(self):
+        if not self._loaded:
+            return super().items_to_save()
+        return [
+            id_ for id_, _ in loaded_items(self.items)
+            if id_ in self._stale_files or not serialization.exists(self.path / id_)
+        ]
+
+    def write_base(self):
+        # Journal records that have not been applied yet need to end up
+        # in the files
+        for id_ in list(self._deferred):
+            self.items[id_]
+        written = self.items_to_save()
+        super().write_base()
+        for id_ in written:
+            self._summarize(id_, self.items[id_])
+        self._stale_files = set()
+
+    def take_journal_records(self):
+        for id_, item in loaded_items(self.items):
+            if item.modified:
+                item.clock += 1
+                item.modified = False
+                self._dirty_items.add(id_)
+
+        r = []
+        for id_ in self._replaced_items:
+            r.append({
+                'location': id_,
+                'item': self.item_to_dict(self.items[id_]),
+            })
+        for id_, path in self._dirty_files:
+            file_state = self.items[id_].files.get(path)
+            r.append({
+                'location': id_,
+                'path': str(path),
+                'state': file_state.to_dict() if file_state is not None else None,
+            })
+        for id_ in self._dirty_items:
+            item = self.items[id_]
+            r.append({
+                'location': id_,
+                'clock': item.clock,
+                'last_modification': item.last_modification,
+            })
+
+        self._stale_files.update(record['location'] for record in r)
+        self._dirty_files = set()
+        self._dirty_items = set()
+        self._replaced_items = set()
+        return r
+
+    def replay(self, records):
+        for record in records:
+            id_ = record['location']
+            self._stale_files.add(id_)
+            if 'item' in record:
+                # No need to load the location state this replaces
+                self.items[id_] = LocationState.from_dict(record['item'])
+                self._deferred.pop(id_, None)
+                self._clocks.pop(id_, None)
+                continue
+
+            if isinstance(self.items, LazyItems) and id_ in self.items \
+                    and not self.items.is_loaded(id_):
+                self._deferred[id_].append(record)
+                if 'clock' in record:
+                    self._clocks[id_] = (record['clock'], record['last_modification'])
+                continue
+
+            if id_ not in self.items:
+                self.items[id_] = LocationState(location = id_)
+            self._apply(self.items[id_], record)
+
+    @staticmethod
+    def _apply(item, record):
+        if 'path' in record:
+            path = intern_path(record['path'])
+            if record['state'] is None:
+                item.files.pop(path, None)
+            else:
+                item.files[path] = FileState.from_dict(record['state'])
+        else:
+            item.clock = record['clock']
+            item.last_modification = record['last_modification']
+
     def get_file_state(self, id_, path):
         """
         preconditions:
             $path is normalized with WorkingDirectory.normalize
         """
-        path = Path(path)
+        path = intern_path(path)
 
         r = self.items.get(id_, LocationState()).files.get(
             path,
@@ -77,7 +321,7 @@ class LocationStates(DirectorySerializable):
         if id_ is None:
             r = set()
             for d in self.items.values():
-                r.update(set(d['files'].keys()))
+                r.update(d.files.keys())
             return r
 
         else:
@@ -86,40 +330,101 @@ class LocationStates(DirectorySerializable):
     def get_locations(self):
         return self.items.keys()
 
+    def locations_with_digest(self, digest):
+        """
+        Return { location id: size } for all locations that have a file with
+        the given digest.
+        The first call loads all locations to build the index.
+        """
+        if self._digest_index is None:
+            index = DigestIndex()
+            for id_ in self.items:
+                for f in self.items[id_].files.values():
+                    index.add(id_, f)
+            self._digest_index = index
+        return self._digest_index.get(digest)
+
     def iterate_file_states(self, id_):
         return self.items.get(id_, LocationState()).files.values()
 
 
     def update(self, other):
+        """
+        Take over the location states of $other that are newer than ours.
+        Those are shared rather than copied, so $other should not be used
+        afterwards.
+        Only the newer location states are loaded.
+        """
         logger.debug('location_states update')
-        for id_, d in other.items.items():
-            assert isinstance(d, LocationState)
-
-            if id_ not in self.items or self.items[id_].clock < d.clock:
+        for id_ in list(other.get_locations()):
+            clock = other.get_clock(id_)
+            if id_ not in self.items or self.get_clock(id_) < clock:
                 logger.debug('overwriting state for {} (={}) with remote'.format(shortened_id(id_), id_))
-                self.items[id_] = deepcopy(d)
+                d = other.items[id_]
+                assert isinstance(d, LocationState)
+                if self.journaling:
+                    if isinstance(self.items, LazyItems) and id_ in self.items \
+                            and not self.items.is_loaded(id_):
+                        # Journal the whole location state rather than
+                        # loading the old one to find the differences
+                        self._replaced_items.add(id_)
+                    else:
+                        self._mark_replaced(id_, d)
+                if self._digest_index is not None:
+                    if id_ in self.items:
+                        for f in self.items[id_].files.values():
+                            self._digest_index.remove(id_, f)
+                    for f in d.files.values():
+                        self._digest_index.add(id_, f)
+                self.items[id_] = d
+                # Whatever was known about the replaced state (if it has not
+                # been loaded) is outdated
+                self._clocks.pop(id_, None)
+                self._deferred.pop(id_, None)
+                if self._observer is not None:
+                    self._observer(id_, None)
             else:
                 logger.debug('keeping state for {}'.format(id_))
-                logger.debug('  clock local:  {} t={}'.format(self.items[id_].clock, self.items[id_].last_modification))
-                logger.debug('    {}'.format(self.items[id_].files))
-                logger.debug('  clock remote: {} t={}'.format(d.clock, d.last_modification))
-                logger.debug('    {}'.format(d.files))
+                logger.debug('  clock local:  {}'.format(self.get_clock(id_)))
+                logger.debug('  clock remote: {}'.format(clock))
 
-    def update_file_state(self, id_, file_state_):
-        file_state = deepcopy(file_state_)
+    def _mark_replaced(self, id_, new):
+        # Record only the file states that actually differ
+        old_files = self.items[id_].files if id_ in self.items else {}
+        self._dirty_files.update(
+            (id_, p) for p, f in new.files.items()
+            if p not in old_files or old_files[p].to_dict() != f.to_dict()
+        )
+        self._dirty_files.update(
+            (id_, p) for p in old_files.keys() - new.files.keys()
+        )
+        self._dirty_items.add(id_)
 
-        assert file_state.path == file_state_.path
-        assert file_state.digest == file_state_.digest
+    def update_file_state(self, id_, file_state):
+        """
+        Record $file_state for location $id_.
+        $file_state is stored as is and must not be modified afterwards.
 
+        return:
+            True iff the recorded contents changed.
+        """
         if id_ not in self.items:
             self.items[id_] = LocationState(last_modification = self.now(), location = id_)
 
         p = file_state.path
         files = self.items[id_].files
         if p not in files or file_state.contents_different(files[p]):
+            if self._digest_index is not None:
+                if p in files:
+                    self._digest_index.remove(id_, files[p])
+                self._digest_index.add(id_, file_state)
             files[p] = file_state
+            if self.journaling:
+                self._dirty_files.add((id_, p))
             self.items[id_].modified = True
             self.items[id_].last_modification = self.now()
+            if self._observer is not None:
+                self._observer(id_, p)
             return True
 
         return False
@@ -0,0 +1,204 @@
+
+"""
+Index of the repository's paths as a tree of directories, so queries for a
+directory (which files are in it, how many of them are missing locally,
+...) only touch that directory's subtree instead of every path of the
+repository.
+"""
+
+import logging
+from pathlib import Path
+
+from harmony.util import intern_path
+
+logger = logging.getLogger(__name__)
+
+class PathIndexNode:
+    """
+    A directory in a PathIndex.
+
+    Aggregates cover all files in the subtree (not counting wiped ones):
+    count:
+        Number of files in the repository.
+    size:
+        Total size of the local copies of these files.
+    missing:
+        Number of files without a local copy.
+    outdated:
+        Number of files whose local copy is not the current version.
+    """
+
+    __slots__ = ('children', 'files', 'count', 'size', 'missing', 'outdated')
+
+    def __init__(self):
+        # { name: PathIndexNode } for subdirectories
+        self.children = {}
+        # { name: (path, size, missing, outdated, count) } for the files
+        # directly in this directory, with what they add to the aggregates
+        self.files = {}
+        self.count = 0
+        self.size = 0
+        self.missing = 0
+        self.outdated = 0
+
+    def iterate_paths(self):
+        """
+        Yield the paths of all files in the subtree.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for f in node.files.values():
+                yield f[0]
+            stack.extend(node.children.values())
+
+class PathIndex:
+    """
+    Kept up to date with set() / update() as files change and stored with
+    to_dict() (see Repository.get_path_index()), so it only has to be
+    built from the complete states (from_states()) once.
+    """
+
+    @staticmethod
+    def contribution(repository_entry, local):
+        """
+        Return the keyword arguments for set() for a file with the given
+        RepositoryFileState (None if unknown) and local FileState.
+        """
+        if repository_entry is None or repository_entry.wipe:
+            return {}
+        return {
+            'size': local.size or 0,
+            'missing': not local.exists(),
+            'outdated': local.exists() and local.digest != repository_entry.digest,
+            'count': True,
+        }
+
+    @classmethod
+    def from_states(class_, repository_state, location_states, id_):
+        """
+        Index the paths of $repository_state with the aggregates for the
+        location $id_ according to $location_states.
+        """
+        r = class_()
+        for entry in repository_state.files.values():
+            r.update(entry.path, repository_state, location_states, id_)
+        return r
+
+    @classmethod
+    def from_dict(class_, d):
+        r = class_()
+        for path, (size, missing, outdated, count) in d['files'].items():
+            r.set(path, size, missing, outdated, count)
+        return r
+
+    def to_dict(self):
+        files = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for path, size, missing, outdated, count in node.files.values():
+                files[str(path)] = [size, missing, outdated, count]
+            stack.extend(node.children.values())
+        return { 'files': files }
+
+    def __init__(self):
+        self.root = PathIndexNode()
+
+    def update(self, path, repository_state, location_states, id_):
+        """
+        Update the file $path from its entry in $repository_state and the
+        file state of location $id_ in $location_states.
+        """
+        entry = repository_state.get(path)
+        if entry is None:
+            self.remove(path)
+        else:
+            self.set(path, **self.contribution(entry, location_states.get_file_state(id_, path)))
+
+    def set(self, path, size = 0, missing = False, outdated = False, count = False):
+        """
+        Add (or replace) the file $path, adding $size, $missing, $outdated
+        and $count (as 1/0) to the aggregates of all directories it is in.
+        """
+        path = intern_path(path)
+        node = self.root
+        nodes = [node]
+        for name in path.parts[:-1]:
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = PathIndexNode()
+            node = child
+            nodes.append(node)
+
+        old = node.files.get(path.name)
+        node.files[path.name] = (path, size, bool(missing), bool(outdated), bool(count))
+        if old is not None:
+            self._add(nodes, *old[1:], sign = -1)
+        self._add(nodes, size, missing, outdated, count)
+
+    add = set
+
+    def remove(self, path):
+        """
+        Remove the file $path (if it is there), directories left empty go
+        as well.
+        """
+        path = intern_path(path)
+        node = self.root
+        nodes = [node]
+        for name in path.parts[:-1]:
+            node = node.children.get(name)
+            if node is None:
+                return
+            nodes.append(node)
+
+        old = node.files.pop(path.name, None)
+        if old is None:
+            return
+        self._add(nodes, *old[1:], sign = -1)
+
+        for parent, child, name in reversed(list(zip(nodes, nodes[1:], path.parts))):
+            if child.files or child.children:
+                break
+            del parent.children[name]
+
+    @staticmethod
+    def _add(nodes, size, missing, outdated, count, sign = 1):
+        for node in nodes:
+            node.count += sign * count
+            node.size += sign * size
+            node.missing += sign * missing
+            node.outdated += sign * outdated
+
+    def find(self, directory = None):
+        """
+        Return the PathIndexNode for $directory (relative to the repository
+        root, None for the root) or None if there is no such directory.
+        """
+        node = self.root
+        if directory is None:
+            return node
+        for name in Path(directory).parts:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def is_directory(self, path):
+        return self.find(path) is not None
+
+    def iterate_paths(self, directory = None):
+        """
+        Yield the paths of all files under $directory (None for all files).
+        A $directory that is a file yields that file only.
+        """
+        node = self.find(directory)
+        if node is not None:
+            yield from node.iterate_paths()
+            return
+
+        path = intern_path(directory)
+        parent = self.find(path.parent)
+        if parent is not None and path.name in parent.files:
+            yield parent.files[path.name][0]
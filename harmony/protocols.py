@@ -1,5 +1,7 @@
 
+import os
 import os.path
+import errno
 import shutil
 import glob
 import logging
@@ -7,12 +9,186 @@ from pathlib import Path
 import re
 from collections import namedtuple
 import tempfile
+import threading
+import time
+import atexit
 
-from paramiko import SSHClient, AutoAddPolicy
-from scp import SCPClient
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from paramiko import SSHClient, AutoAddPolicy, SFTPClient, SSHException
+from scp import SCPClient, SCPException
+
+from harmony import hashers
 
 logger = logging.getLogger(__name__)
 
+class TransferStatistics:
+    """
+    Throughput of a batch of file transfers.
+    """
+
+    def __init__(self, files = 0, bytes_ = 0, seconds = 0.0, failed = 0):
+        self.files = files
+        self.bytes = bytes_
+        self.seconds = seconds
+        # Number of files that were not put in place (not included in
+        # self.files)
+        self.failed = failed
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        r = '{} files ({} bytes) in {:.2f}s: {:.1f} files/s, {:.0f} bytes/s'.format(
+            self.files, self.bytes, self.seconds,
+            self.files_per_second, self.bytes_per_second
+        )
+        if self.failed:
+            r += ', {} failed'.format(self.failed)
+        return r
+
+class HashingReader:
+    """
+    File-like that reads from $source and writes everything read to
+    $destination, so a hasher can digest data while it is copied.
+    """
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+    def read(self, size = -1):
+        data = self.source.read(size)
+        self.destination.write(data)
+        return data
+
+class HashingWriter:
+    """
+    File-like that writes to $destination and digests everything
+    written, for receiving data that is pushed rather than read.
+    """
+
+    def __init__(self, destination, hasher_name = hashers.DEFAULT):
+        self.destination = destination
+        self.digester = hashers.Digester(hasher_name)
+
+    def write(self, data):
+        self.digester.update(data)
+        return self.destination.write(data)
+
+    def digest(self):
+        return self.digester.digest()
+
+def copy_hashed(source, destination, hasher_name = hashers.DEFAULT):
+    """
+    Copy the file $source to $destination and return the digest of its
+    contents, reading it once.
+    """
+    hasher = hashers.get_hasher(hasher_name)
+    with open(source, 'rb') as f, open(destination, 'wb') as g:
+        return hasher(HashingReader(f, g))
+
+# ioctl request for cloning a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+def reflink(source, destination):
+    """
+    Make $destination a copy-on-write clone of $source.
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'reflinks are not supported on this platform')
+    with open(source, 'rb') as f, open(destination, 'wb') as g:
+        fcntl.ioctl(g.fileno(), FICLONE, f.fileno())
+
+def copy_file_range(source, destination):
+    """
+    Copy $source to $destination within the kernel (which may also clone
+    or copy on the server side, depending on the filesystem).
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOTSUP, 'copy_file_range is not supported on this platform')
+    with open(source, 'rb') as f, open(destination, 'wb') as g:
+        size = os.fstat(f.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.copy_file_range(f.fileno(), g.fileno(), size - copied)
+            if n == 0:
+                break
+            copied += n
+
+def sendfile(source, destination):
+    """
+    Copy $source to $destination within the kernel.
+    """
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOTSUP, 'sendfile is not supported on this platform')
+    with open(source, 'rb') as f, open(destination, 'wb') as g:
+        size = os.fstat(f.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.sendfile(g.fileno(), f.fileno(), copied, size - copied)
+            if n == 0:
+                break
+            copied += n
+
+def hardlink(source, destination):
+    """
+    Make $destination another name for $source. Changing the contents of
+    one changes the other, so only use this for content that is never
+    modified in place.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    os.link(source, destination)
+
+# Ways for FileProtocol to copy a file without the data passing through
+# this process, see FileProtocol.strategies
+COPY_STRATEGIES = {
+    'reflink': reflink,
+    'copy_file_range': copy_file_range,
+    'sendfile': sendfile,
+    'hardlink': hardlink,
+}
+
+class TransferError(Exception):
+    pass
+
+# Errors that make a transfer (or a single file of it) fail without being
+# a bug in harmony
+TRANSFER_ERRORS = (OSError, TransferError, SCPException, SSHException)
+
+def make_temporary_file(directory):
+    """
+    Create an empty file with a unique name in $directory and return its
+    path. Unlike tempfile.mkstemp(), the file gets the usual permissions
+    (0666 minus the umask), which it keeps when it is moved into place.
+    """
+    while True:
+        path = Path(directory) / '.harmony-{}.tmp'.format(os.urandom(8).hex())
+        try:
+            fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return path
+
+def get_hasher_name(digest):
+    """
+    Return the name of the hasher that produced $digest
+    (the default one for None).
+    """
+    if digest is None:
+        return hashers.DEFAULT
+    return digest.split(':', 1)[0]
+
 class ProtocolMeta(type):
     def __init__(class_, name, bases, dict_):
         if not hasattr(class_, 'registry'):
@@ -32,22 +208,126 @@ class Protocol(metaclass = ProtocolMeta):
         'location'
         )
 
-    def __init__(self, uri):
+    def __init__(self, uri, **options):
+        """
+        options:
+            Protocol specific settings (see connect()), those a protocol
+            does not know are ignored.
+        """
         self.address = self.parse_uri(uri)
+        # Called (last registered first) when the with block is left
+        self.exit_callbacks = []
+
+    def call_on_exit(self, callback):
+        """
+        Call $callback() when the with block of this connection is left,
+        e.g. to close what has been opened from the files returned by
+        pull_harmony_files(), which may be gone afterwards.
+        """
+        self.exit_callbacks.append(callback)
+
+    def run_exit_callbacks(self):
+        while self.exit_callbacks:
+            self.exit_callbacks.pop()()
+
+    def pull_working_files(self, paths, working_directory, digests = None, expected_digests = None,
+                           temporary_directory = None):
+        """
+        Get $paths into $working_directory. Each file is received into a
+        temporary file and hashed on the way, it only replaces the file in
+        the working directory if its digest is as expected. Files that can
+        not be received are skipped (with a warning).
+
+        digests:
+            If given, a dict that receives { path: digest } for the files
+            put in place.
+        expected_digests:
+            Optional dict { path: digest }. Files whose received contents
+            have a different digest are discarded.
+        temporary_directory:
+            Where to receive the files, must be on the same filesystem as
+            $working_directory and should not be tracked (default: the
+            working directory itself).
+
+        return:
+            A dict { path: absolute path } for the files put in place.
+        """
+        working_directory = Path(working_directory)
+        if temporary_directory is None:
+            temporary_directory = working_directory
+        expected_digests = expected_digests if expected_digests is not None else {}
+        r = {}
+        for path in paths:
+            destination = working_directory / path
+            expected = expected_digests.get(path)
+            temporary = make_temporary_file(temporary_directory)
+            try:
+                digest = self.receive_file(path, temporary, get_hasher_name(expected))
+                if expected is not None and digest != expected:
+                    raise TransferError('{} has digest {}, expected {}'.format(
+                        path, digest, expected
+                    ))
+                # Directories are only created for files that arrived
+                destination.parent.mkdir(parents = True, exist_ok = True)
+                os.replace(str(temporary), str(destination))
+            except TRANSFER_ERRORS as e:
+                # One file failing (e.g. because it is not there) should
+                # not keep the others from being transferred
+                logger.warning('Not getting {}: {}'.format(path, e))
+                continue
+            finally:
+                if os.path.lexists(str(temporary)):
+                    os.remove(str(temporary))
+
+            r[path] = destination
+            if digests is not None:
+                digests[path] = digest
+        return r
 
     @classmethod
-    def connect(class_, uri):
+    def connect(class_, uri, **options):
+        """
+        Return a connection to $uri by the first protocol that can handle
+        it, None if there is none.
+
+        options:
+            Passed on to the protocol, e.g. strategies for FileProtocol.
+        """
         assert isinstance(uri, str) or isinstance(uri, Path)
         uri = str(uri)
         for protocol in sorted(class_.registry.values(), key = lambda x: x.priority):
             if protocol.is_valid(uri):
-                return protocol(uri)
+                return protocol(uri, **options)
         return None
 
 class FileProtocol(Protocol):
 
     priority = 1000
     Address = Path
+    # How to copy files, tried in order until one works, see
+    # COPY_STRATEGIES, overridden per connection by the 'strategies' option
+    # (the 'transfer_strategies' repository setting). Put 'hardlink' first
+    # to share files with the remote instead of copying them (only safe for
+    # read-only content).
+    # 'copy_file_range' and 'sendfile' are not used by default: the copy
+    # has to be read back for hashing, which makes them slower than 'copy'
+    # unless the filesystem copies on the server side (NFS, SMB). A reflink
+    # is cheap enough for the read back to pay off.
+    strategies = ('reflink', 'copy')
+
+    def __init__(self, uri, strategies = None, **options):
+        """
+        strategies:
+            Overrides FileProtocol.strategies for this connection.
+        """
+        super().__init__(uri, **options)
+        if strategies is not None:
+            unknown = set(strategies) - set(COPY_STRATEGIES) - { 'copy' }
+            if unknown:
+                raise ValueError('Unknown copy strategies: {}'.format(
+                    ', '.join(sorted(unknown))
+                ))
+            self.strategies = tuple(strategies)
 
     @classmethod
     def is_valid(class_, uri):
@@ -72,24 +352,157 @@ class FileProtocol(Protocol):
         return self
 
     def __exit__(self, exc_type, exc_value, trackeback):
-        pass
+        self.run_exit_callbacks()
 
     def pull_harmony_files(self, paths):
         return {p: self.address / p for p in paths}
 
-    def pull_working_files(self, paths, working_directory):
-        working_directory = Path(working_directory)
-        for path in paths:
-            shutil.copyfile(str(self.address / path), str(working_directory / path))
-        return {p: working_directory / p for p in paths}
-
+    def receive_file(self, path, destination, hasher_name):
+        """
+        Copy $path to $destination and return its digest.
 
+        Tries the strategies in self.strategies in turn. The ones from
+        COPY_STRATEGIES do not pass the data through this process, so the
+        copy is read once afterwards for hashing. 'copy' (the fallback if
+        no other strategy works) hashes while copying.
+        """
+        source = str(self.address / path)
+        destination = str(destination)
+        for strategy in self.strategies:
+            if strategy == 'copy':
+                break
+            try:
+                COPY_STRATEGIES[strategy](source, destination)
+            except OSError as e:
+                logger.debug('{} {} -> {} failed: {}'.format(strategy, source, destination, e))
+                continue
+            with open(destination, 'rb') as f:
+                return hashers.get_hasher(hasher_name)(f)
+
+        return copy_hashed(source, destination, hasher_name)
+
+
+
+def ssh_connect(address):
+    """
+    Open an authenticated SSHClient to the host of the given
+    ScpProtocol.Address.
+    """
+    ssh = SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    ssh.connect(address.host, username = address.user, password = address.password)
+    return ssh
+
+class SshConnectionPool:
+    """
+    SSH connections shared by all ScpProtocol instances of the process,
+    one per user and host. A connection is opened on the first acquire()
+    and stays open for later operations on the same host. Its transport
+    multiplexes channels, so several ScpProtocols can use it at the
+    same time.
+
+    Connections that have not been used for $idle_timeout seconds are
+    closed on the next acquire() or release() (or by close_idle()), the
+    remaining ones at exit.
+    """
+
+    def __init__(self, connect = ssh_connect, idle_timeout = 60.0, clock = time.monotonic):
+        """
+        connect:
+            Callable returning a connected SSHClient (or anything with
+            get_transport() and close()) for an ScpProtocol.Address.
+        clock:
+            Time source for the idle timeout.
+        """
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        # { (user, host): client } for the connection acquire() hands out
+        self.connections = {}
+        # { client: [key, number of users, time of last release] } for all
+        # open clients, including dead ones that have been replaced but
+        # are still in use
+        self.usage = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(address):
+        return (address.user, address.host)
+
+    def acquire(self, address):
+        """
+        Return the SSHClient for $address, connecting if there is no
+        usable one. Call release() with it when done.
+        """
+        key = self.key(address)
+        with self.lock:
+            self._close_idle()
+            client = self.connections.get(key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is None or not transport.is_active():
+                    logger.debug('ssh connection to {} is gone'.format(address.host))
+                    # Its users still release it, closed when they did
+                    del self.connections[key]
+                    self._close_idle()
+                    client = None
+
+            if client is None:
+                logger.debug('ssh connecting to {}'.format(address.host))
+                client = self.connections[key] = self.connect(address)
+                self.usage[client] = [key, 0, None]
+            else:
+                logger.debug('ssh reusing connection to {}'.format(address.host))
+
+            self.usage[client][1] += 1
+            return client
+
+    def release(self, client):
+        """
+        Give back $client as returned by acquire().
+        """
+        with self.lock:
+            usage = self.usage.get(client)
+            if usage is not None:
+                usage[1] -= 1
+                usage[2] = self.clock()
+            self._close_idle()
+
+    def close_idle(self):
+        with self.lock:
+            self._close_idle()
+
+    def _close_idle(self):
+        now = self.clock()
+        for client, (key, users, released) in list(self.usage.items()):
+            if users:
+                continue
+            if self.connections.get(key) is not client:
+                logger.debug('ssh closing replaced connection to {}'.format(key[1]))
+            elif now - released >= self.idle_timeout:
+                logger.debug('ssh closing idle connection to {}'.format(key[1]))
+                del self.connections[key]
+            else:
+                continue
+            client.close()
+            del self.usage[client]
+
+    def close_all(self):
+        with self.lock:
+            for client in self.usage:
+                client.close()
+            self.connections = {}
+            self.usage = {}
 
 class ScpProtocol(Protocol):
 
     uri_re = 'ssh://((?P<user>[^:@]+)?(?P<cpasswd>:[^:@]+)?@)?(?P<host>[^:/]+)(?P<path>.+)?'
     Address = namedtuple('SSHAddress', ['user', 'password', 'host', 'path'])
     priority = 500
+    # Shared by all instances, replace for different connection settings
+    # (or tests)
+    pool = SshConnectionPool()
 
     @classmethod
     def is_valid(class_, uri):
@@ -114,24 +527,33 @@ class ScpProtocol(Protocol):
             return p
         return self.address.path + '/' + p
 
-    def __init__(self, uri):
-        super().__init__(uri)
+    def __init__(self, uri, **options):
+        super().__init__(uri, **options)
         if self.address is None:
             raise ValueError('Could not interpret "{}" as an SSH address.'.format(uri))
 
     def __enter__(self):
-        self.ssh = SSHClient()
-        self.ssh.load_system_host_keys()
-        self.ssh.set_missing_host_key_policy(AutoAddPolicy())
-        self.ssh.connect(self.address.host)
-        self.scp = SCPClient(self.ssh.get_transport()).__enter__()
+        self.ssh = self.pool.acquire(self.address)
+        # Not entered, that would open a channel right away which is
+        # never used if all files go through SFTP. Each get() opens its
+        # own.
+        self.scp = SCPClient(self.ssh.get_transport())
         self.tempdir = None
+        # SFTPClient on the same transport, opened by the first
+        # receive_file(), False if the server does not offer SFTP
+        self.sftp = None
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.scp.__exit__(exc_type, exc_value, traceback)
-        if self.tempdir is not None:
-            self.tempdir.__exit__(exc_type, exc_value, traceback)
+        try:
+            self.run_exit_callbacks()
+            if self.sftp:
+                self.sftp.close()
+            self.scp.close()
+            if self.tempdir is not None:
+                self.tempdir.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.pool.release(self.ssh)
 
     # TODO: TBD: join into one function w/ working_directory optional?
     #       Implementation is after all relatively similiar in general...
@@ -146,21 +568,45 @@ class ScpProtocol(Protocol):
                 self.abspath(p), str(r[p])
                 ))
             r[p].parent.mkdir(parents = True, exist_ok = True)
-            self.scp.get(self.abspath(p), str(r[p]))
-        return r
-
-    def pull_working_files(self, paths, working_directory):
-        r = {}
-        for p in paths:
-            source = self.abspath(p)
-            destination = working_directory / p
-            self.scp.get(source, str(destination))
-            r[source] = destination
+            try:
+                self.scp.get(self.abspath(p), str(r[p]), recursive = True)
+            except SCPException as e:
+                # Like for FileProtocol, it is up to the caller to notice
+                # the file is not there (some, like journals, are optional)
+                logger.debug('scp({}) failed: {}'.format(self.abspath(p), e))
         return r
 
+    def open_sftp(self):
+        """
+        Return an SFTPClient on the pooled transport (None if the server
+        does not support SFTP).
+        """
+        if self.sftp is None:
+            try:
+                self.sftp = SFTPClient.from_transport(self.ssh.get_transport())
+            except SSHException as e:
+                logger.debug('no sftp on {}: {}'.format(self.address.host, e))
+                self.sftp = False
+        return self.sftp or None
+
+    def receive_file(self, path, destination, hasher_name):
+        sftp = self.open_sftp()
+        if sftp is None:
+            # SCPClient writes received files itself, there is no hook for
+            # hashing them on the way, so hash the freshly written (thus
+            # cached) file
+            self.scp.get(self.abspath(path), str(destination))
+            with open(str(destination), 'rb') as f:
+                return hashers.get_hasher(hasher_name)(f)
+
+        with open(str(destination), 'wb') as f:
+            writer = HashingWriter(f, hasher_name)
+            sftp.getfo(self.abspath(path), writer)
+        return writer.digest()
 
 
-        
 
 connect = Protocol.connect
 
+atexit.register(lambda: ScpProtocol.pool.close_all())
+
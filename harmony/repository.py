@@ -4,17 +4,25 @@ from pathlib import Path
 import socket
 import logging
 import uuid
+import time
+import fnmatch
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+from harmony import columnar
 from harmony import protocols
 from harmony import serialization
 from harmony import file_state_logic
+from harmony import sharded_state
+from harmony.hash_cache import HashCache
 from harmony.location_states import LocationStates
+from harmony.path_index import PathIndex
 from harmony.repository_state import RepositoryState, RepositoryStateException
 from harmony.remotes import Remotes
+from harmony.state_backends import get_backend
 from harmony.ruleset import Ruleset
 from harmony.working_directory import WorkingDirectory
-from harmony.util import shortened_id
+from harmony.util import shortened_id, intern_path
 
 logger = logging.getLogger(__name__)
 
@@ -22,16 +30,48 @@ class Repository:
 
     HARMONY_SUBDIR = Path('.harmony')
     REPOSITORY_FILE = Path('config')
+    PATH_INDEX_FILE = Path('path_index')
+    TEMPORARY_SUBDIR = Path('tmp')
+
+    # Optional settings in the repository configuration file and the
+    # values used when they are not present.
+    DEFAULT_SETTINGS = {
+        # Number of files to hash in parallel during commit
+        'hash_jobs': 1,
+        # 'thread' or 'process', see WorkingDirectory.EXECUTORS
+        'hash_executor': 'thread',
+        # Maximum number of digests remembered in the hash cache,
+        # 0 disables the cache
+        'hash_cache_size': HashCache.DEFAULT_MAX_ENTRIES,
+        # Use the vectorized implementations in harmony.columnar for merging
+        # and status (requires numpy)
+        'columnar': False,
+        # Where repository and location states are stored, 'files' or
+        # 'sqlite', see harmony.state_backends. Only used when creating a
+        # repository, changing it afterwards is not supported.
+        'state_backend': 'files',
+        # Number of files to transfer in parallel (over shared connections)
+        # on get
+        'transfer_jobs': 4,
+        # How to copy files from a remote on the same machine, see
+        # FileProtocol.strategies, None for its default. E.g.
+        # ['hardlink', 'copy'] shares the files with the remote instead of
+        # copying them (only safe if neither side modifies them in place).
+        'transfer_strategies': None,
+    }
 
     #
     # Factory classmethods (returning Repository instances)
     #
 
     @classmethod
-    def init(class_, working_directory, name = None):
+    def init(class_, working_directory, name = None, state_backend = None):
         """
         Create fresh repository in given working dir.
 
+        state_backend:
+            Name of the state backend to use, see DEFAULT_SETTINGS.
+
         @return Repository instance for created repo.
         """
 
@@ -44,20 +84,25 @@ class Repository:
         harmony_directory.mkdir()
 
         repo = Repository(working_directory, harmony_directory)
+        repo.settings = dict(class_.DEFAULT_SETTINGS)
+        if state_backend is not None:
+            repo.settings['state_backend'] = state_backend
 
         def make_component(class_):
             return class_.init(
                 class_.get_path(repo.harmony_directory)
             )
 
-        repo.location_states = make_component(LocationStates)
-        repo.repository_state = make_component(RepositoryState)
+        repo.location_states, repo.repository_state = \
+            get_backend(repo.settings['state_backend']).init(repo.harmony_directory)
+        repo.observe_states()
         repo.ruleset = make_component(Ruleset)
         repo.remotes = make_component(Remotes)
-        repo.working_directory = WorkingDirectory(working_directory, repo.ruleset)
+        repo.hash_cache = make_component(HashCache)
 
         repo.id = uuid.uuid1().hex
         repo.name = name
+        repo.working_directory = repo.make_working_directory(working_directory)
 
         logging.info('Initialized repository')
         logging.info('  ID  : {} ({})'.format(shortened_id(repo.id), repo.id))
@@ -92,21 +137,30 @@ class Repository:
 
         # TODO: implement a Configuration class so we can use
         # Configuration.load(...) here
-        repo_config = serialization.read(harmony_directory / Repository.REPOSITORY_FILE)
+        repo_config, repo._config_fingerprint = serialization.read_fingerprinted(
+            harmony_directory / Repository.REPOSITORY_FILE
+        )
 
         repo.id = repo_config['id']
         repo.name = repo_config['name']
+        repo.settings = dict(class_.DEFAULT_SETTINGS)
+        repo.settings.update(
+            (k, v) for k, v in repo_config.items()
+            if k in class_.DEFAULT_SETTINGS
+        )
 
         def load_component(class_):
             return class_.load(
                 class_.get_path(repo.harmony_directory)
             )
 
-        repo.location_states = load_component(LocationStates)
-        repo.repository_state = load_component(RepositoryState)
+        repo.location_states, repo.repository_state = \
+            get_backend(repo.settings['state_backend']).load(repo.harmony_directory)
+        repo.observe_states()
         repo.ruleset = load_component(Ruleset)
         repo.remotes = load_component(Remotes)
-        repo.working_directory = WorkingDirectory(working_directory, repo.ruleset)
+        repo.hash_cache = load_component(HashCache)
+        repo.working_directory = repo.make_working_directory(working_directory)
 
         logging.info('Loaded repository')
         logging.info('  ID  : {} ({})'.format(shortened_id(repo.id), repo.id))
@@ -116,11 +170,11 @@ class Repository:
         return repo
 
     @classmethod
-    def clone(class_, working_directory, location, name = None):
+    def clone(class_, working_directory, location, name = None, state_backend = None):
         working_directory = Path(working_directory)
     
         # Create empty repo $r in target location
-        target_repo = class_.init(working_directory, name)
+        target_repo = class_.init(working_directory, name, state_backend)
         config_path = class_.HARMONY_SUBDIR / class_.REPOSITORY_FILE
 
         with protocols.connect(location) as connection:
@@ -203,6 +257,15 @@ class Repository:
         if harmony_directory is None:
             harmony_directory = Repository.find_harmony_directory(working_directory)
         self.harmony_directory = harmony_directory
+        # serialization.fingerprint() of the config file as last read or
+        # written
+        self._config_fingerprint = None
+        # PathIndex, read or built on demand by get_path_index()
+        self._path_index = None
+        # Paths whose entry in the path index may be outdated, the whole
+        # index is if the local location has been replaced
+        self._path_index_dirty = set()
+        self._path_index_stale = False
 
     @property
     def short_id(self):
@@ -214,93 +277,464 @@ class Repository:
         """
         return shortened_id(self.id)
 
+    def make_working_directory(self, path):
+        self.hash_cache.max_entries = self.settings['hash_cache_size']
+        return WorkingDirectory(
+            path,
+            self.ruleset,
+            jobs = self.settings['hash_jobs'],
+            executor = self.settings['hash_executor'],
+            hash_cache = self.hash_cache if self.settings['hash_cache_size'] else None,
+        )
+
+    def observe_states(self):
+        """
+        Track the changes of the states that affect the path index.
+        """
+        def repository_changed(path):
+            self._path_index_dirty.add(path)
+
+        def location_changed(id_, path):
+            if id_ != self.id:
+                return
+            if path is None:
+                self._path_index_stale = True
+            else:
+                self._path_index_dirty.add(path)
+
+        self.repository_state.observe(repository_changed)
+        self.location_states.observe(location_changed)
+
+    @property
+    def use_columnar(self):
+        if not self.settings['columnar']:
+            return False
+        if not columnar.available():
+            logger.warning('Setting "columnar" requires numpy, which is not available.')
+            return False
+        return True
+
     def save(self):
         self.location_states.save()
         self.repository_state.save()
         self.remotes.save()
         self.ruleset.save()
+        self.hash_cache.save()
+        self.save_path_index()
 
         d = {
                 'id': self.id,
                 'name': self.name,
                 }
-        serialization.write(d, self.harmony_directory / Repository.REPOSITORY_FILE)
+        d.update(self.settings)
+        self._config_fingerprint = serialization.write(
+            d, self.harmony_directory / Repository.REPOSITORY_FILE, 'yaml',
+            self._config_fingerprint
+        )
 
     #
     # Actual repository operations
     #
 
-    def commit(self):
+    def commit(self, jobs = None, executor = None, paths = None, digests = None):
+        """
+        Record the current state of the working directory.
+
+        jobs, executor:
+            Override the 'hash_jobs' and 'hash_executor' settings for this
+            commit.
+        paths:
+            Only record the state of these paths (relative to the working
+            directory) instead of scanning the whole working directory.
+        digests:
+            Already known digests of the current contents of files
+            { path: digest }, these files are not read for hashing.
+        """
         logger.debug('{} committing...'.format(self.short_id))
+        if jobs is not None:
+            self.working_directory.jobs = jobs
+        if executor is not None:
+            self.working_directory.executor = executor
+        # Read before the states change, so it can be updated along
+        self.load_path_index()
+
         any_change = file_state_logic.commit(
             self.id,
             self.working_directory,
             self.location_states,
-            self.repository_state
+            self.repository_state,
+            paths = paths,
+            digests = digests
         )
 
         self.location_states.save()
         self.repository_state.save()
+        self.hash_cache.save()
+        self.save_path_index()
         logger.debug('{} committed. Changes seen: {}'.format(self.short_id, any_change))
         return any_change
 
     def pull_state(self, remote_spec):
         logger.debug('{} pull from {}'.format(self.short_id, remote_spec))
-        remote_repository_state = self.fetch(remote_spec)
-        conflicts, new_repository_state = file_state_logic.merge(
-            local_state = self.repository_state,
-            remote_state = remote_repository_state,
-            merger_id = self.id
-        )
+        location = self.remotes.get_location_any(remote_spec)
+        self.load_path_index()
+
+        # The remote state is read lazily (from files that only exist as
+        # long as the connection), so merge within
+        with protocols.connect(location) as connection:
+            remote_repository_state = self.fetch(connection)
+            if sharded_state.can_merge(self.repository_state, remote_repository_state):
+                merge = sharded_state.merge
+            elif self.use_columnar:
+                merge = columnar.merge
+            else:
+                merge = file_state_logic.merge
+            conflicts, new_repository_state = merge(
+                local_state = self.repository_state,
+                remote_state = remote_repository_state,
+                merger_id = self.id
+            )
 
         logger.debug('conflicts={}'.format(list(conflicts.keys())))
         if not len(conflicts):
             logger.debug('auto-merging')
             self.repository_state.overwrite(new_repository_state)
             self.repository_state.save()
+            self.save_path_index()
             file_state_logic.auto_rename(self.working_directory,
-                                         self.repository_state)
+                                         self.repository_state,
+                                         self.location_states,
+                                         self.id,
+                                         self.get_temporary_directory())
             # Commit changes done by auto_rename
             self.commit()
 
         return conflicts
 
-    def fetch(self, remote_spec):
-        location = self.remotes.get_location_any(remote_spec)
-
-        logger.debug('{} fetching from {} which is at {} to {}'.format(
-            self.short_id, remote_spec, location,
-            self.harmony_directory
+    def fetch(self, connection):
+        """
+        Update the location states with the ones of the repository
+        $connection (see protocols.connect()) leads to and return its
+        repository state.
+        """
+        logger.debug('{} fetching from {} to {}'.format(
+            self.short_id, connection.address, self.harmony_directory
         ))
 
-        location_states_path = LocationStates.get_path(self.HARMONY_SUBDIR)
-        repository_state_path = RepositoryState.get_path(self.HARMONY_SUBDIR)
+        # The remote might store its state differently
+        remote_config = self.read_remote_config(connection)
+        backend = get_backend(remote_config.get(
+            'state_backend', self.DEFAULT_SETTINGS['state_backend']
+        ))
 
-        with protocols.connect(location) as connection:
-            files = connection.pull_harmony_files([
-                location_states_path,
-                repository_state_path
-            ])
-            remote_location_states = LocationStates.load(files[location_states_path])
-            repository_state = RepositoryState.load(files[repository_state_path])
+        paths = backend.relative_paths(self.HARMONY_SUBDIR)
+        files = connection.pull_harmony_files(paths)
+        remote_location_states, repository_state = backend.load(
+            files[paths[0]].parent,
+            read_only = True
+        )
+        connection.call_on_exit(
+            lambda: backend.close(remote_location_states, repository_state)
+        )
 
         logger.debug('{} fetched remote state:'.format(self.short_id))
-        for lid, location in remote_location_states.items.items():
-            logger.debug('  {}:'.format(shortened_id(lid)))
-            for f in location.files.values():
-                logger.debug('    {}'.format(f.__dict__))
+        # (Clocks only, listing files would load all location states)
+        for lid in remote_location_states.get_locations():
+            logger.debug('  {}: clock {}'.format(
+                shortened_id(lid), remote_location_states.get_clock(lid)
+            ))
 
         self.location_states.update(remote_location_states)
         self.location_states.save()
+        self.save_path_index()
 
         return repository_state
 
+    def read_remote_config(self, connection):
+        """
+        Return the configuration (id, name, settings) of the repository
+        $connection leads to.
+        """
+        config_path = self.HARMONY_SUBDIR / self.REPOSITORY_FILE
+        files = connection.pull_harmony_files([config_path])
+        return serialization.read(files[config_path])
+
     def pull_file(self, path, remote_spec):
+        """
+        Get the file $path from $remote_spec. If $path is a directory, get
+        the files in it that are missing or outdated here.
+        """
+        return self.pull_files([path], remote_spec)
+
+    def pull_files(self, paths, remote_spec, jobs = None):
+        """
+        Get the given files from $remote_spec and record their new state.
+
+        paths:
+            Paths relative to the working directory. A directory or a glob
+            pattern (see expand_paths()) stands for the files it covers that
+            are missing or outdated here.
+        jobs:
+            Number of files to transfer in parallel, overrides the
+            'transfer_jobs' setting.
+
+        Received files are checked against the digest of their current
+        version, files that do not match (e.g. because the remote has a
+        version this repository does not know about yet) are discarded.
+
+        return:
+            TransferStatistics of the transfer.
+        """
+        jobs = jobs if jobs is not None else self.settings['transfer_jobs']
+        temporary_directory = self.get_temporary_directory()
         location = self.remotes.get_location_any(remote_spec)
         with protocols.connect(location) as connection:
-            connection.pull_working_files([path], self.working_directory.path)
+            remote_id = self.read_remote_config(connection).get('id')
+        paths = self.expand_paths(paths, source = remote_id)
+
+        expected_digests = {}
+        for p in paths:
+            re = self.repository_state.get(p)
+            if re is not None and not re.wipe:
+                expected_digests[p] = re.digest
+
+        def transfer(batch):
+            # Connections of the same host are pooled by the protocol, so
+            # this is cheap
+            digests = {}
+            try:
+                with protocols.connect(
+                    location, strategies = self.settings['transfer_strategies']
+                ) as connection:
+                    connection.pull_working_files(
+                        batch, self.working_directory.path, digests, expected_digests,
+                        temporary_directory = temporary_directory
+                    )
+            except protocols.TRANSFER_ERRORS as e:
+                # Still record what has been received so far, the rest
+                # counts as failed
+                logger.warning('Transfer of {} files from {} failed: {}'.format(
+                    len(batch) - len(digests), location, e
+                ))
+            return digests
+
+        # More batches than workers so a few large files do not hold up
+        # the others
+        n = max(1, min(len(paths), jobs * 4))
+        batches = [paths[i::n] for i in range(n)]
+
+        # Digests of the files put in place, computed during the transfer
+        # so the files do not have to be read again for the commit
+        digests = {}
+        start = time.perf_counter()
+        if jobs > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers = jobs) as executor:
+                futures = [executor.submit(transfer, batch) for batch in batches]
+                for future in futures:
+                    # (Re-raises anything transfer() did not handle)
+                    digests.update(future.result())
+        else:
+            for batch in batches:
+                digests.update(transfer(batch))
+
+        received = list(digests.keys())
+        stats = self.working_directory.stat_files(received)
+        statistics = protocols.TransferStatistics(
+            files = len(received),
+            bytes_ = sum(st.st_size for st in stats.values()),
+            seconds = time.perf_counter() - start,
+            failed = len(paths) - len(received),
+        )
+        logger.info('Transferred {}'.format(statistics))
+
+        self.commit(paths = received, digests = digests)
+        return statistics
 
-        self.commit()
+    def expand_paths(self, paths, source = None):
+        """
+        Return the list of files the given paths stand for:
+
+        - A file stands for itself (whether or not it is known).
+        - A directory stands for the files in it that are missing or outdated
+          here.
+        - A glob pattern (containing *, ? or [) stands for the files whose
+          path matches it that are missing or outdated here. Note that * also
+          matches /.
+
+        source:
+            ID of a location to get the files from. If its location state is
+            known, directories and glob patterns only stand for files it has
+            the current version of.
+        """
+        if source not in self.location_states.get_locations():
+            source = None
+
+        index = self.get_path_index()
+        r = {}
+        for path in paths:
+            path = str(path)
+            if index.is_directory(path):
+                candidates = index.iterate_paths(path)
+            elif any(c in path for c in '*?['):
+                candidates = (
+                    p for p in index.iterate_paths()
+                    if fnmatch.fnmatchcase(p.as_posix(), path)
+                )
+            else:
+                r[intern_path(path)] = None
+                continue
+
+            for p in candidates:
+                if self.is_missing_or_outdated(p) \
+                        and (source is None or source in self.get_sources(p)):
+                    r[p] = None
+        return list(r)
+
+    def get_temporary_directory(self):
+        """
+        Return the directory for files on their way into the working
+        directory. It is in the harmony directory, so it is never tracked
+        and (normally) on the same filesystem as the working directory.
+        """
+        r = self.harmony_directory / self.TEMPORARY_SUBDIR
+        r.mkdir(exist_ok = True)
+        return r
+
+    def get_path_index(self):
+        """
+        Return a PathIndex of the repository state, with aggregates for the
+        local location.
+
+        The index is stored in the harmony directory along with the
+        signature (see state_backends) of the state files it was derived
+        from, so it is only built from the complete states when these have
+        been changed by something other than this class (e.g. an older
+        version). Changes are applied to it as the states report them.
+        """
+        self.load_path_index()
+        if self._path_index is None:
+            # With no unsaved changes the index matches the saved states
+            saved = not self._path_index_dirty and not self._path_index_stale
+            self._path_index = PathIndex.from_states(
+                self.repository_state, self.location_states, self.id
+            )
+            self._path_index_dirty.clear()
+            self._path_index_stale = False
+            if saved:
+                self.write_path_index()
+        else:
+            self.apply_path_index_changes()
+        return self._path_index
+
+    def get_path_index_signature(self):
+        r = []
+        backend = get_backend(self.settings['state_backend'])
+        for path in backend.signature_paths(self.harmony_directory, self.id):
+            try:
+                st = serialization.stat(path)
+            except FileNotFoundError:
+                r.append(None)
+            else:
+                r.append([st.st_ino, st.st_size, st.st_mtime_ns])
+        return r
+
+    def load_path_index(self):
+        """
+        Read the stored path index unless there is one in memory already.
+        It is ignored if the states have been changed since it was written
+        (in memory or on disk).
+        """
+        if self._path_index is not None or self._path_index_dirty or self._path_index_stale:
+            return
+        path = self.harmony_directory / self.PATH_INDEX_FILE
+        if not serialization.exists(path):
+            return
+        try:
+            d = serialization.read(path)
+        except ValueError as e:
+            logger.warning('Ignoring unreadable path index {}: {}'.format(path, e))
+            return
+        if d.get('signature') != self.get_path_index_signature():
+            logger.debug('{} path index is outdated'.format(self.short_id))
+            return
+        self._path_index = PathIndex.from_dict(d)
+
+    def apply_path_index_changes(self):
+        if self._path_index_stale:
+            self._path_index = PathIndex.from_states(
+                self.repository_state, self.location_states, self.id
+            )
+        else:
+            for path in self._path_index_dirty:
+                self._path_index.update(
+                    path, self.repository_state, self.location_states, self.id
+                )
+        self._path_index_dirty.clear()
+        self._path_index_stale = False
+
+    def write_path_index(self):
+        d = self._path_index.to_dict()
+        d['signature'] = self.get_path_index_signature()
+        serialization.write(d, self.harmony_directory / self.PATH_INDEX_FILE)
+
+    def save_path_index(self):
+        """
+        Bring the path index up to date and store it, to be called right
+        after the states have been saved.
+        """
+        if self._path_index is None:
+            # Nothing to update, the next get_path_index() builds it from
+            # the saved states
+            self._path_index_dirty.clear()
+            self._path_index_stale = False
+            return
+        self.apply_path_index_changes()
+        self.write_path_index()
+
+    def get_sources(self, path):
+        """
+        Return { location id: size } for all locations that have the current
+        version of $path.
+        """
+        re = self.repository_state.get(path)
+        if re is None or re.wipe:
+            return {}
+        return self.location_states.locations_with_digest(re.digest)
+
+    def get_under_replicated(self, min_locations = 2, directory = None):
+        """
+        Return a list of (path, { location id: size }) for the (not wiped)
+        files whose current version is in fewer than $min_locations
+        locations.
+
+        directory:
+            Only consider files in this directory.
+        """
+        if directory is None:
+            paths = self.repository_state.get_paths()
+        else:
+            paths = self.get_path_index().iterate_paths(directory)
+
+        r = []
+        for path in paths:
+            re = self.repository_state.get(path)
+            if re.wipe:
+                continue
+            sources = self.location_states.locations_with_digest(re.digest)
+            if len(sources) < min_locations:
+                r.append((path, sources))
+        return r
+
+    def is_missing_or_outdated(self, path):
+        """
+        Return True iff the current version of $path (which is not wiped)
+        is not here.
+        """
+        re = self.repository_state.get(path)
+        if re is None or re.wipe:
+            return False
+        le = self.location_states.get_file_state(self.id, path)
+        return not le.exists() or le.digest != re.digest
 
     def add_remote(self, name, location, id_=None):
         self.remotes.add(
@@ -319,10 +753,14 @@ class Repository:
     def get_remotes(self):
         return self.remotes.get_remotes()
 
-    def get_file_stats(self):
+    def get_file_stats(self, directory = None):
         """
         Return a list of FileStatus() objects describing the status
         of all files in the repository.
+
+        directory:
+            Only describe the files in this directory (or this file),
+            relative to the working directory.
         """
 
         class FileStatus:
@@ -335,11 +773,50 @@ class Repository:
                     self.__dict__.items()
                 ) + ')'
 
-        files = self.repository_state.get_paths()
+        if directory is None:
+            files = self.repository_state.get_paths()
+            repository_state = self.repository_state
+            file_states = self.location_states.iterate_file_states(self.id)
+        else:
+            files = tuple(self.get_path_index().iterate_paths(directory))
+            repository_state = RepositoryState(None, files = {
+                str(path): self.repository_state[path] for path in files
+            })
+            file_states = [self.location_states.get_file_state(self.id, path) for path in files]
         logger.debug(f'files in repo: {files}')
 
+        wd_stats = self.working_directory.scan(directory)
+
+        if self.use_columnar:
+            flags = columnar.status(
+                repository_state,
+                file_states,
+                [
+                    wd_stats.get(path) or self.working_directory.stat(path)
+                    for path in files
+                ]
+            )
+        else:
+            flags = None
+
         stats = []
-        for path in files:
+        for i, path in enumerate(files):
+            # Files not reported by scan() might still exist
+            # (eg. as ignored files or symlinks)
+            exists_in_workdir = path in wd_stats or path in self.working_directory
+
+            if flags is not None:
+                f = FileStatus(
+                    path = path,
+                    exists_in_repository = True,
+                    maybe_modified = bool(flags['maybe_modified'][i]),
+                    exists_in_workdir = exists_in_workdir,
+                    exists_in_location_state = bool(flags['exists_in_location_state'][i]),
+                    is_most_recent = bool(flags['is_most_recent'][i]),
+                    )
+                stats.append(f)
+                continue
+
             re = self.repository_state.get(path)
             assert re is not None
             le = self.location_states.get_file_state(self.id, path)
@@ -347,15 +824,14 @@ class Repository:
             f = FileStatus(
                 path = path,
                 exists_in_repository = True,
-                maybe_modified = self.working_directory.file_maybe_modified(le),
-                exists_in_workdir = path in self.working_directory,
+                maybe_modified = self.working_directory.file_maybe_modified(le, wd_stats.get(path)),
+                exists_in_workdir = exists_in_workdir,
                 exists_in_location_state = le.exists(),
                 is_most_recent = not le.exists() or le.digest == re.digest,
                 )
             stats.append(f)
 
-        logger.debug(f'wd files: {self.working_directory.get_filenames()}')
-        wd_only_files = set(self.working_directory.get_filenames()) - set(files)
+        wd_only_files = set(wd_stats.keys()) - set(files)
         logger.debug(f'wd only files: {wd_only_files}')
         for path in wd_only_files:
             f = FileStatus(
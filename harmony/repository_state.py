@@ -1,13 +1,13 @@
 
 import logging
-from copy import deepcopy
 from pathlib import Path
 from collections import ChainMap
 from typing import Iterable
 
-from harmony.serialization import FileSerializable, Serializable
+from harmony.serialization import FileSerializable, Serializable, JournaledSerializable
 from harmony.clock import Clock
 from harmony import serialization
+from harmony.util import intern_path
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +22,29 @@ class RepositoryFileState(Serializable):
     that is, (amongst other things), its digest and clock.  It does
     specifically not contain any information about availability on
     remotes, which is handled by working_directory.FileState.
+
+    Instances are shared between RepositoryState instances (e.g. the local,
+    remote and merged state during a merge) and must not be modified once
+    they have been stored in one, use replace() instead.
     """
 
-    def __init__(self, path = None, digest = None, clock = Clock(), wipe = False):
+    __slots__ = ('path', 'digest', 'clock', 'wipe')
+
+    def __init__(self, path = None, digest = None, clock = None, wipe = False):
         self.digest = digest
-        self.path = Path(path) if path is not None else None
-        self.clock = clock
+        self.path = intern_path(path) if path is not None else None
+        self.clock = clock if clock is not None else Clock()
         self.wipe = wipe
 
+    def replace(self, **kws):
+        """
+        Return a copy with the attributes given as keyword arguments replaced.
+        The clock is shared unless a new one is given.
+        """
+        d = { k: getattr(self, k) for k in self.__slots__ }
+        d.update(kws)
+        return self.__class__(**d)
+
     @classmethod
     def from_dict(class_, d):
         d = ChainMap({ 'clock': Clock(**d['clock']) }, d)
@@ -40,51 +55,116 @@ class RepositoryFileState(Serializable):
         return self.digest != other.digest
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str({ k: getattr(self, k) for k in self.__slots__ })
 
-class RepositoryState(FileSerializable):
+class RepositoryState(JournaledSerializable, FileSerializable):
 
     RELATIVE_PATH = 'repository_state'
 
     def __init__(self, path, files = None):
         super().__init__(path)
         self.files = files if files else {}
+        # Paths changed since the last save
+        self._dirty = set()
+        self._observer = None
+        # get_paths() as of the last change of the set of paths
+        self._paths = None
+
+    def observe(self, callback):
+        """
+        Call $callback(path) for every path whose entry changes from now on.
+        """
+        self._observer = callback
 
     @classmethod
     def from_dict(class_, d):
-        return class_(
-            d['path'],
-            files = {
-                f: RepositoryFileState.from_dict(v)
-                for f, v in d['files'].items()
+        files = {}
+        for f, v in d['files'].items():
+            # Hold on to the interned path until the entry refers to it
+            path = intern_path(f)
+            files[str(path)] = RepositoryFileState.from_dict(v)
+        return class_(d['path'], files = files)
+
+    def take_journal_records(self):
+        r = [
+            {
+                'path': p,
+                'entry': self.files[p].to_dict() if p in self.files else None
             }
-        )
+            for p in self._dirty
+        ]
+        self._dirty = set()
+        return r
+
+    def replay(self, records):
+        self._paths = None
+        for record in records:
+            if record['entry'] is None:
+                self.files.pop(record['path'], None)
+            else:
+                path = intern_path(record['path'])
+                self.files[str(path)] = \
+                    RepositoryFileState.from_dict(record['entry'])
 
     def get_paths(self) -> Iterable[Path]:
-        return tuple(Path(p) for p in self.files.keys())
+        if self._paths is None:
+            self._paths = tuple(map(intern_path, self.files.keys()))
+        return self._paths
 
     def get(self, path : Path, default = None):
         return self.files.get(str(path), default)
 
     def __getitem__(self, path):
-        return deepcopy(self.files.get(str(path), RepositoryFileState(path = path)))
+        """
+        Return the (shared, not to be modified) entry for $path
+        or a new empty one if there is none.
+        """
+        r = self.files.get(str(path))
+        if r is None:
+            r = RepositoryFileState(path = path)
+        return r
 
     def __setitem__(self, path, v):
-        self.files[str(path)] = v
+        path = str(intern_path(path))
+        if path not in self.files:
+            self._paths = None
+        self.files[path] = v
+        if self.journaling:
+            self._dirty.add(path)
+        if self._observer is not None:
+            self._observer(path)
 
     def overwrite(self, other):
-        self.files = deepcopy(other.files)
+        """
+        Take over the entries of $other (which should not be used afterwards).
+        """
+        if self.journaling or self._observer is not None:
+            # Entries are shared, not copied (see merge()), so anything that
+            # is not the very same object has changed
+            changed = set(
+                p for p, e in other.files.items()
+                if self.files.get(p) is not e
+            )
+            changed.update(self.files.keys() - other.files.keys())
+            if self.journaling:
+                self._dirty.update(changed)
+            if self._observer is not None:
+                for p in changed:
+                    self._observer(p)
+        self.files = other.files
+        self._paths = None
 
     def update_file_state(self, new_state, id_, clock_value):
         path = new_state.path
-        entry = deepcopy(self[str(path)])
+        entry = self[str(path)]
 
         if new_state.digest == entry.digest and new_state.wipe == entry.wipe:
             # Nothing changed, really, no need to update anything.
             return
 
-        entry.wipe = new_state.wipe
-        entry.digest = new_state.digest
-        entry.clock.values[id_] = clock_value
-        self[path] = entry
+        self[path] = entry.replace(
+            wipe = new_state.wipe,
+            digest = new_state.digest,
+            clock = entry.clock.with_value(id_, clock_value),
+        )
 
@@ -7,13 +7,185 @@ from harmony import hashers
 from harmony import serialization
 from harmony.serialization import FileSerializable
 
+# Outcomes of matching a rule against all files below a directory
+ALWAYS = 'always'
+NEVER = 'never'
+MAYBE = 'maybe'
+
+
+def compile_elements(patterns):
+    """
+    Compile patterns for a single path element (as understood by fnmatch)
+    into one predicate that holds if any of them matches.
+    Regular expressions are avoided for the very common cases of literal
+    names and '*.suffix'.
+    """
+    magic = '*?['
+    names = set()
+    suffixes = []
+    expressions = []
+    for pattern in patterns:
+        if not any(c in pattern for c in magic):
+            names.add(pattern)
+        elif pattern.startswith('*') and not any(c in pattern[1:] for c in magic):
+            suffixes.append(pattern[1:])
+        else:
+            expressions.append(fnmatch.translate(pattern))
+
+    predicates = []
+    if names:
+        predicates.append(frozenset(names).__contains__)
+    if suffixes:
+        suffixes = tuple(suffixes)
+        predicates.append(lambda s: s.endswith(suffixes))
+    if expressions:
+        predicates.append(re.compile('|'.join(expressions)).match)
+    return any_of(predicates)
+
+def compile_element(pattern):
+    return compile_elements([pattern])
+
+def any_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda s: any(p(s) for p in predicates)
+
+def all_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda s: all(p(s) for p in predicates)
+
+class PathMatcher:
+    """
+    A 'path' pattern compiled into a nondeterministic automaton over path
+    elements: State i means the first i pattern elements have been matched.
+    '**' matches any number of elements, a trailing '**' at least one.
+
+    Matcher states are kept per directory (see Ruleset.directory_state()),
+    from which residual() tells what remains to be checked for the filename.
+    """
+
+    def __init__(self, pattern):
+        if pattern.startswith('/'):
+            pattern = pattern[1:]
+        self.elements = pattern.split(os.path.sep)
+        self.predicates = [
+            None if e == '**' else compile_element(e)
+            for e in self.elements
+        ]
+        n = len(self.elements)
+
+        # Absorbing state after a trailing '**' consumed an element
+        self.ALL = n + 1
+        self.trailing = self.elements[-1] == '**'
+        self.initial = self.closure({0})
+
+    def closure(self, states):
+        # A non-trailing '**' may match zero elements
+        states = set(states)
+        for i in sorted(states):
+            while i < len(self.elements) - 1 and self.elements[i] == '**':
+                i += 1
+                states.add(i)
+        return frozenset(states)
+
+    def enter(self, states, element):
+        n = len(self.elements)
+        r = set()
+        for i in states:
+            if i == self.ALL:
+                r.add(i)
+            elif i >= n:
+                continue
+            elif self.predicates[i] is None:
+                r.add(self.ALL if i == n - 1 else i)
+            elif self.predicates[i](element):
+                r.add(i + 1)
+        return self.closure(r)
+
+    def accepts(self, states):
+        return len(self.elements) in states or self.ALL in states
+
+    def below(self, states):
+        # Files below this directory have at least one more element which a
+        # trailing '**' will happily consume
+        if self.ALL in states or (self.trailing and len(self.elements) - 1 in states):
+            return ALWAYS
+        if all(i >= len(self.elements) for i in states):
+            return NEVER
+        return MAYBE
+
+    def residual(self, states):
+        if self.below(states) == ALWAYS:
+            return True
+        # Only the last pattern element can lead to acceptance when
+        # matching the filename
+        n = len(self.elements)
+        if n - 1 in states and self.predicates[n - 1] is not None:
+            return self.predicates[n - 1]
+        return False
+
+class DirnameMatcher:
+    """
+    Compiled 'dirname' pattern, the state is whether any directory element
+    so far matched.
+    """
+
+    initial = False
+
+    def __init__(self, pattern):
+        self.predicate = compile_element(pattern)
+
+    def enter(self, state, element):
+        return state or bool(self.predicate(element))
+
+    def below(self, state):
+        return ALWAYS if state else MAYBE
+
+    def residual(self, state):
+        return state
+
+class FilenameMatcher:
+    """
+    Compiled 'filename' pattern (or list of patterns),
+    independent of the directory.
+    """
+
+    initial = None
+
+    def __init__(self, patterns):
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        self.predicate = compile_elements(patterns)
+
+    def enter(self, state, element):
+        return None
+
+    def below(self, state):
+        return MAYBE
+
+    def residual(self, state):
+        return self.predicate
+
 class Ruleset(FileSerializable):
 
     RELATIVE_PATH = 'rules'
+    # Rules are meant to be edited by hand
+    FORMAT = 'yaml'
     _state = (
         'rules',
     )
 
+    # Compiled matcher class for each key in a rule's 'match' dict
+    MATCHERS = {
+        'path': PathMatcher,
+        'dirname': DirnameMatcher,
+        'filename': FilenameMatcher,
+    }
+
+    # Memoized directory states are dropped when there are more than this
+    MAX_CACHED_DIRECTORIES = 100000
+
     class FileInfo:
         pass
 
@@ -56,58 +228,23 @@ class Ruleset(FileSerializable):
 
     @staticmethod
     def match_path(path, pattern):
+        m = PathMatcher(pattern)
+        states = m.initial
+        for e in path.split(os.path.sep):
+            states = m.enter(states, e)
+        return m.accepts(states)
 
-        anchored = pattern.startswith('/')
-        if anchored:
-            pattern = pattern[1:]
-
-        path_elements = path.split(os.path.sep)
-        pattern_elements = pattern.split(os.path.sep)
-
-        def match_recursive(i_pattern, i_path):
-            if i_pattern >= len(pattern_elements):
-                return i_path >= len(path_elements)
-            e_pattern = pattern_elements[i_pattern]
-
-            if i_path >= len(path_elements):
-                return e_pattern != '**'
-
-            e_path = path_elements[i_path]
-
-            if e_pattern == '**':
-                # If the pattern ended with **, everything that comes,
-                # matches, so we are done
-                if i_pattern == len(pattern_elements) - 1:
-                    return True
-
-                # No try all possible chains of subdirectories for '**'
-                i = i_path
-                while i < len(path_elements):
-                    if match_recursive(i_pattern + 1, i):
-                        return True
-                    i += 1
-                return False
-
-            else:
-                match = fnmatch.fnmatch(e_path, e_pattern)
-                if not match:
-                    return False
-                return match_recursive(i_pattern + 1, i_path + 1)
-
-        return match_recursive(0, 0)
-        
-
-        # TODO: this should more behave like rsyncs matching
-
-        #pattern = pattern.replace('.', '\\.')
-        #pattern = pattern.replace('?', '.')
-
-        #pattern, _ = re.subn(r'(?<!\*)\*(?!\*)', '[^/]*', pattern)
-        #pattern, _ = re.subn(r'\*\*', '.*', pattern)
-        #pattern += '$'
-
-        #m = re.match(pattern, path)
-        #return m is not None
+    @staticmethod
+    def match_path_below(path, pattern):
+        """
+        Decide whether the path pattern matches all (ALWAYS), none (NEVER)
+        or possibly some (MAYBE) of the files below the directory $path.
+        """
+        m = PathMatcher(pattern)
+        states = m.initial
+        for e in path.split(os.path.sep):
+            states = m.enter(states, e)
+        return m.below(states)
 
     @staticmethod
     def match_directory(path, pattern):
@@ -132,54 +269,224 @@ class Ruleset(FileSerializable):
     def __init__(self, path, rules = None):
         super().__init__(path)
         self.rules = rules if rules else []
-        self.matchers = {
-                'path': Ruleset.match_path,
-                'dirname': Ruleset.match_directory,
-                'filename': Ruleset.match_filename,
-                }
-
-    def iterate_committable_files(self, working_directory):
-        for file_info in self.iterate_files(working_directory):
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drop compiled rules and memoized results,
+        needs to be called whenever self.rules is modified.
+        """
+        self._compiled = None
+        self._directory_states = {}
+        self._results = {}
+
+    def compile(self):
+        if self._compiled is None:
+            self._compiled = [
+                [
+                    self.MATCHERS[matcher](parameters)
+                    for matcher, parameters in rule['match'].items()
+                ]
+                for rule in self.rules
+            ]
+        return self._compiled
+
+    def directory_state(self, reldir):
+        """
+        Return the states of all compiled matchers of all rules
+        after matching the directory $reldir, memoized per directory.
+        """
+        return self.directory_info(reldir)[0]
+
+    def directory_info(self, reldir):
+        """
+        Return a pair (states, plan) for the directory $reldir, memoized per
+        directory.
+
+        states:
+            A tuple with a tuple of matcher states for each rule.
+        plan:
+            A tuple of (rule index, check, stop) for the rules that might
+            match files directly in $reldir, check is either True (the rule
+            matches all of them) or a predicate on the filename.
+        """
+        r = self._directory_states.get(reldir)
+        if r is not None:
+            return r
+
+        compiled = self.compile()
+        if reldir == '':
+            states = tuple(
+                tuple(m.initial for m in matchers)
+                for matchers in compiled
+            )
+        else:
+            parent, _, name = reldir.rpartition(os.path.sep)
+            parent_states = self.directory_state(parent)
+            states = tuple(
+                tuple(m.enter(s, name) for m, s in zip(matchers, rule_states))
+                for matchers, rule_states in zip(compiled, parent_states)
+            )
+
+        plan = []
+        for i, (matchers, rule_states) in enumerate(zip(compiled, states)):
+            checks = []
+            for m, s in zip(matchers, rule_states):
+                residual = m.residual(s)
+                if residual is False:
+                    break
+                if residual is not True:
+                    checks.append(residual)
+            else:
+                plan.append((
+                    i,
+                    all_of(checks) if checks else True,
+                    self.rules[i]['action'] != 'continue'
+                ))
+
+        r = (states, tuple(plan))
+        if len(self._directory_states) >= self.MAX_CACHED_DIRECTORIES:
+            self._directory_states.clear()
+        self._directory_states[reldir] = r
+        return r
+
+    def iterate_committable_files(self, working_directory, subdirectory = None):
+        for file_info in self.iterate_files(working_directory, prune = True,
+                                            subdirectory = subdirectory):
             if file_info.rule['commit']:
                 yield file_info
 
-    def iterate_files(self, working_directory):
-        # TODO: do this with pathlib
+    def iterate_files(self, working_directory, prune = False, subdirectory = None):
+        """
+        Walk working_directory (not following symlinked directories) and
+        yield a FileInfo for every file in it.
+        FileInfo.dir_entry is the os.DirEntry of the file so callers can get
+        its stat() without additional system calls in most cases.
+
+        prune:
+            If True, do not descend into directories for which
+            directory_excluded() holds (and thus not report the
+            non-committable files in there).
+
+        subdirectory:
+            Walk only this directory (relative to working_directory) but
+            still report paths relative to working_directory.
+        """
         working_directory = str(working_directory)
 
-        for root, dirs, files in os.walk(working_directory):
-            for filename in files:
-                absfn = os.path.join(root, filename)
-                relfn = os.path.relpath(absfn, working_directory)
-                rule = self.get_rule(relfn)
+        # Stack of (absolute directory, relative directory) to visit,
+        # relative paths are built up along the way instead of computing
+        # them for every file.
+        if subdirectory is not None:
+            subdirectory = os.path.normpath(str(subdirectory))
+        if subdirectory is None or subdirectory == os.path.curdir:
+            stack = [(working_directory, '')]
+        else:
+            absdir = os.path.join(working_directory, subdirectory)
+            if not os.path.isdir(absdir) or os.path.islink(absdir) \
+                    or (prune and self.directory_excluded(subdirectory)):
+                return
+            stack = [(absdir, subdirectory)]
+        while stack:
+            absdir, reldir = stack.pop()
+            with os.scandir(absdir) as it:
+                for entry in it:
+                    relfn = os.path.join(reldir, entry.name) if reldir else entry.name
+
+                    # Same classification as os.walk(): Symlinks to
+                    # directories are not followed but also not reported
+                    # as files.
+                    if entry.is_dir():
+                        if not entry.is_symlink() \
+                                and not (prune and self.directory_excluded(relfn)):
+                            stack.append((entry.path, relfn))
+                        continue
+
+                    file_info = Ruleset.FileInfo()
+                    file_info.absolute_filename = entry.path
+                    file_info.relative_filename = relfn
+                    file_info.dir_entry = entry
+                    file_info.rule = self.get_rule(relfn)
+
+                    yield file_info
 
-                file_info = Ruleset.FileInfo()
-                file_info.absolute_filename = absfn
-                file_info.relative_filename = relfn
-                file_info.rule = rule
+    def get_rule(self, relfn):
+        """
+        Return the combined rule for the file $relfn.
+        The returned dict is shared between files with the same outcome and
+        must not be modified.
+        """
+        reldir, _, filename = relfn.rpartition(os.path.sep)
+        _, plan = self.directory_info(reldir)
+
+        applied = []
+        for i, check, stop in plan:
+            if check is not True and not check(filename):
+                continue
+
+            applied.append(i)
+            if stop:
+                break
 
-                yield file_info
+        # Results only depend on which rules were applied
+        applied = tuple(applied)
+        result = self._results.get(applied)
+        if result is None:
+            result = {
+                    'commit': True
+                    }
+            for i in applied:
+                result.update(self.rules[i])
+            self._results[applied] = result
+        return result
 
-    def get_rule(self, relfn):
-        result = {
-                'commit': True
-                }
-        for rule in self.rules:
-            matches = True
-            for matcher, parameters in rule['match'].items():
-                if not self.matchers[matcher](relfn, parameters):
-                    matches = False
+
+    def directory_excluded(self, reldir):
+        """
+        Return True if the rules make sure no file below the directory
+        $reldir (relative to the working directory) is committable, so there
+        is no need to walk it at all.
+        """
+        matches = []
+        for matchers, states in zip(self.compile(), self.directory_state(reldir)):
+            m = ALWAYS
+            for matcher, state in zip(matchers, states):
+                r = matcher.below(state)
+                if r == NEVER:
+                    m = NEVER
                     break
+                if r == MAYBE:
+                    m = MAYBE
+            matches.append(m)
+
+        # Follow the evaluation of get_rule() for all files below $reldir at
+        # once, that is for rules that match only some of them consider both
+        # outcomes. The directory is excluded iff none of the possible
+        # evaluations ends with commit=True.
+        seen = set()
+        todo = [(0, True)]
+        while todo:
+            i, commit = todo.pop()
+            if (i, commit) in seen:
+                continue
+            seen.add((i, commit))
+
+            if i >= len(self.rules):
+                if commit:
+                    return False
+                continue
 
-            if matches:
-                result.update(rule)
-                if rule['action'] == 'continue':
-                    continue
-                break
-        return result
+            rule = self.rules[i]
+            if matches[i] != ALWAYS:
+                todo.append((i + 1, commit))
+            if matches[i] != NEVER:
+                next_i = i + 1 if rule['action'] == 'continue' else len(self.rules)
+                todo.append((next_i, rule.get('commit', commit)))
 
+        return True
 
     def add_rule(self, **kws):
         self.rules.append(kws)
+        self.invalidate()
 
 
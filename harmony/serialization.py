@@ -1,31 +1,462 @@
-
+"""
+Reading and writing of state files.
+
+Several on-disk formats are supported, see FORMATS. Files in the 'json'
+format start with a header line that names the format and its version,
+followed by the whole document as a single line of JSON. Files without
+such a header are read as YAML, which is how all state files were written
+before the header was introduced. They are rewritten in the current format
+on the next save.
+
+write() replaces files atomically (temporary file, fsync, rename), so an
+interrupted write leaves either the old or the new version. Within
+group_commit() the fsyncs and renames of all writes are done together
+when the group ends.
+"""
+
+import json
+import hashlib
 import logging
+import os
+import errno
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 import yaml
 from pathlib import Path, PosixPath
 
+# Use the libyaml based implementations when PyYAML was built with them
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+HEADER_KEY = 'harmony_format'
+
+class SerializationException(Exception):
+    pass
+
+class YamlFormat:
+    """
+    Headerless YAML, human readable and editable.
+    """
+    name = 'yaml'
+    version = None
+
+    def loads(self, s):
+        return yaml.load(s, Loader = YamlLoader)
+
+    def dumps(self, d):
+        return yaml.dump(d, Dumper = YamlDumper)
+
+class JsonFormat:
+    """
+    A JSON header line followed by the document as one line of
+    compact JSON.
+    """
+    name = 'json'
+    version = 1
+
+    def header(self):
+        return json.dumps({ HEADER_KEY: self.name, 'version': self.version })
+
+    def loads(self, s):
+        _, _, body = s.partition('\n')
+        return json.loads(body)
+
+    def dumps(self, d):
+        return '{}\n{}\n'.format(
+            self.header(),
+            # Sorted keys make the output deterministic, see fingerprint()
+            json.dumps(d, ensure_ascii = False, separators = (',', ':'), sort_keys = True)
+        )
+
+FORMATS = {
+    f.name: f
+    for f in (YamlFormat(), JsonFormat())
+}
+
+# Format used for state files unless a class or caller asks for another one
+DEFAULT_FORMAT = 'json'
+
+def get_format(name = None):
+    try:
+        return FORMATS[name or DEFAULT_FORMAT]
+    except KeyError:
+        raise SerializationException('Unknown serialization format: {}'.format(name))
+
+def detect_format(s):
+    """
+    Return the format the serialized document $s is written in.
+    """
+    if not s.startswith('{"' + HEADER_KEY + '"'):
+        return FORMATS['yaml']
+
+    header, _, _ = s.partition('\n')
+    try:
+        header = json.loads(header)
+        format_ = FORMATS[header[HEADER_KEY]]
+    except (ValueError, KeyError):
+        raise SerializationException('Invalid format header: {}'.format(header))
+
+    if header.get('version') != format_.version:
+        raise SerializationException(
+            'Unsupported version {} of format {} (supported: {})'.format(
+                header.get('version'), format_.name, format_.version
+            )
+        )
+    return format_
+
+def loads(s):
+    return detect_format(s).loads(s)
+
+def dumps(d, format_ = None):
+    return get_format(format_).dumps(d)
+
+class WriteStatistics:
+    """
+    Counts the writes done through this module (by write() and
+    Journal.append()).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.files = 0
+        self.bytes_ = 0
+        self.skipped = 0
+        self.fsyncs = 0
+
+    def add(self, bytes_):
+        self.files += 1
+        self.bytes_ += bytes_
+
+    def __str__(self):
+        return '{} bytes written in {} writes ({} fsyncs), {} unchanged files skipped'.format(
+            self.bytes_, self.files, self.fsyncs, self.skipped
+        )
+
+statistics = WriteStatistics()
+
+def fingerprint(s):
+    """
+    Return a short value identifying the serialized document $s.
+    """
+    return hashlib.sha1(s.encode('utf-8')).digest()
+
+def fsync(path):
+    """
+    fsync() the file or directory at $path.
+    """
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    statistics.fsyncs += 1
+
+def temporary_path(filename):
+    """
+    Return the path write() writes $filename's new contents to before
+    renaming it. It is hidden so DirectorySerializable.load() ignores it.
+    """
+    filename = Path(filename)
+    return filename.parent / '.{}.tmp'.format(filename.name)
+
+class WriteGroup:
+    """
+    Writes that have been done within group_commit() but are not yet in
+    place: Files written to their temporary_path(), journals appended to
+    and journals cleared.
+    """
+
+    def __init__(self):
+        # { target path: temporary path }, in the order written
+        self.renames = {}
+        self.appended = set()
+        self.removals = set()
+
+    def current_path(self, path):
+        """
+        Return where the current contents of $path are.
+        """
+        return self.renames.get(Path(path), path)
+
+    def commit(self):
+        # Everything needs to be on disk before any of the renames so
+        # that no file is replaced by a (partially) unwritten one
+        for path in list(self.renames.values()) + sorted(self.appended):
+            fsync(path)
+
+        directories = set()
+        for target, temporary in self.renames.items():
+            os.replace(str(temporary), str(target))
+            directories.add(target.parent)
+        for directory in directories:
+            fsync(directory)
+
+        # Journals go only after the files they were compacted into
+        directories = set()
+        for path in self.removals:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            directories.add(path.parent)
+        for directory in directories:
+            fsync(directory)
+
+        self.renames = {}
+        self.appended = set()
+        self.removals = set()
+
+_group = None
+
+@contextmanager
+def group_commit():
+    """
+    Context manager that defers the fsyncs and renames of all write()s
+    and journal operations until it is left, then does each fsync once.
+    Reads within the group see the written contents.
+    Nested group_commit()s join the outermost one.
+    """
+    global _group
+    if _group is not None:
+        yield _group
+        return
+
+    _group = WriteGroup()
+    try:
+        yield _group
+    finally:
+        # Also on errors: Every single write is consistent in itself, as if
+        # it had been done outside of a group
+        group, _group = _group, None
+        group.commit()
+
+def current_path(path):
+    """
+    Return the file that holds the current contents of $path,
+    which differs from $path for writes pending in a group_commit().
+    """
+    if _group is None:
+        return path
+    return _group.current_path(path)
+
+def exists(path):
+    """
+    Like Path.exists(), taking pending writes and removals into account.
+    """
+    if _group is not None and Path(path) in _group.removals:
+        return False
+    return Path(current_path(path)).exists()
+
+def stat(path):
+    """
+    Like os.stat(), taking pending writes and removals into account. As
+    rename does not change any of the stat values, the result also holds
+    for $path once the writes are in place.
+    """
+    if _group is not None and Path(path) in _group.removals:
+        raise FileNotFoundError(errno.ENOENT, 'File is about to be removed', str(path))
+    return os.stat(str(current_path(path)))
+
 def read(filename):
-    filename = str(filename)
-    r = None
-    with open(filename, 'r') as f:
+    filename = str(current_path(filename))
+    with open(filename, 'r', encoding = 'utf-8') as f:
         s = f.read()
-        r = yaml.safe_load(s)
-    return r
-
-def write(d, filename):
-    filename = str(filename)
-    with open(filename, 'w') as f:
-        logger.debug('  (-> {}): {}'.format(filename, d))
-        yaml.safe_dump(d, f)
+    return loads(s)
+
+def read_fingerprinted(filename):
+    """
+    Like read(), return a pair of the document and the fingerprint() of
+    the file contents.
+    """
+    filename = str(current_path(filename))
+    with open(filename, 'r', encoding = 'utf-8') as f:
+        s = f.read()
+    return loads(s), fingerprint(s)
+
+def write(d, filename, format_ = None, fingerprint_ = None):
+    """
+    Write $d to $filename.
+
+    fingerprint_:
+        Fingerprint of the current contents of $filename (as returned by
+        read_fingerprinted() or a previous write()). If $d serializes to
+        the same contents, nothing is written.
+
+    return:
+        The fingerprint of the new contents.
+    """
+    s = dumps(d, format_)
+    f = fingerprint(s)
+    if f == fingerprint_:
+        logger.debug('  (-> {}): unchanged'.format(filename))
+        statistics.skipped += 1
+        return f
+
+    write_serialized(s, filename)
+    return f
+
+def write_serialized(s, filename):
+    """
+    Write the serialized document $s (see dumps()) to $filename.
+    """
+    logger.debug('  (-> {})'.format(filename))
+    b = s.encode('utf-8')
+    target = Path(filename)
+    temporary = temporary_path(target)
+    with open(str(temporary), 'wb') as fd:
+        fd.write(b)
+        if _group is None:
+            fd.flush()
+            os.fsync(fd.fileno())
+            statistics.fsyncs += 1
+    statistics.add(len(b))
+
+    if _group is None:
+        os.replace(str(temporary), str(target))
+        fsync(target.parent)
+    else:
+        _group.removals.discard(target)
+        _group.renames[target] = temporary
+
+def remove(path):
+    """
+    Remove the file at $path if there is one. Within group_commit() that
+    happens once all pending writes are in place.
+    """
+    path = Path(path)
+    if _group is None:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        return
+
+    _group.appended.discard(path)
+    temporary = _group.renames.pop(path, None)
+    if temporary is not None:
+        temporary.unlink()
+    _group.removals.add(path)
 
 def dump(d):
     return yaml.safe_dump(d)
 
+class Journal:
+    """
+    Append-only log of changes to a serialized component, stored next to
+    the component's file (or directory) with SUFFIX appended to the
+    name, one JSON object per line.
+    """
+
+    SUFFIX = '.journal'
+
+    @classmethod
+    def path_for(class_, path):
+        return Path(str(path) + class_.SUFFIX)
+
+    def __init__(self, path, read_only = False):
+        """
+        read_only:
+            The journal belongs to another repository (or is on read only
+            media), it is never written to.
+        """
+        self.path = Path(path)
+        self.read_only = read_only
+        # Number of records in the file, as far as known by read()/append()
+        self.length = 0
+        # Size of the complete records in the file if read() found an
+        # incomplete one after them, append() cuts it off
+        self._valid_size = None
+
+    def read(self):
+        """
+        Return the list of records in the journal (empty if there is none).
+        An incomplete last line (left by an interrupted append) is
+        skipped, it is only removed from the file by the next append().
+        """
+        records = []
+        self._valid_size = None
+        if _group is not None and self.path in _group.removals:
+            self.length = 0
+            return records
+
+        try:
+            f = open(str(self.path), 'rb')
+        except FileNotFoundError:
+            self.length = 0
+            return records
+
+        with f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete line')
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    logger.warning('{}: skipping incomplete record at offset {}'.format(
+                        self.path, offset
+                    ))
+                    self._valid_size = offset
+                    break
+                offset += len(line)
+
+        self.length = len(records)
+        return records
+
+    def check_writable(self):
+        if self.read_only:
+            raise PermissionError('{} is read only'.format(self.path))
+
+    def append(self, records):
+        b = ''.join(
+            json.dumps(r, ensure_ascii = False, separators = (',', ':')) + '\n'
+            for r in records
+        ).encode('utf-8')
+        self.check_writable()
+        if self._valid_size is not None:
+            logger.warning('{}: removing incomplete record'.format(self.path))
+            with open(str(self.path), 'r+b') as f:
+                f.truncate(self._valid_size)
+            self._valid_size = None
+
+        if _group is not None:
+            # Replaying the records from before a (not yet done) clear()
+            # is harmless, see JournaledSerializable
+            _group.removals.discard(self.path)
+            _group.appended.add(self.path)
+
+        with open(str(self.path), 'ab') as f:
+            f.write(b)
+            if _group is None:
+                f.flush()
+                os.fsync(f.fileno())
+                statistics.fsyncs += 1
+        statistics.add(len(b))
+        self.length += len(records)
+
+    def clear(self):
+        self.check_writable()
+        self.length = 0
+        self._valid_size = None
+        remove(self.path)
+
 
 class Serializable(object):
 
+    # Subclasses for which there are many instances (eg. file states) use
+    # __slots__, which requires all base classes to have them
+    __slots__ = ()
+
+    # Name of the serialization format to save in, None for DEFAULT_FORMAT
+    FORMAT = None
+
     @classmethod
     def get_path(class_, harmony_directory):
         return Path(harmony_directory) / class_.RELATIVE_PATH
@@ -68,10 +499,10 @@ class Serializable(object):
     def to_dict(self, skip = ()):
         if hasattr(self, '_state'):
             keys = set(self._state)
-        elif hasattr(self, '__slots__'):
-            keys = set(k for k in self.__slots__ if not k.startswith('_'))
-        else:
+        elif hasattr(self, '__dict__'):
             keys = set(k for k in self.__dict__.keys() if not k.startswith('_'))
+        else:
+            keys = set(k for k in self.__slots__ if not k.startswith('_'))
 
         keys = keys - set(skip)
 
@@ -84,8 +515,60 @@ class Serializable(object):
         self.path = Path(path) if path is not None else None
 
 
+class LazyItems(MutableMapping):
+    """
+    Mapping whose values are produced by calling $load(key) when they are
+    first accessed.
+    """
+
+    _NOT_LOADED = object()
+
+    def __init__(self, keys, load):
+        self.load = load
+        self._items = dict.fromkeys(keys, self._NOT_LOADED)
+
+    def __getitem__(self, key):
+        v = self._items[key]
+        if v is self._NOT_LOADED:
+            v = self.load(key)
+            self._items[key] = v
+        return v
+
+    def __setitem__(self, key, v):
+        self._items[key] = v
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def is_loaded(self, key):
+        return self._items.get(key, self._NOT_LOADED) is not self._NOT_LOADED
+
+    def loaded_items(self):
+        return [(k, v) for k, v in self._items.items() if v is not self._NOT_LOADED]
+
+def loaded_items(items):
+    """
+    Return the (key, value) pairs of $items (a dict or LazyItems)
+    that are in memory.
+    """
+    if isinstance(items, LazyItems):
+        return items.loaded_items()
+    return items.items()
+
 class DirectorySerializable(Serializable):
 
+    # If True, load() reads the file of an item only when it is accessed
+    LAZY = False
+
     @classmethod
     def init(class_, path):
         path = Path(path)
@@ -95,24 +578,34 @@ class DirectorySerializable(Serializable):
     @classmethod
     def load(class_, path):
         path = Path(path)
-        items = {
-            filename.name: read(filename)
-            for filename in path.iterdir() if not str(filename).startswith('.')
-            }
+        # Hidden files are not items (but eg. metadata about them)
+        names = [
+            filename.name for filename in path.iterdir()
+            if not filename.name.startswith('.')
+        ]
+        if class_.LAZY:
+            items = LazyItems(names, lambda name: class_.load_item(path, name))
+        else:
+            items = { name: read(path / name) for name in names }
         return class_.from_dict({
             'path': path,
             'items': items,
             })
 
+    @classmethod
+    def load_item(class_, path, name):
+        return class_.item_from_dict(read(Path(path) / name))
+
     @classmethod
     def from_dict(class_, d):
-        items = { k: class_.item_from_dict(v) for k, v in d['items'].items() }
-        d['items'] = items
+        if not isinstance(d['items'], LazyItems):
+            d['items'] = { k: class_.item_from_dict(v) for k, v in d['items'].items() }
         return super().from_dict(d)
 
     def to_dict(self):
+        # Items that have not been loaded cannot have changed
         d = super().to_dict(skip = ('items',))
-        d['items'] = { k: self.item_to_dict(v) for k, v in self.items.items() }
+        d['items'] = { k: self.item_to_dict(v) for k, v in loaded_items(self.items) }
         return d
 
     @classmethod
@@ -126,21 +619,32 @@ class DirectorySerializable(Serializable):
        super().__init__(path)
        self.items = items
 
+    def items_to_save(self):
+        """
+        Return the keys of the items save() needs to write.
+        """
+        return [k for k, _ in loaded_items(self.items)]
+
     def save(self):
-        d = self.to_dict()
-        for k, v in d['items'].items():
+        for k in self.items_to_save():
             p = Path(self.path) / k
-            logger.debug('SAVE {} -> {}'.format(v, p))
-            write(v, p)
+            logger.debug('SAVE {}'.format(p))
+            write(self.item_to_dict(self.items[k]), p, self.FORMAT)
 
 class FileSerializable(Serializable):
 
+    # fingerprint() of the file contents as last read or written,
+    # save() does not write anything if they would stay the same
+    _fingerprint = None
+
     @classmethod
     def load(class_, path):
         path = Path(path)
-        d = read(path)
+        d, fingerprint_ = read_fingerprinted(path)
         d['path'] = Path(path)
-        return class_.from_dict(d)
+        r = class_.from_dict(d)
+        r._fingerprint = fingerprint_
+        return r
 
     def __init__(self, path):
         super().__init__(path)
@@ -149,6 +653,72 @@ class FileSerializable(Serializable):
         d = self.to_dict()
         if 'path' in d:
             del d['path']
-        write(d, self.path)
+        self._fingerprint = write(d, self.path, self.FORMAT, self._fingerprint)
 
+class JournaledSerializable:
+    """
+    Mixin for FileSerializable and DirectorySerializable components that
+    save() their changes by appending them to a Journal instead of writing
+    the whole component. The journal is folded into the component's file(s)
+    when it has grown to COMPACT_JOURNAL_RECORDS records.
 
+    Subclasses implement take_journal_records(), which returns records for
+    all changes since the last call, and replay(), which applies records
+    to a freshly loaded instance. Records must set absolute values: Every
+    change is in the journal before the base is rewritten, so a journal may
+    get replayed on top of a base that already contains it.
+    """
+
+    COMPACT_JOURNAL_RECORDS = 10000
+
+    @classmethod
+    def load(class_, path, read_only = False):
+        """
+        read_only:
+            Never write to the journal, eg. when it belongs to a remote
+            repository.
+        """
+        r = super().load(path)
+        r._journal.read_only = read_only
+        r.replay(r._journal.read())
+        r._loaded = True
+        return r
+
+    def __init__(self, *args, **kws):
+        super().__init__(*args, **kws)
+        self._journal = Journal(Journal.path_for(self.path)) if self.path is not None else None
+        # Instances that were not load()ed do not know what is on disk and
+        # are written in full
+        self._loaded = False
+
+    @property
+    def journaling(self):
+        return self._journal is not None
+
+    def take_journal_records(self):
+        raise NotImplementedError()
+
+    def replay(self, records):
+        raise NotImplementedError()
+
+    def save(self):
+        # Changes go to the journal first in any case. So the journal
+        # together with any version of the base file(s) always yields the
+        # current state, should we be interrupted during compaction.
+        records = self.take_journal_records()
+        if records and self._loaded:
+            self._journal.append(records)
+
+        if not self._loaded \
+                or not exists(self.path) \
+                or self._journal.length >= self.COMPACT_JOURNAL_RECORDS:
+            logger.debug('{}: writing in full'.format(self.path))
+            self.write_base()
+            self._journal.clear()
+            self._loaded = True
+
+    def write_base(self):
+        """
+        Write the component's own file(s), as opposed to the journal.
+        """
+        super().save()
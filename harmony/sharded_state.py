@@ -0,0 +1,324 @@
+
+"""
+Repository state split into shards, for repositories with many files.
+
+A path belongs to the shard named by the first few hex digits of the sha1
+of the path. Shards are read when one of their paths is accessed and only
+modified shards are written on save().
+
+The manifest maps each shard to the fingerprint of its serialized
+contents. That fingerprint is also part of the shard's file name, so shard
+files never change once written and the manifest (which is written last)
+always refers to a complete set of them. merge() uses the fingerprints to
+skip shards that are the same on both sides.
+"""
+
+import hashlib
+import logging
+from collections.abc import Mapping
+from pathlib import Path
+
+from harmony import file_state_logic
+from harmony import serialization
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.serialization import LazyItems
+from harmony.util import intern_path
+
+logger = logging.getLogger(__name__)
+
+class ShardedFilesView(Mapping):
+    """
+    Read only mapping { path (str): RepositoryFileState } over all shards
+    of a ShardedRepositoryState. Iterating loads all shards.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __getitem__(self, path):
+        r = self.state.get(path)
+        if r is None:
+            raise KeyError(path)
+        return r
+
+    def __contains__(self, path):
+        return self.state.get(path) is not None
+
+    def __iter__(self):
+        for key in sorted(self.state.shards):
+            yield from self.state.shards[key]
+
+    def __len__(self):
+        return sum(len(self.state.shards[key]) for key in self.state.shards)
+
+    def items(self):
+        for key in sorted(self.state.shards):
+            yield from self.state.shards[key].items()
+
+    def values(self):
+        for _, v in self.items():
+            yield v
+
+class ShardedRepositoryState:
+    """
+    RepositoryState stored as a directory of shards.
+    """
+
+    RELATIVE_PATH = 'repository_shards'
+    MANIFEST = 'manifest'
+    # Shard files are compared by fingerprint, which needs a format with a
+    # deterministic serialization
+    FORMAT = 'json'
+    # Number of hex digits of the path hash that make up the shard key,
+    # 2 gives 256 shards
+    PREFIX_LENGTH = 2
+
+    @classmethod
+    def get_path(class_, harmony_directory):
+        return Path(harmony_directory) / class_.RELATIVE_PATH
+
+    @classmethod
+    def init(class_, path):
+        path = Path(path)
+        path.mkdir()
+        r = class_(path)
+        r.save()
+        return r
+
+    @classmethod
+    def load(class_, path):
+        path = Path(path)
+        manifest, fingerprint_ = serialization.read_fingerprinted(path / class_.MANIFEST)
+        r = class_(
+            path,
+            prefix_length = manifest['prefix_length'],
+            fingerprints = manifest['shards'],
+        )
+        r._manifest_fingerprint = fingerprint_
+        return r
+
+    def __init__(self, path, prefix_length = None, fingerprints = None, shards = None):
+        """
+        fingerprints:
+            { shard key: fingerprint } of the shards as they are on disk.
+        shards:
+            { shard key: { path (str): RepositoryFileState } } (or
+            LazyItems). By default, the shards in $fingerprints are loaded
+            from $path on access.
+        """
+        self.path = Path(path) if path is not None else None
+        self.prefix_length = prefix_length if prefix_length is not None else self.PREFIX_LENGTH
+        self.fingerprints = dict(fingerprints) if fingerprints else {}
+        if shards is None:
+            shards = LazyItems(self.fingerprints.keys(), self._load_shard)
+        self.shards = shards
+        self.files = ShardedFilesView(self)
+        # Keys of shards changed since the last save
+        self._dirty = set()
+        self._manifest_fingerprint = None
+        self._observer = None
+        # get_paths() as of the last change of the set of paths
+        self._paths = None
+
+    def observe(self, callback):
+        """
+        Call $callback(path) for every path whose entry changes from now on.
+        """
+        self._observer = callback
+
+    def _notify(self, old, new):
+        # Report the paths that differ between two versions of a shard
+        if self._observer is None:
+            return
+        for p in old.keys() | new.keys():
+            if old.get(p) is not new.get(p):
+                self._observer(p)
+
+    def shard_key(self, path):
+        return hashlib.sha1(str(path).encode('utf-8')).hexdigest()[:self.prefix_length]
+
+    def shard_path(self, key, fingerprint_):
+        return self.path / '{}-{}'.format(key, fingerprint_)
+
+    def _load_shard(self, key):
+        logger.debug('loading repository state shard {}'.format(key))
+        d = serialization.read(self.shard_path(key, self.fingerprints[key]))
+        r = {}
+        for p, v in d.items():
+            # Hold on to the interned path until the entry refers to it
+            path = intern_path(p)
+            r[str(path)] = RepositoryFileState.from_dict(v)
+        return r
+
+    def fingerprint(self, key):
+        """
+        Return the fingerprint of shard $key as it is in memory,
+        None if that is not known (the shard has been modified).
+        """
+        if key in self._dirty:
+            return None
+        return self.fingerprints.get(key)
+
+    def get_paths(self):
+        if self._paths is None:
+            self._paths = tuple(map(intern_path, self.files))
+        return self._paths
+
+    def get(self, path, default = None):
+        key = self.shard_key(path)
+        if key not in self.shards:
+            return default
+        return self.shards[key].get(str(path), default)
+
+    def __getitem__(self, path):
+        """
+        Return the (shared, not to be modified) entry for $path
+        or a new empty one if there is none.
+        """
+        r = self.get(path)
+        if r is None:
+            r = RepositoryFileState(path = path)
+        return r
+
+    def __setitem__(self, path, v):
+        path = str(intern_path(path))
+        key = self.shard_key(path)
+        if key not in self.shards:
+            self.shards[key] = {}
+        if path not in self.shards[key]:
+            self._paths = None
+        self.shards[key][path] = v
+        self._dirty.add(key)
+        if self._observer is not None:
+            self._observer(path)
+
+    def overwrite(self, other):
+        """
+        Take over the entries of $other (which should not be used afterwards).
+        Shards of another ShardedRepositoryState with the same fingerprint
+        as ours are not even looked at.
+        """
+        self._paths = None
+        if isinstance(other, ShardedRepositoryState) and other.prefix_length == self.prefix_length:
+            shards = other.shards
+            fingerprints = { key: other.fingerprint(key) for key in shards }
+        else:
+            shards = {}
+            for path, entry in other.files.items():
+                shards.setdefault(self.shard_key(path), {})[str(path)] = entry
+            fingerprints = {}
+
+        for key in set(self.shards) - set(shards):
+            self._notify(self.shards[key] if self._observer is not None else {}, {})
+            del self.shards[key]
+            self._dirty.add(key)
+
+        for key in shards:
+            if fingerprints.get(key) is not None and fingerprints[key] == self.fingerprint(key):
+                continue
+            shard = shards[key]
+            # Entries are shared, not copied (see merge()), so this compares
+            # them by identity
+            if key in self.shards and self.shards[key] == shard:
+                continue
+            self._notify(self.shards.get(key, {}), shard)
+            self.shards[key] = dict(shard)
+            self._dirty.add(key)
+
+    def update_file_state(self, new_state, id_, clock_value):
+        path = new_state.path
+        entry = self[str(path)]
+
+        if new_state.digest == entry.digest and new_state.wipe == entry.wipe:
+            # Nothing changed, really, no need to update anything.
+            return
+
+        self[path] = entry.replace(
+            wipe = new_state.wipe,
+            digest = new_state.digest,
+            clock = entry.clock.with_value(id_, clock_value),
+        )
+
+    def save(self):
+        for key in sorted(self._dirty):
+            old = self.fingerprints.pop(key, None)
+            shard = self.shards.get(key)
+            if shard:
+                s = serialization.dumps(
+                    { p: e.to_dict() for p, e in shard.items() },
+                    self.FORMAT
+                )
+                new = serialization.fingerprint(s).hex()
+                if new != old:
+                    serialization.write_serialized(s, self.shard_path(key, new))
+                self.fingerprints[key] = new
+            elif key in self.shards:
+                del self.shards[key]
+
+        self._manifest_fingerprint = serialization.write(
+            {
+                'prefix_length': self.prefix_length,
+                'shards': self.fingerprints,
+            },
+            self.path / self.MANIFEST,
+            self.FORMAT,
+            self._manifest_fingerprint,
+        )
+        self.remove_unreferenced_shards()
+        self._dirty = set()
+
+    def remove_unreferenced_shards(self):
+        """
+        Remove the shard files the manifest does not refer to (anymore).
+        """
+        referenced = set(
+            self.shard_path(key, f).name for key, f in self.fingerprints.items()
+        )
+        for p in self.path.iterdir():
+            if p.name != self.MANIFEST and not p.name.startswith('.') \
+                    and p.name not in referenced:
+                serialization.remove(p)
+
+def can_merge(local_state, remote_state):
+    """
+    Return True iff merge() can be used on the given states.
+    """
+    return isinstance(local_state, ShardedRepositoryState) \
+        and isinstance(remote_state, ShardedRepositoryState) \
+        and local_state.prefix_length == remote_state.prefix_length
+
+def merge(local_state, remote_state, merger_id, merge_shard = file_state_logic.merge):
+    """
+    Equivalent of file_state_logic.merge() for two ShardedRepositoryStates
+    (see can_merge()), with the same parameters and return value.
+    Shards that have the same fingerprint on both sides are taken over
+    from $local_state as they are (without loading them), the others are
+    merged with $merge_shard.
+    """
+    keys = set(local_state.shards) | set(remote_state.shards)
+    same = set(
+        key for key in keys
+        if local_state.fingerprint(key) is not None
+        and local_state.fingerprint(key) == remote_state.fingerprint(key)
+    )
+    logger.debug('merge: {} of {} shards unchanged'.format(len(same), len(keys)))
+
+    merged = ShardedRepositoryState(
+        None,
+        prefix_length = local_state.prefix_length,
+        fingerprints = { key: local_state.fingerprint(key) for key in same },
+        shards = LazyItems(same, lambda key: local_state.shards[key]),
+    )
+    conflicts = {}
+
+    for key in sorted(keys - same):
+        shard_conflicts, shard_merged = merge_shard(
+            RepositoryState(None, files = local_state.shards.get(key)),
+            RepositoryState(None, files = remote_state.shards.get(key)),
+            merger_id
+        )
+        conflicts.update(shard_conflicts)
+        if shard_merged.files:
+            merged.shards[key] = shard_merged.files
+
+    return conflicts, merged
@@ -0,0 +1,446 @@
+
+"""
+Repository and location states kept in a single SQLite database instead of
+one serialized file per component.
+
+Entries are read from the database on demand, so neither component needs
+to be held in memory as a whole, and the database indexes answer
+questions like "which locations have content X" directly.
+SqliteRepositoryState and SqliteLocationStates provide the same interface
+as RepositoryState and LocationStates as far as file_state_logic and
+Repository use it.
+"""
+
+import json
+import logging
+import sqlite3
+from collections.abc import Mapping
+from pathlib import Path
+
+from harmony.clock import Clock
+from harmony.location_states import LocationStates, LocationState
+from harmony.repository_state import RepositoryFileState
+from harmony.util import intern_path
+from harmony.working_directory import FileState
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE repository_files (
+    path TEXT PRIMARY KEY,
+    digest TEXT,
+    clock TEXT NOT NULL,
+    wipe INTEGER NOT NULL
+);
+CREATE INDEX repository_files_digest ON repository_files (digest);
+
+CREATE TABLE locations (
+    location TEXT PRIMARY KEY,
+    clock INTEGER NOT NULL,
+    last_modification TEXT
+);
+
+CREATE TABLE location_files (
+    location TEXT NOT NULL,
+    path TEXT NOT NULL,
+    digest TEXT,
+    size INTEGER,
+    mtime REAL,
+    wipe INTEGER NOT NULL,
+    PRIMARY KEY (location, path)
+);
+CREATE INDEX location_files_path ON location_files (path);
+CREATE INDEX location_files_digest ON location_files (digest);
+'''
+
+class StateDatabase:
+    """
+    Connection to the state database shared by SqliteRepositoryState and
+    SqliteLocationStates, so their changes end up in the same transaction.
+    """
+
+    RELATIVE_PATH = 'state.sqlite'
+
+    @classmethod
+    def get_path(class_, harmony_directory):
+        return Path(harmony_directory) / class_.RELATIVE_PATH
+
+    @classmethod
+    def init(class_, path):
+        path = Path(path)
+        r = class_(sqlite3.connect(str(path)), path)
+        r.connection.executescript(SCHEMA)
+        r.commit()
+        return r
+
+    @classmethod
+    def load(class_, path, read_only = False):
+        """
+        read_only:
+            Open the database in read only mode, eg. when it belongs to a
+            remote repository.
+        """
+        path = Path(path)
+        if not path.exists():
+            raise FileNotFoundError('No state database at {}'.format(path))
+        if read_only:
+            connection = sqlite3.connect('{}?mode=ro'.format(path.as_uri()), uri = True)
+        else:
+            connection = sqlite3.connect(str(path))
+        return class_(connection, path)
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def executemany(self, *args):
+        return self.connection.executemany(*args)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+class RepositoryFilesView(Mapping):
+    """
+    Read only mapping { path (str): RepositoryFileState }
+    over the repository_files table.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, path):
+        row = self.db.execute(
+            'SELECT path, digest, clock, wipe FROM repository_files WHERE path = ?',
+            (str(path), )
+        ).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return SqliteRepositoryState.entry_from_row(row)
+
+    def __contains__(self, path):
+        return self.db.execute(
+            'SELECT 1 FROM repository_files WHERE path = ?', (str(path), )
+        ).fetchone() is not None
+
+    def __iter__(self):
+        for (path, ) in self.db.execute('SELECT path FROM repository_files ORDER BY path'):
+            yield path
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM repository_files').fetchone()[0]
+
+    def items(self):
+        for row in self.db.execute(
+                'SELECT path, digest, clock, wipe FROM repository_files ORDER BY path'):
+            yield row[0], SqliteRepositoryState.entry_from_row(row)
+
+    def values(self):
+        for _, v in self.items():
+            yield v
+
+class SqliteRepositoryState:
+    """
+    RepositoryState stored in a StateDatabase.
+    """
+
+    @staticmethod
+    def entry_from_row(row):
+        path, digest, clock, wipe = row
+        return RepositoryFileState(
+            path = path,
+            digest = digest,
+            clock = Clock(**json.loads(clock)),
+            wipe = bool(wipe),
+        )
+
+    @staticmethod
+    def entry_to_row(path, v):
+        # Sorted keys so equal clocks compare equal in SQL, see overwrite()
+        return (str(path), v.digest, json.dumps(v.clock.values, sort_keys = True), int(v.wipe))
+
+    def __init__(self, db):
+        self.db = db
+        self.files = RepositoryFilesView(db)
+        self._observer = None
+
+    def observe(self, callback):
+        """
+        Call $callback(path) for every path whose entry changes from now on.
+        """
+        self._observer = callback
+
+    def get_paths(self):
+        return tuple(map(intern_path, self.files))
+
+    def get(self, path, default = None):
+        try:
+            return self.files[path]
+        except KeyError:
+            return default
+
+    def __getitem__(self, path):
+        r = self.get(path)
+        if r is None:
+            r = RepositoryFileState(path = path)
+        return r
+
+    def __setitem__(self, path, v):
+        self.db.execute(
+            'INSERT OR REPLACE INTO repository_files (path, digest, clock, wipe) VALUES (?, ?, ?, ?)',
+            self.entry_to_row(path, v)
+        )
+        if self._observer is not None:
+            self._observer(str(path))
+
+    def __delitem__(self, path):
+        self.db.execute('DELETE FROM repository_files WHERE path = ?', (str(path), ))
+        if self._observer is not None:
+            self._observer(str(path))
+
+    def overwrite(self, other):
+        """
+        Replace the contents with the entries of $other,
+        writing only those that differ.
+
+        The entries of $other go to a temporary table first, so finding
+        the differences is a join rather than a query per path.
+        """
+        db = self.db
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS new_files '
+                   '(path TEXT PRIMARY KEY, digest TEXT, clock TEXT NOT NULL, wipe INTEGER NOT NULL)')
+        db.execute('DELETE FROM new_files')
+        db.executemany(
+            'INSERT INTO new_files (path, digest, clock, wipe) VALUES (?, ?, ?, ?)',
+            (self.entry_to_row(p, e) for p, e in other.files.items())
+        )
+
+        changed = '''
+            SELECT n.path FROM new_files n
+            LEFT JOIN repository_files r ON r.path = n.path
+            WHERE r.path IS NULL OR r.digest IS NOT n.digest
+                OR r.clock != n.clock OR r.wipe != n.wipe
+        '''
+        removed = 'SELECT path FROM repository_files WHERE path NOT IN (SELECT path FROM new_files)'
+        notify = []
+        if self._observer is not None:
+            notify = [p for (p, ) in db.execute(changed)] + [p for (p, ) in db.execute(removed)]
+
+        db.execute('INSERT OR REPLACE INTO repository_files (path, digest, clock, wipe) '
+                   'SELECT path, digest, clock, wipe FROM new_files WHERE path IN ({})'.format(changed))
+        db.execute('DELETE FROM repository_files WHERE path IN ({})'.format(removed))
+        db.execute('DELETE FROM new_files')
+
+        for path in notify:
+            self._observer(path)
+
+    def update_file_state(self, new_state, id_, clock_value):
+        path = new_state.path
+        entry = self[str(path)]
+
+        if new_state.digest == entry.digest and new_state.wipe == entry.wipe:
+            # Nothing changed, really, no need to update anything.
+            return
+
+        self[path] = entry.replace(
+            wipe = new_state.wipe,
+            digest = new_state.digest,
+            clock = entry.clock.with_value(id_, clock_value),
+        )
+
+    def save(self):
+        self.db.commit()
+
+class LocationItemsView(Mapping):
+    """
+    Read only mapping { location id: LocationState } over the locations and
+    location_files tables. LocationStates are constructed on access
+    (including all their file states).
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, id_):
+        row = self.db.execute(
+            'SELECT clock, last_modification FROM locations WHERE location = ?', (id_, )
+        ).fetchone()
+        if row is None:
+            raise KeyError(id_)
+        clock, last_modification = row
+        return LocationState(
+            files = {
+                f.path: f
+                for f in SqliteLocationStates.iterate_file_states_in(self.db, id_)
+            },
+            clock = clock,
+            last_modification = last_modification,
+            location = id_,
+        )
+
+    def __iter__(self):
+        for (id_, ) in self.db.execute('SELECT location FROM locations ORDER BY location'):
+            yield id_
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM locations').fetchone()[0]
+
+class SqliteLocationStates:
+    """
+    LocationStates stored in a StateDatabase.
+    """
+
+    now = staticmethod(LocationStates.now)
+
+    @staticmethod
+    def iterate_file_states_in(db, id_):
+        for path, digest, size, mtime, wipe in db.execute(
+                'SELECT path, digest, size, mtime, wipe FROM location_files WHERE location = ?',
+                (id_, )):
+            yield FileState(path = path, digest = digest, size = size, mtime = mtime, wipe = bool(wipe))
+
+    def __init__(self, db):
+        self.db = db
+        self.items = LocationItemsView(db)
+        # Locations with file state changes since the last save
+        self._modified = set()
+        self._observer = None
+
+    def observe(self, callback):
+        """
+        Call $callback(id_, path) for every file state that changes from
+        now on, path is None if the whole location was replaced.
+        """
+        self._observer = callback
+
+    def get_clock(self, id_):
+        row = self.db.execute(
+            'SELECT clock FROM locations WHERE location = ?', (id_, )
+        ).fetchone()
+        if row is None:
+            raise KeyError(id_)
+        return row[0]
+
+    def get_file_state(self, id_, path):
+        """
+        preconditions:
+            $path is normalized with WorkingDirectory.normalize
+        """
+        path = Path(path)
+        r = self._get_file_state(id_, path)
+        return r if r is not None else FileState(path = path)
+
+    def _get_file_state(self, id_, path):
+        row = self.db.execute(
+            'SELECT digest, size, mtime, wipe FROM location_files WHERE location = ? AND path = ?',
+            (id_, str(path))
+        ).fetchone()
+        if row is None:
+            return None
+        digest, size, mtime, wipe = row
+        return FileState(path = path, digest = digest, size = size, mtime = mtime, wipe = bool(wipe))
+
+    def get_all_paths(self, id_ = None):
+        if id_ is None:
+            cursor = self.db.execute('SELECT DISTINCT path FROM location_files')
+        else:
+            cursor = self.db.execute(
+                'SELECT path FROM location_files WHERE location = ?', (id_, )
+            )
+        return set(intern_path(p) for (p, ) in cursor)
+
+    def get_locations(self):
+        return list(self.items)
+
+    def iterate_file_states(self, id_):
+        return self.iterate_file_states_in(self.db, id_)
+
+    def locations_with_digest(self, digest):
+        """
+        Return { location id: size } for all locations that have a file with
+        the given digest.
+        """
+        return {
+            id_: size for id_, size in self.db.execute(
+                'SELECT location, size FROM location_files WHERE digest = ?', (digest, )
+            )
+        }
+
+    def _insert_file_states(self, id_, file_states):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO location_files (location, path, digest, size, mtime, wipe) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                (id_, str(f.path), f.digest, f.size, f.mtime, int(f.wipe))
+                for f in file_states
+            )
+        )
+
+    def update(self, other):
+        """
+        Take over the location states of $other (a LocationStates or
+        SqliteLocationStates instance) that are newer than ours.
+        """
+        logger.debug('location_states update')
+        for id_ in list(other.get_locations()):
+            row = self.db.execute(
+                'SELECT clock FROM locations WHERE location = ?', (id_, )
+            ).fetchone()
+            if row is not None and row[0] >= other.get_clock(id_):
+                logger.debug('keeping state for {}'.format(id_))
+                continue
+
+            logger.debug('overwriting state for {} with remote'.format(id_))
+            d = other.items[id_]
+            self.db.execute('DELETE FROM location_files WHERE location = ?', (id_, ))
+            self._insert_file_states(id_, d.files.values())
+            self.db.execute(
+                'INSERT OR REPLACE INTO locations (location, clock, last_modification) VALUES (?, ?, ?)',
+                (id_, d.clock, d.last_modification)
+            )
+            if self._observer is not None:
+                self._observer(id_, None)
+
+    def update_file_state(self, id_, file_state):
+        """
+        Record $file_state for location $id_.
+
+        return:
+            True iff the recorded contents changed.
+        """
+        self.db.execute(
+            'INSERT OR IGNORE INTO locations (location, clock, last_modification) VALUES (?, 0, ?)',
+            (id_, self.now())
+        )
+
+        current = self._get_file_state(id_, file_state.path)
+        if current is not None and not file_state.contents_different(current):
+            return False
+
+        self._insert_file_states(id_, [file_state])
+        self.db.execute(
+            'UPDATE locations SET last_modification = ? WHERE location = ?',
+            (self.now(), id_)
+        )
+        self._modified.add(id_)
+        if self._observer is not None:
+            self._observer(id_, file_state.path)
+        return True
+
+    def was_modified(self, id_):
+        return id_ in self._modified
+
+    def save(self):
+        # Same as LocationStates.item_to_dict(): Saving a modified location
+        # state advances its clock
+        for id_ in self._modified:
+            self.db.execute(
+                'UPDATE locations SET clock = clock + 1 WHERE location = ?', (id_, )
+            )
+        self._modified = set()
+        self.db.commit()
@@ -0,0 +1,156 @@
+
+"""
+Storage backends for the repository state and the location states,
+selected by the 'state_backend' repository setting.
+
+A backend creates (init) or opens (load) both components for a given
+harmony directory, releases what they hold open (close) and knows which files (relative_paths) need to be
+transferred to read the state of a remote repository. The stat() of the
+files listed by signature_paths changes whenever the repository state or
+the local location state is saved with changes, which tells whether data
+derived from them (see Repository.get_path_index()) is still current.
+"""
+
+import logging
+
+from harmony.location_states import LocationStates
+from harmony.repository_state import RepositoryState
+from harmony.serialization import Journal
+from harmony.sharded_state import ShardedRepositoryState
+from harmony.sqlite_state import StateDatabase, SqliteLocationStates, SqliteRepositoryState
+
+logger = logging.getLogger(__name__)
+
+class FilesBackend:
+    """
+    One serialized file (location states: directory) per component,
+    each with a journal.
+    """
+
+    name = 'files'
+
+    @staticmethod
+    def relative_paths(harmony_subdir):
+        paths = [
+            LocationStates.get_path(harmony_subdir),
+            RepositoryState.get_path(harmony_subdir),
+        ]
+        return paths + [Journal.path_for(p) for p in paths] \
+            + [LocationStates.summary_path(paths[0])]
+
+    @staticmethod
+    def signature_paths(harmony_directory, id_):
+        location_states = LocationStates.get_path(harmony_directory)
+        repository_state = RepositoryState.get_path(harmony_directory)
+        return [
+            location_states / id_,
+            Journal.path_for(location_states),
+            repository_state,
+            Journal.path_for(repository_state),
+        ]
+
+    @staticmethod
+    def init(harmony_directory):
+        return (
+            LocationStates.init(LocationStates.get_path(harmony_directory)),
+            RepositoryState.init(RepositoryState.get_path(harmony_directory)),
+        )
+
+    @staticmethod
+    def load(harmony_directory, read_only = False):
+        return (
+            LocationStates.load(LocationStates.get_path(harmony_directory), read_only = read_only),
+            RepositoryState.load(RepositoryState.get_path(harmony_directory), read_only = read_only),
+        )
+
+    @staticmethod
+    def close(location_states, repository_state):
+        # Everything is read into memory, nothing is held open
+        pass
+
+class ShardedBackend:
+    """
+    Location states as for FilesBackend, the repository state split into
+    shards, see harmony.sharded_state.
+    """
+
+    name = 'sharded'
+
+    @staticmethod
+    def relative_paths(harmony_subdir):
+        path = LocationStates.get_path(harmony_subdir)
+        return [
+            path,
+            Journal.path_for(path),
+            LocationStates.summary_path(path),
+            ShardedRepositoryState.get_path(harmony_subdir),
+        ]
+
+    @staticmethod
+    def signature_paths(harmony_directory, id_):
+        location_states = LocationStates.get_path(harmony_directory)
+        return [
+            location_states / id_,
+            Journal.path_for(location_states),
+            ShardedRepositoryState.get_path(harmony_directory) / ShardedRepositoryState.MANIFEST,
+        ]
+
+    @staticmethod
+    def init(harmony_directory):
+        return (
+            LocationStates.init(LocationStates.get_path(harmony_directory)),
+            ShardedRepositoryState.init(ShardedRepositoryState.get_path(harmony_directory)),
+        )
+
+    @staticmethod
+    def load(harmony_directory, read_only = False):
+        return (
+            LocationStates.load(LocationStates.get_path(harmony_directory), read_only = read_only),
+            ShardedRepositoryState.load(ShardedRepositoryState.get_path(harmony_directory)),
+        )
+
+    @staticmethod
+    def close(location_states, repository_state):
+        pass
+
+class SqliteBackend:
+    """
+    Both components in one SQLite database, see harmony.sqlite_state.
+    """
+
+    name = 'sqlite'
+
+    @staticmethod
+    def relative_paths(harmony_subdir):
+        return [StateDatabase.get_path(harmony_subdir)]
+
+    @staticmethod
+    def signature_paths(harmony_directory, id_):
+        return [StateDatabase.get_path(harmony_directory)]
+
+    @staticmethod
+    def init(harmony_directory):
+        db = StateDatabase.init(StateDatabase.get_path(harmony_directory))
+        return SqliteLocationStates(db), SqliteRepositoryState(db)
+
+    @staticmethod
+    def load(harmony_directory, read_only = False):
+        db = StateDatabase.load(StateDatabase.get_path(harmony_directory), read_only = read_only)
+        return SqliteLocationStates(db), SqliteRepositoryState(db)
+
+    @staticmethod
+    def close(location_states, repository_state):
+        # Both share the database
+        repository_state.db.close()
+
+BACKENDS = {
+    b.name: b
+    for b in (FilesBackend, ShardedBackend, SqliteBackend)
+}
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('Unknown state backend "{}", expected one of {}.'.format(
+            name, ', '.join(sorted(BACKENDS))
+        ))
+    return BACKENDS[name]
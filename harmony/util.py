@@ -1,3 +1,5 @@
+import weakref
+from pathlib import Path
 
 # Not available in py3
 #import dateutil
@@ -18,3 +20,31 @@ def iso_to_datetime(s):
 def shortened_id(id_):
     return id_[4:8]
 
+
+class InternedPath(type(Path())):
+    """
+    The Path class used by intern_path(), one that can be weakly
+    referenced.
+    """
+    __slots__ = ('__weakref__', )
+
+# { str: InternedPath } of the paths returned by intern_path() that are
+# still in use (by file states, state keys, ...), so the table does not
+# outlive the states
+_paths = weakref.WeakValueDictionary()
+
+def intern_path(path):
+    """
+    Return the one Path instance used for $path (a str or Path) in all
+    file states and state keys, so every relative path is in memory only
+    once, no matter how many locations and components refer to it.
+    str() of the result is cached by Path, so it can serve as the
+    interned str of the path as well.
+    """
+    s = str(path)
+    r = _paths.get(s)
+    if r is None:
+        r = InternedPath(s)
+        r = _paths.setdefault(str(r), r)
+        _paths[s] = r
+    return r
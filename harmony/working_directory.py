@@ -1,10 +1,13 @@
 
 import os
+import time
 import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from harmony import hashers
 from harmony.serialization import Serializable
+from harmony.util import intern_path
 
 logger = logging.getLogger(__name__)
 
@@ -14,8 +17,10 @@ class FileState(Serializable):
     Generated in WorkingDirectory, stored in LocationState.
     """
 
+    __slots__ = ('path', 'digest', 'size', 'mtime', 'wipe')
+
     def __init__(self, path = None, digest = None, size = None, mtime = None, wipe = False):
-        self.path = Path(path)
+        self.path = intern_path(path)
         self.digest = digest
         self.size = size
         self.mtime = mtime
@@ -30,17 +35,97 @@ class FileState(Serializable):
             self.wipe,
         )
 
+    def replace(self, **kws):
+        """
+        Return a copy with the attributes given as keyword arguments replaced.
+        """
+        d = { k: getattr(self, k) for k in self.__slots__ }
+        d.update(kws)
+        return self.__class__(**d)
+
     def exists(self):
         return self.size is not None
 
     def contents_different(self, other):
         return self.size != other.size or self.digest != other.digest
 
+def stat(path):
+    """
+    Return os.stat() of path (following symlinks)
+    or None if the file does not exist.
+    """
+    try:
+        return os.stat(str(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def hash_file(path, hasher_name = 'default'):
+    """
+    Stat and hash the file at the given absolute path.
+    This is a module level function so it can be shipped to worker processes.
+
+    return:
+        A tuple (stat_result, digest) or None if the file does not exist.
+    """
+    path = Path(path)
+    st = stat(path)
+    if st is None:
+        return None
+
+    hasher = hashers.get_hasher(hasher_name)
+    with path.open('rb') as f:
+        digest = hasher(f)
+    return st, digest
+
+class HashStatistics:
+    """
+    Throughput of one run of WorkingDirectory.generate_file_states().
+    """
+
+    def __init__(self, files = 0, bytes_ = 0, seconds = 0.0, cached = 0):
+        self.files = files
+        self.bytes = bytes_
+        self.seconds = seconds
+        # Number of files whose digest came from the hash cache
+        # (these are included in self.files but not in self.bytes)
+        self.cached = cached
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return '{} files ({} bytes, {} cached) in {:.2f}s: {:.1f} files/s, {:.0f} bytes/s'.format(
+            self.files, self.bytes, self.cached, self.seconds,
+            self.files_per_second, self.bytes_per_second
+        )
+
 class WorkingDirectory:
 
-    def __init__(self, path, ruleset):
+    # Executors available for hashing files in parallel,
+    # threads are usually the better choice for large (I/O bound) files,
+    # processes for lots of small (CPU bound) files.
+    EXECUTORS = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
+    def __init__(self, path, ruleset, jobs = 1, executor = 'thread', hash_cache = None):
         self.path = Path(path).resolve()
         self.ruleset = ruleset
+        self.jobs = jobs
+        self.executor = executor
+        self.hash_cache = hash_cache
+        self.hash_statistics = HashStatistics()
+
+        if executor not in self.EXECUTORS:
+            raise ValueError('Unknown hashing executor "{}", expected one of {}.'.format(
+                executor, ', '.join(sorted(self.EXECUTORS))
+            ))
 
     def normalize(self, relpath):
         abspath = (self.path / relpath)
@@ -50,16 +135,62 @@ class WorkingDirectory:
             pass
         return abspath.relative_to(self.path)
 
+    def scan(self, subdirectory = None):
+        """
+        Walk the working directory once and stat every committable file in
+        it.
+
+        subdirectory:
+            Only walk this directory (relative to the working directory).
+
+        return:
+            A dict { path: os.stat_result } with normalized relative paths
+            (see normalize()).
+        """
+        r = {}
+        for file_info in self.ruleset.iterate_committable_files(self.path, subdirectory):
+            entry = file_info.dir_entry
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                # Dangling symlink
+                continue
+
+            # As we do not descend into symlinked directories, only paths
+            # that are symlinks themselves need normalization
+            if entry.is_symlink():
+                path = intern_path(self.normalize(file_info.relative_filename))
+            else:
+                path = intern_path(file_info.relative_filename)
+            r[path] = st
+        return r
+
     def get_filenames(self):
-        r = set()
-        for file_info in self.ruleset.iterate_committable_files(self.path):
-            r.add(self.normalize(file_info.relative_filename))
+        return set(self.scan().keys())
+
+    def stat(self, path):
+        """
+        Return os.stat() of the file at relative path $path
+        or None if it does not exist.
+        """
+        return stat(self.path / path)
+
+    def stat_files(self, paths):
+        """
+        Like scan(), but only stat the given (normalized, relative) paths
+        instead of walking the working directory.
+        """
+        r = {}
+        for path in paths:
+            st = stat(self.path / path)
+            if st is not None:
+                r[path] = st
         return r
 
     def __contains__(self, path):
         return (self.path / self.normalize(path)).exists()
 
-    def file_maybe_modified(self, file_state):
+    def file_maybe_modified(self, file_state, stat_ = None):
         """
         Return True if the file $file_info.path suggests that it might have
         been modified since file_info was generated.
@@ -71,11 +202,16 @@ class WorkingDirectory:
         Unless there are clock screwups, when this function returns False it
         can be assumed the file has not changed. If it returns True it might or
         might not have been changed.
+
+        stat_:
+            os.stat_result for the file if already known (eg. from scan()),
+            if None, the file is stat'ed.
         """
-        path = self.path / file_state.path
+        if stat_ is None:
+            stat_ = self.stat(file_state.path)
 
         exists_before = file_state.size is not None
-        exists_now = path.exists()
+        exists_now = stat_ is not None
 
         if not exists_before and not exists_now:
             # Nothing changed on the non-existance of this file in this
@@ -89,8 +225,8 @@ class WorkingDirectory:
 
         assert exists_before and exists_now
 
-        mtime = path.stat().st_mtime
-        size = path.stat().st_size
+        mtime = stat_.st_mtime
+        size = stat_.st_size
 
         if file_state.mtime > mtime:
             logger.warn('Clock screwup: Memorized modification time of {} is more recent than actual.'.format(
@@ -103,24 +239,99 @@ class WorkingDirectory:
         return mtime > file_state.mtime or size != file_state.size
 
     def generate_file_state(self, path):
-        hasher = hashers.get_hasher('default')
-        full_path = self.path / path
-        exists = full_path.exists()
+        return self.generate_file_states([path])[path]
 
-        if exists:
-            mtime = full_path.stat().st_mtime
-            size = full_path.stat().st_size
-            with full_path.open('rb') as f:
-                digest = hasher(f)
+    def generate_file_states(self, paths, stats = None, digests = None):
+        """
+        Generate FileState instances for all of the given paths.
+        Hashing is distributed over self.jobs workers of type self.executor,
+        the result is the same as calling generate_file_state() on each path
+        in turn.
+        Throughput of the run is stored in self.hash_statistics.
+
+        stats:
+            Optional dict { path: os.stat_result } as returned by scan().
+            Paths in there are assumed to be normalized already and are not
+            stat'ed again before consulting the hash cache.
+
+        digests:
+            Optional dict { path: digest } of digests of the current contents
+            that are already known (e.g. computed during a transfer). These
+            files are not read, and their digests go to the hash cache.
+
+        return:
+            A dict { path: FileState } with the paths as passed in.
+        """
+        paths = list(paths)
+        stats = stats if stats is not None else {}
+        digests = digests if digests is not None else {}
+        normalized = [path if path in stats else self.normalize(path) for path in paths]
+        full_paths = [str(self.path / path) for path in normalized]
+        hasher_name = hashers.DEFAULT
+        statistics = HashStatistics()
+
+        start = time.perf_counter()
 
+        # Files known to the hash cache only need a stat, the rest is read
+        # and hashed (possibly in parallel)
+        results = [None] * len(paths)
+        to_hash = []
+        for i, full_path in enumerate(full_paths):
+            if paths[i] in digests:
+                st = stats.get(paths[i]) or stat(full_path)
+                if st is not None:
+                    results[i] = (st, digests[paths[i]])
+                    if self.hash_cache is not None:
+                        self.hash_cache.put(*results[i])
+                continue
+
+            if self.hash_cache is not None:
+                st = stats.get(paths[i]) or stat(full_path)
+                if st is None:
+                    continue
+                digest = self.hash_cache.get(st, hasher_name)
+                if digest is not None:
+                    results[i] = (st, digest)
+                    statistics.cached += 1
+                    continue
+            to_hash.append(i)
+
+        hash_paths = [full_paths[i] for i in to_hash]
+        if self.jobs > 1 and len(hash_paths) > 1:
+            with self.EXECUTORS[self.executor](max_workers = self.jobs) as executor:
+                hashed = list(executor.map(
+                    hash_file, hash_paths, [hasher_name] * len(hash_paths),
+                    chunksize = max(1, len(hash_paths) // (self.jobs * 4))
+                ))
         else:
-            mtime = size = digest = None
+            hashed = [hash_file(p, hasher_name) for p in hash_paths]
 
-        r = FileState(
-            path = self.normalize(path),
-            mtime = mtime,
-            size = size,
-            digest = digest,
-        )
+        for i, result in zip(to_hash, hashed):
+            results[i] = result
+            if result is not None:
+                statistics.bytes += result[0].st_size
+                if self.hash_cache is not None:
+                    self.hash_cache.put(*result)
+
+        r = {}
+        for path, normalized_path, result in zip(paths, normalized, results):
+            if result is not None:
+                st, digest = result
+                mtime, size = st.st_mtime, st.st_size
+                statistics.files += 1
+            else:
+                mtime = size = digest = None
+
+            r[path] = FileState(
+                path = normalized_path,
+                mtime = mtime,
+                size = size,
+                digest = digest,
+            )
+
+        statistics.seconds = time.perf_counter() - start
+        self.hash_statistics = statistics
+        if statistics.files:
+            logger.info('Hashed {}'.format(statistics))
         return r
 
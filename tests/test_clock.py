@@ -1,6 +1,8 @@
 
+import random
 import logging
-from harmony.clock import Clock
+from harmony import clock
+from harmony.clock import Clock, compare_many
 
 
 logger = logging.getLogger(__name__)
@@ -38,3 +40,34 @@ def test_clock_compare_greater():
     assert Clock(a = 2)        >  Clock(a = 1) 
     assert Clock(a = 2, b = 1) >  Clock(a = 1) 
 
+
+def test_compare_many_equals_compare(monkeypatch):
+    rnd = random.Random(0)
+    keys = ['loc{}'.format(i) for i in range(6)]
+
+    def random_clock():
+        return Clock(**{k: rnd.randint(0, 2) for k in keys if rnd.random() < 0.5})
+
+    clocks = [random_clock() for _ in range(500)]
+    others = [random_clock() for _ in range(500)]
+    expected = [a.compare(b) for a, b in zip(clocks, others)]
+
+    assert compare_many(clocks, others) == expected
+    assert compare_many([], []) == []
+
+    # Fallback without numpy
+    monkeypatch.setattr(clock, 'numpy', None)
+    assert compare_many(clocks, others) == expected
+
+def test_clock_non_mutating_operations():
+    a = Clock(a = 1, b = 2)
+    b = Clock(b = 3, c = 1)
+
+    merged = a.merged(b)
+    assert merged.values == { 'a': 1, 'b': 3, 'c': 1 }
+    assert merged.increased('a').values == { 'a': 2, 'b': 3, 'c': 1 }
+    assert a.with_value('d', 5).values == { 'a': 1, 'b': 2, 'd': 5 }
+
+    assert a.values == { 'a': 1, 'b': 2 }
+    assert b.values == { 'b': 3, 'c': 1 }
+    assert merged.values == { 'a': 1, 'b': 3, 'c': 1 }
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import random
+import logging
+from pathlib import Path
+
+import pytest
+
+from tests.utils import *
+from harmony import columnar
+from harmony import file_state_logic
+from harmony.clock import Clock
+from harmony.location_states import LocationStates
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.ruleset import Ruleset
+from harmony.working_directory import WorkingDirectory
+
+numpy = pytest.importorskip('numpy')
+
+logger = logging.getLogger(__name__)
+
+LOCATIONS = ('a', 'b', 'c', 'd')
+
+def random_state(rnd, paths):
+    return RepositoryState(None, files = {
+        p: RepositoryFileState(
+            path = p,
+            digest = rnd.choice(['sha1:1', 'sha1:2', None]),
+            clock = Clock(**{
+                l: rnd.randint(0, 3) for l in LOCATIONS
+                if rnd.random() < 0.7
+            }),
+            wipe = rnd.random() < 0.1,
+        )
+        for p in paths
+    })
+
+def test_merge_equals_file_state_logic():
+    rnd = random.Random(1)
+    for _ in range(20):
+        local = random_state(rnd, ['f{}'.format(i) for i in range(0, 60)])
+        remote = random_state(rnd, ['f{}'.format(i) for i in range(30, 90)])
+
+        conflicts, merged = file_state_logic.merge(local, remote, 'a')
+        c_conflicts, c_merged = columnar.merge(local, remote, 'a')
+
+        assert set(conflicts.keys()) == set(c_conflicts.keys())
+        assert set(merged.files.keys()) == set(c_merged.files.keys())
+        for p in merged.files:
+            expected = merged.files[p]
+            actual = c_merged.files[p]
+            assert str(expected.path) == str(actual.path)
+            assert expected.digest == actual.digest
+            assert expected.wipe == actual.wipe
+            # Clocks may differ in explicit zero entries
+            assert expected.clock == actual.clock
+
+def test_status_equals_file_maybe_modified():
+    with TempDir() as d:
+        wd = WorkingDirectory(d, Ruleset(d))
+        location_states = LocationStates(None)
+        for name in ('same.txt', 'modified.txt', 'deleted.txt'):
+            (d / name).write_text(name)
+            location_states.update_file_state('x', wd.generate_file_state(name))
+        (d / 'modified.txt').write_text('modified!')
+        (d / 'deleted.txt').unlink()
+        (d / 'new.txt').write_text('new')
+
+        repository_state = RepositoryState(None, files = {
+            name: RepositoryFileState(path = name, digest = 'sha1:other' if name == 'same.txt' else None)
+            for name in ('same.txt', 'modified.txt', 'deleted.txt', 'new.txt', 'elsewhere.txt')
+        })
+        repository_state.files['modified.txt'].digest = \
+            location_states.get_file_state('x', 'modified.txt').digest
+
+        paths = list(repository_state.files)
+        flags = columnar.status(
+            repository_state,
+            location_states.iterate_file_states('x'),
+            [wd.stat(p) for p in paths]
+        )
+
+        for i, p in enumerate(paths):
+            le = location_states.get_file_state('x', p)
+            re = repository_state.files[p]
+            assert flags['maybe_modified'][i] == wd.file_maybe_modified(le)
+            assert flags['exists_in_location_state'][i] == le.exists()
+            assert flags['is_most_recent'][i] == (not le.exists() or le.digest == re.digest)
+
+def test_repository_columnar_setting():
+    from harmony.repository import Repository
+
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A)
+        rB = Repository.clone(B, A)
+        rB.settings['columnar'] = True
+
+        (A / 'x.txt').write_text('Hello, World')
+        rA.commit()
+        (B / 'x.txt').write_text('Hello, World')
+        (B / 'y.txt').write_text('Only in B')
+        rB.commit()
+
+        conflicts = rB.pull_state(A)
+        assert len(conflicts) == 0
+
+        stats = { str(f.path): f for f in rB.get_file_stats() }
+        assert set(stats.keys()) == { 'x.txt', 'y.txt' }
+        assert not stats['x.txt'].maybe_modified
+        assert stats['x.txt'].is_most_recent
+
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import logging
+from io import BytesIO
+from pathlib import Path
+
+from tests.utils import *
+from harmony import file_state_logic
+from harmony.hashers import get_hasher
+from harmony.clock import Clock
+from harmony.location_states import LocationStates
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.ruleset import Ruleset
+from harmony.working_directory import WorkingDirectory
+
+logger = logging.getLogger(__name__)
+
+ID = 'local'
+
+def digest(content):
+    return get_hasher('default')(BytesIO(content.encode()))
+
+def make_state(d, wd_contents, repository_contents):
+    """
+    Create files in $d and matching location states from
+    $wd_contents = { path: content } and a repository state from
+    $repository_contents = { path: (content, wipe) }.
+    """
+    wd = WorkingDirectory(d, Ruleset(d))
+    location_states = LocationStates(None)
+    for path, content in wd_contents.items():
+        (d / path).parent.mkdir(parents = True, exist_ok = True)
+        (d / path).write_text(content)
+        location_states.update_file_state(ID, wd.generate_file_state(path))
+
+    repository_state = RepositoryState(None, files = {
+        path: RepositoryFileState(
+            path = path,
+            digest = digest(content),
+            clock = Clock(),
+            wipe = wipe
+        )
+        for path, (content, wipe) in repository_contents.items()
+    })
+    return wd, location_states, repository_state
+
+def test_auto_rename_simple():
+    with TempDir() as d:
+        wd, ls, rs = make_state(d, { 'x.txt': 'x' }, {
+            'x.txt': ('x', True),
+            'sub/y.txt': ('x', False),
+        })
+
+        renames = file_state_logic.auto_rename(wd, rs)
+        assert renames == { Path('x.txt'): Path('sub/y.txt') }
+        assert not (d / 'x.txt').exists()
+        assert (d / 'sub' / 'y.txt').read_text() == 'x'
+
+def test_auto_rename_does_not_overwrite():
+    with TempDir() as d:
+        wd, ls, rs = make_state(d, { 'a': 'a', 'b': 'b' }, {
+            'a': ('a', True),
+            'b': ('a', False),
+        })
+
+        # Without location states the content of b is unknown,
+        # so it must not be overwritten
+        renames = file_state_logic.auto_rename(wd, rs)
+        assert renames == {}
+        assert (d / 'a').read_text() == 'a'
+        assert (d / 'b').read_text() == 'b'
+
+def test_auto_rename_chain():
+    with TempDir() as d:
+        # a -> b, b -> c
+        wd, ls, rs = make_state(d, { 'a': 'a', 'b': 'b' }, {
+            'a': ('a', True),
+            'b': ('a', False),
+            'c': ('b', False),
+        })
+
+        renames = file_state_logic.auto_rename(wd, rs, ls, ID)
+        assert renames == { Path('a'): Path('b'), Path('b'): Path('c') }
+        assert not (d / 'a').exists()
+        assert (d / 'b').read_text() == 'a'
+        assert (d / 'c').read_text() == 'b'
+
+def test_auto_rename_swap():
+    with TempDir() as d:
+        wd, ls, rs = make_state(d, { 'a': 'a', 'b': 'b' }, {
+            'a': ('b', False),
+            'b': ('a', False),
+        })
+
+        renames = file_state_logic.auto_rename(wd, rs, ls, ID)
+        assert renames == { Path('a'): Path('b'), Path('b'): Path('a') }
+        assert (d / 'a').read_text() == 'b'
+        assert (d / 'b').read_text() == 'a'
+
+def test_auto_rename_keeps_outdated_files():
+    with TempDir() as d:
+        # x is outdated here, its old content is wanted as y, which is
+        # missing. Moving x would make it look deleted.
+        wd, ls, rs = make_state(d, { 'x': 'old x' }, {
+            'x': ('new x', False),
+            'y': ('old x', False),
+        })
+
+        renames = file_state_logic.auto_rename(wd, rs, ls, ID)
+        assert renames == {}
+        assert (d / 'x').read_text() == 'old x'
+        assert not (d / 'y').exists()
+
+def test_auto_rename_keeps_wipe():
+    with TempDir() as d:
+        # a -> b, b -> c
+        wd, ls, rs = make_state(d, { 'a': 'a', 'b': 'b' }, {
+            'a': ('a', True),
+            'b': ('a', False),
+            'c': ('b', False),
+        })
+        before = { p: rs[p] for p in ('a', 'b', 'c') }
+
+        file_state_logic.auto_rename(wd, rs, ls, ID)
+        file_state_logic.commit(ID, wd, ls, rs)
+
+        # Only the local location state changed
+        for p, entry in before.items():
+            assert rs[p] is entry
+        assert not ls.get_file_state(ID, Path('a')).exists()
+        assert ls.get_file_state(ID, Path('c')).digest == digest('b')
+
+def test_merge_shares_entries():
+    local = RepositoryState(None, files = {
+        'same': RepositoryFileState(path = 'same', digest = 'sha1:s', clock = Clock(a = 1)),
+        'newer_remote': RepositoryFileState(path = 'newer_remote', digest = 'sha1:1', clock = Clock(a = 1)),
+        'automerge': RepositoryFileState(path = 'automerge', digest = 'sha1:x', clock = Clock(a = 1)),
+    })
+    remote = RepositoryState(None, files = {
+        'same': RepositoryFileState(path = 'same', digest = 'sha1:s', clock = Clock(a = 1)),
+        'newer_remote': RepositoryFileState(path = 'newer_remote', digest = 'sha1:2', clock = Clock(a = 1, b = 1)),
+        'automerge': RepositoryFileState(path = 'automerge', digest = 'sha1:x', clock = Clock(b = 1)),
+    })
+
+    conflicts, merged = file_state_logic.merge(local, remote, 'a')
+    assert conflicts == {}
+
+    # Unchanged entries are shared, not copied
+    assert merged.files['same'] is local.files['same']
+    assert merged.files['newer_remote'] is remote.files['newer_remote']
+
+    # Automerged entries are new, the inputs stay untouched
+    assert merged.files['automerge'].clock.values == { 'a': 2, 'b': 1 }
+    assert local.files['automerge'].clock.values == { 'a': 1 }
+    assert remote.files['automerge'].clock.values == { 'b': 1 }
+
+def test_update_file_state_does_not_modify_entries():
+    rs = RepositoryState(None)
+    rs.update_file_state(RepositoryFileState(path = 'x', digest = 'sha1:1'), 'a', 1)
+    before = rs['x']
+
+    rs.update_file_state(RepositoryFileState(path = 'x', digest = 'sha1:2'), 'a', 2)
+    assert before.digest == 'sha1:1'
+    assert before.clock.values == { 'a': 1 }
+    assert rs['x'].digest == 'sha1:2'
+    assert rs['x'].clock.values == { 'a': 2 }
+
+
+def test_auto_rename_offers_targets_of_dropped_renames():
+    with TempDir() as d:
+        # a (outdated) and w (wiped) both have the content wanted as t.
+        # a can not move, so t goes to w.
+        wd, ls, rs = make_state(d, { 'a': 'x', 'w': 'x' }, {
+            'a': ('new a', False),
+            't': ('x', False),
+            'w': ('x', True),
+        })
+        (d / 'tmp').mkdir()
+
+        renames = file_state_logic.auto_rename(wd, rs, ls, ID, d / 'tmp')
+        assert renames == { Path('w'): Path('t') }
+        assert (d / 'a').read_text() == 'x'
+        assert (d / 't').read_text() == 'x'
+        assert not (d / 'w').exists()
+        assert list((d / 'tmp').iterdir()) == []
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+from pathlib import Path
+
+from tests.utils import *
+from harmony import serialization
+from harmony.hash_cache import HashCache
+from harmony.ruleset import Ruleset
+from harmony.working_directory import WorkingDirectory
+
+logger = logging.getLogger(__name__)
+
+def test_hash_cache_evicts_least_recently_used():
+    with TempDir() as d:
+        for i in range(3):
+            (d / 'f{}'.format(i)).write_text(str(i))
+        stats = [os.stat(str(d / 'f{}'.format(i))) for i in range(3)]
+
+        cache = HashCache(d / 'hash_cache', max_entries = 2)
+        cache.put(stats[0], 'sha1:0')
+        cache.put(stats[1], 'sha1:1')
+        assert cache.get(stats[0], 'sha1') == 'sha1:0'
+
+        # f1 is now least recently used
+        cache.put(stats[2], 'sha1:2')
+        assert len(cache) == 2
+        assert cache.get(stats[1], 'sha1') is None
+        assert cache.get(stats[0], 'sha1') == 'sha1:0'
+        assert cache.get(stats[2], 'sha1') == 'sha1:2'
+
+        # Digests of other hashers are not reported
+        assert cache.get(stats[0], 'md5') is None
+
+def test_hash_cache_save_load():
+    with TempDir() as d:
+        (d / 'x').write_text('x')
+        st = os.stat(str(d / 'x'))
+
+        cache = HashCache.init(d / 'hash_cache')
+        cache.put(st, 'sha1:x')
+        cache.save()
+
+        loaded = HashCache.load(d / 'hash_cache')
+        assert loaded.get(st, 'sha1') == 'sha1:x'
+
+def test_hash_cache_journals_changes():
+    with TempDir() as d:
+        for i in range(3):
+            (d / 'f{}'.format(i)).write_text(str(i))
+        stats = [os.stat(str(d / 'f{}'.format(i))) for i in range(3)]
+
+        cache = HashCache.init(d / 'hash_cache')
+        cache.max_entries = 2
+        cache.put(stats[0], 'sha1:0')
+        cache.put(stats[1], 'sha1:1')
+        cache.save()
+        base = (d / 'hash_cache').read_bytes()
+
+        # Only the changes are written
+        cache = HashCache.load(d / 'hash_cache')
+        cache.max_entries = 2
+        cache.put(stats[2], 'sha1:2')
+        cache.save()
+        assert (d / 'hash_cache').read_bytes() == base
+        assert serialization.Journal.path_for(d / 'hash_cache').exists()
+
+        loaded = HashCache.load(d / 'hash_cache')
+        assert len(loaded) == 2
+        assert loaded.get(stats[0], 'sha1') is None
+        assert loaded.get(stats[2], 'sha1') == 'sha1:2'
+
+def test_hash_cache_load_missing():
+    with TempDir() as d:
+        cache = HashCache.load(d / 'hash_cache')
+        assert len(cache) == 0
+
+def test_working_directory_uses_hash_cache():
+    with TempDir() as d:
+        (d / 'x.txt').write_text('xxx')
+        cache = HashCache(d / 'hash_cache')
+        wd = WorkingDirectory(d, Ruleset(d), hash_cache = cache)
+
+        state = wd.generate_file_state(Path('x.txt'))
+        assert wd.hash_statistics.cached == 0
+
+        cached_state = wd.generate_file_state(Path('x.txt'))
+        assert wd.hash_statistics.cached == 1
+        assert cached_state.to_dict() == state.to_dict()
+
+        # Changing the file invalidates the cache entry
+        (d / 'x.txt').write_text('yyyy')
+        changed_state = wd.generate_file_state(Path('x.txt'))
+        assert wd.hash_statistics.cached == 0
+        assert changed_state.digest != state.digest
+
@@ -9,7 +9,7 @@ from io import BytesIO
 from pytest import raises
 
 from tests.utils import *
-from harmony.hashers import get_hasher
+from harmony.hashers import get_hasher, Digester
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +29,13 @@ def test_sha1_of_empty():
     digest = hasher(empty)
     assert digest == 'sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709'
 
+def test_digester_matches_hasher():
+    data = b'some data' * 1000
+    digester = Digester('default')
+    digester.update(data[:100])
+    digester.update(data[100:])
+    assert digester.digest() == get_hasher('default')(BytesIO(data))
+
 
 #  vim: set ts=4 sw=4 tw=79 expandtab :
 
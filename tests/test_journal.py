@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+import pytest
+
+from tests.utils import *
+from harmony.clock import Clock
+from harmony.location_states import LocationStates
+from harmony.repository import Repository
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.serialization import Journal
+from harmony.state_backends import FilesBackend
+from harmony.working_directory import FileState
+
+logger = logging.getLogger(__name__)
+
+def test_journal_drops_incomplete_record():
+    with TempDir() as d:
+        journal = Journal(d / 'j')
+        journal.append([{ 'a': 1 }, { 'b': 2 }])
+        with (d / 'j').open('a') as f:
+            f.write('{"c":')
+
+        assert Journal(d / 'j').read() == [{ 'a': 1 }, { 'b': 2 }]
+
+        journal = Journal(d / 'j')
+        journal.read()
+        journal.append([{ 'd': 4 }])
+        assert Journal(d / 'j').read() == [{ 'a': 1 }, { 'b': 2 }, { 'd': 4 }]
+
+def test_read_only_journal_is_not_written():
+    with TempDir() as d:
+        r = Repository.init(d)
+        (d / 'x.txt').write_text('x')
+        r.commit()
+        path = RepositoryState.get_path(r.harmony_directory)
+        with Journal.path_for(path).open('a') as f:
+            f.write('{"c":')
+        contents = Journal.path_for(path).read_bytes()
+
+        location_states, repository_state = FilesBackend.load(r.harmony_directory, read_only = True)
+        assert set(repository_state.get_paths()) == { Path('x.txt') }
+        assert Journal.path_for(path).read_bytes() == contents
+
+        repository_state['y.txt'] = RepositoryFileState(path = 'y.txt', digest = 'sha1:y')
+        with pytest.raises(PermissionError):
+            repository_state.save()
+        assert Journal.path_for(path).read_bytes() == contents
+
+def test_repository_state_journal():
+    with TempDir() as d:
+        path = d / 'repository_state'
+        rs = RepositoryState.init(path)
+        rs['x'] = RepositoryFileState(path = 'x', digest = 'sha1:x', clock = Clock(a = 1))
+        rs.save()
+        base = path.read_bytes()
+        journal_length = len(Journal(Journal.path_for(path)).read())
+
+        rs = RepositoryState.load(path)
+        rs.update_file_state(RepositoryFileState(path = 'x', digest = 'sha1:y'), 'a', 2)
+        rs['z'] = RepositoryFileState(path = 'z', digest = 'sha1:z')
+        rs.save()
+
+        # Only the journal has been written to
+        assert path.read_bytes() == base
+        assert len(Journal(Journal.path_for(path)).read()) == journal_length + 2
+
+        rs = RepositoryState.load(path)
+        assert rs['x'].digest == 'sha1:y'
+        assert rs['x'].clock.values == { 'a': 2 }
+        assert rs['z'].digest == 'sha1:z'
+
+        # Removal via overwrite() and compaction
+        rs.COMPACT_JOURNAL_RECORDS = journal_length + 3
+        other = RepositoryState(None, files = { 'x': rs.files['x'] })
+        rs.overwrite(other)
+        rs.save()
+        assert not Journal.path_for(path).exists()
+        assert set(RepositoryState.load(path).files.keys()) == { 'x' }
+
+def test_location_states_journal():
+    with TempDir() as d:
+        path = d / 'location_states'
+        ls = LocationStates.init(path)
+        ls.update_file_state('a', FileState(path = 'x', digest = 'sha1:x', size = 1))
+        ls.save()
+        assert ls.get_clock('a') == 1
+        journal_length = len(Journal(Journal.path_for(path)).read())
+
+        ls = LocationStates.load(path)
+        ls.update_file_state('a', FileState(path = 'y', digest = 'sha1:y', size = 2))
+        ls.save()
+        # One file state and the clock
+        assert len(Journal(Journal.path_for(path)).read()) == journal_length + 2
+
+        ls = LocationStates.load(path)
+        assert ls.get_clock('a') == 2
+        assert ls.get_file_state('a', 'x').digest == 'sha1:x'
+        assert ls.get_file_state('a', 'y').digest == 'sha1:y'
+
+def test_commit_appends_to_journal():
+    with TempDir() as d:
+        r = Repository.init(d)
+        for i in range(100):
+            (d / 'file{}.txt'.format(i)).write_text('file {}'.format(i))
+        r.commit()
+
+        harmony = d / Repository.HARMONY_SUBDIR
+        journals = [
+            Journal.path_for(harmony / 'repository_state'),
+            Journal.path_for(harmony / 'location_states'),
+        ]
+        sizes = [p.stat().st_size if p.exists() else 0 for p in journals]
+
+        (d / 'file42.txt').write_text('changed')
+        r.commit()
+
+        written = sum(p.stat().st_size for p in journals) - sum(sizes)
+        assert 0 < written < 1000
+
+        r = Repository.load(r.harmony_directory)
+        assert r.repository_state['file42.txt'].digest \
+            == r.location_states.get_file_state(r.id, Path('file42.txt')).digest
+
+def test_pull_state_replays_remote_journal():
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A)
+        (A / 'x.txt').write_text('x')
+        rA.commit()
+        rB = Repository.clone(B, A)
+
+        (A / 'x.txt').write_text('changed x')
+        rA.commit()
+
+        conflicts = rB.pull_state(A)
+        assert len(conflicts) == 0
+        assert rB.repository_state['x.txt'].digest == rA.repository_state['x.txt'].digest
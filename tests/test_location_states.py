@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+from tests.utils import *
+from harmony import serialization
+from harmony.location_states import LocationStates
+from harmony.working_directory import FileState
+
+logger = logging.getLogger(__name__)
+
+def make_location_states(path, files):
+    """
+    Create location states in $path from $files = { location: { path: digest } }.
+    """
+    ls = LocationStates.init(path)
+    for id_, d in files.items():
+        for p, digest in d.items():
+            ls.update_file_state(id_, FileState(path = p, digest = digest, size = 1))
+    ls.save()
+    return ls
+
+def test_locations_are_loaded_on_demand():
+    with TempDir() as d:
+        make_location_states(d / 'ls', {
+            'a': { 'x': 'sha1:ax' },
+            'b': { 'x': 'sha1:bx' },
+            'c': { 'x': 'sha1:cx' },
+        })
+
+        ls = LocationStates.load(d / 'ls')
+        assert set(ls.get_locations()) == { 'a', 'b', 'c' }
+        assert [ls.get_clock(id_) for id_ in 'abc'] == [1, 1, 1]
+        assert not any(ls.items.is_loaded(id_) for id_ in 'abc')
+
+        assert ls.get_file_state('b', 'x').digest == 'sha1:bx'
+        assert ls.items.is_loaded('b')
+        assert not ls.items.is_loaded('a')
+        assert not ls.items.is_loaded('c')
+
+def test_journal_is_applied_on_load():
+    with TempDir() as d:
+        make_location_states(d / 'ls', {
+            'a': { 'x': 'sha1:ax' },
+            'b': { 'x': 'sha1:bx' },
+        })
+        ls = LocationStates.load(d / 'ls')
+        ls.update_file_state('b', FileState(path = 'y', digest = 'sha1:by', size = 1))
+        ls.save()
+
+        ls = LocationStates.load(d / 'ls')
+        assert ls.get_clock('b') == 2
+        assert not ls.items.is_loaded('b')
+        assert ls.get_file_state('b', 'y').digest == 'sha1:by'
+        assert ls.get_clock('b') == 2
+
+        # Compaction writes the journaled changes of locations that were
+        # not loaded
+        ls = LocationStates.load(d / 'ls')
+        ls.COMPACT_JOURNAL_RECORDS = 1
+        ls.update_file_state('a', FileState(path = 'y', digest = 'sha1:ay', size = 1))
+        ls.save()
+        assert not serialization.Journal.path_for(d / 'ls').exists()
+
+        ls = LocationStates.load(d / 'ls')
+        assert ls.get_file_state('b', 'y').digest == 'sha1:by'
+        assert ls.get_file_state('a', 'y').digest == 'sha1:ay'
+        assert (ls.get_clock('a'), ls.get_clock('b')) == (2, 2)
+
+def test_stale_summary_is_ignored():
+    with TempDir() as d:
+        make_location_states(d / 'ls', { 'a': { 'x': 'sha1:ax' } })
+
+        # Somebody else rewrites the location file (and there is no
+        # journal to take the clock from)
+        serialization.Journal(serialization.Journal.path_for(d / 'ls')).clear()
+        data = serialization.read(d / 'ls' / 'a')
+        data['files']['y'] = data['files']['x']
+        serialization.write(data, d / 'ls' / 'a')
+
+        # The clock can not be taken from the summary anymore
+        ls = LocationStates.load(d / 'ls')
+        assert ls.get_clock('a') == 1
+        assert ls.items.is_loaded('a')
+        assert ls.get_file_state('a', 'y').exists()
+
+def test_update_loads_newer_locations_only():
+    with TempDir() as d:
+        make_location_states(d / 'local', {
+            'a': { 'x': 'sha1:ax' },
+            'b': { 'x': 'sha1:bx' },
+        })
+        remote = make_location_states(d / 'remote', {
+            'a': { 'x': 'sha1:ax' },
+            'b': { 'x': 'sha1:bx' },
+        })
+        remote.update_file_state('b', FileState(path = 'x', digest = 'sha1:bx2', size = 1))
+        remote.save()
+
+        local = LocationStates.load(d / 'local')
+        remote = LocationStates.load(d / 'remote')
+        local.update(remote)
+
+        assert not local.items.is_loaded('a')
+        assert not remote.items.is_loaded('a')
+        assert local.get_clock('b') == 2
+        assert local.get_file_state('b', 'x').digest == 'sha1:bx2'
+
+        local.save()
+        local = LocationStates.load(d / 'local')
+        assert local.get_clock('b') == 2
+        assert local.get_file_state('b', 'x').digest == 'sha1:bx2'
+
+def test_update_replaces_unloaded_journaled_location():
+    with TempDir() as d:
+        local = make_location_states(d / 'local', { 'b': { 'x': 'sha1:bx' } })
+        # Journaled change of 'b' that is deferred until 'b' is loaded
+        local.update_file_state('b', FileState(path = 'y', digest = 'sha1:by', size = 1))
+        local.save()
+        remote = make_location_states(d / 'remote', { 'b': { 'z': 'sha1:bz' } })
+        for digest in ('sha1:bz2', 'sha1:bz3'):
+            remote.update_file_state('b', FileState(path = 'z', digest = digest, size = 1))
+            remote.save()
+
+        local = LocationStates.load(d / 'local')
+        assert local.get_clock('b') == 2
+        local.update(LocationStates.load(d / 'remote'))
+        assert local.get_clock('b') == 3
+        assert not local.get_file_state('b', 'y').exists()
+        assert local.get_file_state('b', 'z').digest == 'sha1:bz3'
+
+        local.save()
+        local = LocationStates.load(d / 'local')
+        assert local.get_clock('b') == 3
+        assert not local.get_file_state('b', 'y').exists()
+        assert local.get_file_state('b', 'z').digest == 'sha1:bz3'
+
+def test_update_does_not_load_replaced_locations(monkeypatch):
+    with TempDir() as d:
+        make_location_states(d / 'local', {
+            'b': { 'x': 'sha1:bx', 'y': 'sha1:by' },
+        })
+        remote = make_location_states(d / 'remote', { 'b': { 'x': 'sha1:bx' } })
+        for digest in ('sha1:bz', 'sha1:bz2'):
+            remote.update_file_state('b', FileState(path = 'z', digest = digest, size = 1))
+            remote.save()
+
+        loaded = []
+        load_item = LocationStates.load_item
+        def record_load(class_, path, name):
+            loaded.append((Path(path).name, name))
+            return load_item(path, name)
+        monkeypatch.setattr(LocationStates, 'load_item', classmethod(record_load))
+
+        local = LocationStates.load(d / 'local')
+        local.update(LocationStates.load(d / 'remote'))
+        local.save()
+        assert loaded == [('remote', 'b')]
+
+        # The journal has all of the new state, the old one is still not
+        # needed
+        local = LocationStates.load(d / 'local')
+        assert local.get_clock('b') == 3
+        assert not local.get_file_state('b', 'y').exists()
+        assert local.get_file_state('b', 'z').digest == 'sha1:bz2'
+        assert loaded == [('remote', 'b')]
+
+        # ... until compaction writes it to the location file
+        local.COMPACT_JOURNAL_RECORDS = 1
+        local.update_file_state('b', FileState(path = 'w', digest = 'sha1:bw', size = 1))
+        local.save()
+        assert not serialization.Journal.path_for(d / 'local').exists()
+        local = LocationStates.load(d / 'local')
+        assert local.get_clock('b') == 4
+        assert sorted(map(str, local.get_all_paths('b'))) == ['w', 'x', 'z']
+
+def test_locations_with_digest():
+    with TempDir() as d:
+        make_location_states(d / 'ls', {
+            'a': { 'x': 'sha1:1', 'y': 'sha1:1' },
+            'b': { 'x': 'sha1:1', 'z': 'sha1:2' },
+        })
+        ls = LocationStates.load(d / 'ls')
+        assert ls.locations_with_digest('sha1:1') == { 'a': 1, 'b': 1 }
+        assert ls.locations_with_digest('sha1:2') == { 'b': 1 }
+        assert ls.locations_with_digest('sha1:3') == {}
+
+        # Kept up to date on changes, one of two copies in 'a' is not enough
+        # to drop it
+        ls.update_file_state('a', FileState(path = 'x', digest = 'sha1:3', size = 5))
+        ls.update_file_state('b', FileState(path = 'z'))
+        assert ls.locations_with_digest('sha1:1') == { 'a': 1, 'b': 1 }
+        assert ls.locations_with_digest('sha1:2') == {}
+        assert ls.locations_with_digest('sha1:3') == { 'a': 5 }
+
+        ls.update_file_state('a', FileState(path = 'y'))
+        assert ls.locations_with_digest('sha1:1') == { 'b': 1 }
+
+        # ... and on update()
+        other = make_location_states(d / 'other', { 'b': { 'z': 'sha1:2' } })
+        other.update_file_state('b', FileState(path = 'w', digest = 'sha1:2', size = 1))
+        other.save()
+        ls.update(LocationStates.load(d / 'other'))
+        assert ls.locations_with_digest('sha1:1') == {}
+        assert ls.locations_with_digest('sha1:2') == { 'b': 1 }
+
+        assert ls.get_all_paths() == { Path('x'), Path('y'), Path('z'), Path('w') }
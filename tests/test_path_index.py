@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+from tests.utils import *
+from harmony.path_index import PathIndex
+from harmony.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+def test_aggregates():
+    index = PathIndex()
+    index.add('a/x', size = 1, count = True)
+    index.add('a/b/y', size = 2, outdated = True, count = True)
+    index.add('a/b/z', missing = True, count = True)
+    index.add('c', size = 4, count = True)
+    index.add('a/wiped')
+
+    root = index.find()
+    assert (root.count, root.size, root.missing, root.outdated) == (4, 7, 1, 1)
+    b = index.find('a/b')
+    assert (b.count, b.size, b.missing, b.outdated) == (2, 2, 1, 1)
+    assert index.find('a/x') is None
+    assert index.find('d') is None
+
+    assert set(index.iterate_paths('a/b')) == { Path('a/b/y'), Path('a/b/z') }
+    assert set(index.iterate_paths('a')) == { Path('a/x'), Path('a/b/y'), Path('a/b/z'), Path('a/wiped') }
+    assert list(index.iterate_paths('a/x')) == [Path('a/x')]
+    assert list(index.iterate_paths('a/nothing')) == []
+    assert len(list(index.iterate_paths())) == 5
+
+def test_directory_status_and_get():
+    with TempDir() as A, TempDir() as B:
+        for p in ('photos/2019/a.jpg', 'photos/2019/b.jpg', 'photos/2020/c.jpg', 'notes.txt'):
+            (A / p).parent.mkdir(parents = True, exist_ok = True)
+            (A / p).write_text(p)
+        rA = Repository.init(A)
+        rA.commit()
+        rB = Repository.clone(B, A)
+
+        node = rB.get_path_index().find('photos')
+        assert (node.count, node.missing) == (3, 3)
+
+        stats = rB.get_file_stats('photos/2019')
+        assert set(f.path for f in stats) == { Path('photos/2019/a.jpg'), Path('photos/2019/b.jpg') }
+        assert not any(f.exists_in_location_state for f in stats)
+
+        rB.pull_file('photos/2019', A)
+        assert (B / 'photos/2019/a.jpg').read_text() == 'photos/2019/a.jpg'
+        assert not (B / 'photos/2020').exists()
+
+        node = rB.get_path_index().find('photos')
+        assert (node.count, node.missing, node.size) == (3, 1, 2 * len('photos/2019/a.jpg'))
+        stats = rB.get_file_stats('photos/2019')
+        assert all(f.exists_in_location_state and f.is_most_recent for f in stats)
+
+def test_update_replaces_contribution():
+    index = PathIndex()
+    index.set('a/b/x', size = 3, missing = False, count = True)
+    index.set('a/b/x', size = 5, outdated = True, count = True)
+    a = index.find('a')
+    assert (a.count, a.size, a.missing, a.outdated) == (1, 5, 0, 1)
+
+    index.remove('a/b/x')
+    assert index.find('a') is None
+    assert index.find().count == 0
+
+    index.set('c', size = 1, count = True)
+    assert PathIndex.from_dict(index.to_dict()).to_dict() == index.to_dict()
+
+def test_index_is_persisted_and_updated(monkeypatch):
+    for backend in ('files', 'sharded', 'sqlite'):
+        with TempDir() as A:
+            for p in ('photos/a.jpg', 'photos/b.jpg', 'notes.txt'):
+                (A / p).parent.mkdir(parents = True, exist_ok = True)
+                (A / p).write_text(p)
+            r = Repository.init(A, state_backend = backend)
+            r.commit()
+            assert r.get_path_index().find('photos').count == 2
+
+            # Loading the repository again uses the stored index
+            def from_states(*args):
+                raise AssertionError('path index rebuilt')
+            with monkeypatch.context() as m:
+                m.setattr(PathIndex, 'from_states', from_states)
+                r = Repository.find(A)
+                node = r.get_path_index().find('photos')
+                assert (node.count, node.size) == (2, 2 * len('photos/a.jpg'))
+
+                # Commits update it instead of throwing it away
+                (A / 'photos/c.jpg').write_text('c')
+                (A / 'photos/a.jpg').unlink()
+                r.commit()
+                node = r.get_path_index().find('photos')
+                assert (node.count, node.size, node.missing) == (3, len('photos/b.jpg') + 1, 1)
+                index = r.get_path_index().to_dict()
+
+                r = Repository.find(A)
+                assert r.get_path_index().to_dict() == index
+
+            assert Repository.find(A).get_path_index().find('photos').count == 3
+            assert PathIndex.from_states(r.repository_state, r.location_states, r.id).to_dict() == index
@@ -1,10 +1,19 @@
 
 from tempfile import TemporaryDirectory
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 import logging
+import socket
+import subprocess
+import threading
+import io
+import os
 
-from harmony.protocols import ScpProtocol
+import paramiko
+
+from harmony.protocols import ScpProtocol, SshConnectionPool, FileProtocol, COPY_STRATEGIES
+from harmony import hashers
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +54,31 @@ def test_scp_normalize():
         path = None
         )
 
+@pytest.mark.parametrize('strategy', sorted(COPY_STRATEGIES) + ['copy'])
+def test_file_copy_strategies(strategy, monkeypatch):
+    monkeypatch.setattr(FileProtocol, 'strategies', (strategy, 'copy'))
+    with TemporaryDirectory() as d, TemporaryDirectory() as target:
+        files = ['test.txt', 'foo/foo.txt']
+        make_files(d, files)
+        (Path(target) / 'foo').mkdir()
+        (Path(target) / 'test.txt').write_text('old contents')
+        expected = {
+            f: hashers.get_hasher('default')(io.BytesIO('This is the file {}'.format(f).encode()))
+            for f in files
+        }
+
+        digests = {}
+        with FileProtocol(d) as p:
+            r = p.pull_working_files(files, Path(target), digests, expected)
+
+        assert set(r) == set(files)
+        assert digests == expected
+        for f in files:
+            assert (Path(target) / f).read_text() == 'This is the file {}'.format(f)
+        assert sorted(p.name for p in Path(target).iterdir()) == ['foo', 'test.txt']
+        assert ((Path(target) / 'test.txt').stat().st_ino == (Path(d) / 'test.txt').stat().st_ino) \
+            == (strategy == 'hardlink')
+
 #@pytest.mark.skip(reason = 'Depends on environment (local keybased SSH must be possible for running user)')
 def test_scp_transfer_localhost():
     with TemporaryDirectory() as d:
@@ -66,3 +100,242 @@ def test_scp_transfer_localhost():
             for k, v in r.items():
                 assert (Path(d) / k).read_text() == Path(v).read_text()
 
+
+class SftpHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class SftpServer(paramiko.SFTPServerInterface):
+    """
+    Read-only SFTP on the local filesystem.
+    """
+
+    def open(self, path, flags, attr):
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = SftpHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+class ScpServer(paramiko.ServerInterface):
+    """
+    In-process SSH server on localhost that accepts any password and runs
+    exec requests (as sent by SCPClient) with the local scp. With $sftp,
+    it also serves SFTP.
+    """
+
+    host_key = None
+
+    def __init__(self, sftp = False):
+        if ScpServer.host_key is None:
+            ScpServer.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.exec_requests = 0
+        self.sftp = sftp
+        threading.Thread(target = self.serve, daemon = True).start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            if self.sftp:
+                transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SftpServer)
+            transport.start_server(server = self)
+            self.transports.append(transport)
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+    def connect(self, address):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect('127.0.0.1', port = self.port, username = 'test', password = 'test',
+                    look_for_keys = False, allow_agent = False)
+        return ssh
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.exec_requests += 1
+        process = subprocess.Popen(command.decode('utf-8'), shell = True,
+                                   stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+        def to_process():
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+
+        def from_process():
+            for data in iter(lambda: process.stdout.read1(65536), b''):
+                channel.sendall(data)
+            channel.send_exit_status(process.wait())
+            channel.close()
+
+        threading.Thread(target = to_process, daemon = True).start()
+        threading.Thread(target = from_process, daemon = True).start()
+        return True
+
+@pytest.fixture(params = [False, True], ids = ['scp', 'sftp'])
+def scp_server(request):
+    server = ScpServer(sftp = request.param)
+    connections = []
+    def connect(address):
+        connections.append(address)
+        return server.connect(address)
+    server.connections = connections
+
+    pool = ScpProtocol.pool
+    ScpProtocol.pool = SshConnectionPool(connect = connect)
+    yield server
+    ScpProtocol.pool.close_all()
+    ScpProtocol.pool = pool
+    server.close()
+
+def make_files(d, files):
+    for filename in files:
+        (Path(d) / filename).parent.mkdir(parents = True, exist_ok = True)
+        (Path(d) / filename).write_text('This is the file {}'.format(filename))
+
+def test_scp_connection_is_reused(scp_server):
+    with TemporaryDirectory() as d, TemporaryDirectory() as target:
+        files = ['test.txt', 'foo/foo.txt', 'foo/test.txt']
+        make_files(d, files)
+
+        with ScpProtocol('ssh://localhost/' + d) as p:
+            r = p.pull_harmony_files(files)
+            for k, v in r.items():
+                assert (Path(d) / k).read_text() == Path(v).read_text()
+
+        for f in files:
+            (Path(target) / f).parent.mkdir(parents = True, exist_ok = True)
+        with ScpProtocol('ssh://localhost/' + d) as p:
+            p.pull_working_files(files, Path(target))
+        for f in files:
+            assert (Path(d) / f).read_text() == (Path(target) / f).read_text()
+
+        assert len(scp_server.connections) == 1
+        # Working files are received through SFTP if the server has it
+        assert scp_server.exec_requests == (1 if scp_server.sftp else 2) * len(files)
+
+def test_scp_concurrent_channels(scp_server):
+    with TemporaryDirectory() as d:
+        files = ['file{}.txt'.format(i) for i in range(8)]
+        make_files(d, files)
+
+        def pull(f):
+            with ScpProtocol('ssh://localhost/' + d) as p:
+                return Path(p.pull_harmony_files([f])[f]).read_text()
+
+        with ThreadPoolExecutor(4) as executor:
+            contents = list(executor.map(pull, files))
+
+        assert contents == ['This is the file {}'.format(f) for f in files]
+        assert len(scp_server.connections) == 1
+
+def test_scp_verifies_digest(scp_server):
+    with TemporaryDirectory() as d, TemporaryDirectory() as target:
+        files = ['good.txt', 'bad.txt']
+        make_files(d, files)
+        (Path(target) / 'bad.txt').write_text('old contents')
+        expected = {
+            'good.txt': hashers.get_hasher('default')(io.BytesIO(b'This is the file good.txt')),
+            'bad.txt': 'sha1:0000000000000000000000000000000000000000',
+        }
+
+        digests = {}
+        with ScpProtocol('ssh://localhost/' + d) as p:
+            r = p.pull_working_files(files, Path(target), digests, expected)
+
+        assert set(r) == { 'good.txt' }
+        assert digests == { 'good.txt': expected['good.txt'] }
+        assert (Path(target) / 'good.txt').read_text() == 'This is the file good.txt'
+        assert (Path(target) / 'bad.txt').read_text() == 'old contents'
+        assert sorted(p.name for p in Path(target).iterdir()) == sorted(files)
+
+def test_ssh_pool_idle_timeout():
+    class Client:
+        closed = False
+        def get_transport(self):
+            return self
+        def is_active(self):
+            return not self.closed
+        def close(self):
+            self.closed = True
+
+    now = [0]
+    clients = []
+    def connect(address):
+        clients.append(Client())
+        return clients[-1]
+
+    pool = SshConnectionPool(connect = connect, idle_timeout = 10, clock = lambda: now[0])
+    a = ScpProtocol.parse_uri('ssh://a/x')
+    b = ScpProtocol.parse_uri('ssh://b/x')
+
+    assert pool.acquire(a) is pool.acquire(a)
+    pool.release(clients[0])
+    pool.release(clients[0])
+    assert pool.acquire(b) is not clients[0]
+    assert len(clients) == 2
+
+    # In use connections are never closed
+    now[0] = 100
+    pool.close_idle()
+    assert clients[0].closed and not clients[1].closed
+
+    pool.release(clients[1])
+    now[0] = 105
+    assert pool.acquire(b) is clients[1]
+    pool.release(clients[1])
+
+    # Dead connections are replaced
+    clients[1].close()
+    assert pool.acquire(b) is clients[2]
+
+    # A dead connection still in use is replaced as well, releasing it
+    # does not count against its replacement
+    assert pool.acquire(b) is clients[2]
+    clients[2].close()
+    assert pool.acquire(b) is clients[3]
+    pool.release(clients[2])
+    pool.release(clients[2])
+    now[0] = 1000
+    pool.close_idle()
+    assert not clients[3].closed
+    assert clients[2] not in pool.usage
+    pool.release(clients[3])
+    now[0] = 2000
+    pool.close_idle()
+    assert not pool.connections and not pool.usage
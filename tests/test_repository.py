@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import gc
 
 import os
 import pytest
@@ -9,6 +10,9 @@ from pathlib import Path
 
 from tests.utils import *
 from harmony.repository import Repository
+from harmony import working_directory
+from harmony import protocols
+from harmony import util
 
 LOCATION_STATE_DIR = 'location_states'
 
@@ -288,6 +292,178 @@ def test_pull_file_simple():
         assert (A / 'x.txt').read_bytes() == (B / 'x.txt').read_bytes()
 
 
+def test_pull_files():
+
+    with TempDir() as A, TempDir() as B:
+
+        rA = Repository.init(A)
+        files = ['x.txt', 'y.txt', 'a/1.jpg', 'a/2.jpg', 'a/b/3.jpg', 'c/4.txt', 'c/5.txt']
+        for p in files:
+            (A / p).parent.mkdir(parents = True, exist_ok = True)
+            (A / p).write_text(p)
+        rA.commit()
+
+        rB = Repository.clone(B, A)
+        (B / 'untracked.txt').write_text('not committed by pull_files')
+
+        statistics = rB.pull_files(['x.txt', 'a', '*.txt'], A, jobs = 3)
+        got = ['x.txt', 'a/1.jpg', 'a/2.jpg', 'a/b/3.jpg', 'y.txt', 'c/4.txt', 'c/5.txt']
+        assert statistics.files == len(got)
+        assert statistics.bytes == sum(len(p) for p in got)
+        for p in got:
+            assert (B / p).read_text() == p
+            assert rB.location_states.get_file_state(rB.id, Path(p)).digest \
+                == rA.repository_state[p].digest
+
+        # Only the transferred files were recorded
+        assert not rB.location_states.get_file_state(rB.id, Path('untracked.txt')).exists()
+
+        # Files that are already here are skipped
+        assert rB.pull_files(['a', '*.jpg'], A).files == 0
+
+
+def test_pull_files_from_incomplete_remote():
+
+    with TempDir() as A, TempDir() as B, TempDir() as C:
+
+        rA = Repository.init(A)
+        for p in ('d/x', 'd/y', 'e/z'):
+            (A / p).parent.mkdir(parents = True, exist_ok = True)
+            (A / p).write_text(p)
+        rA.commit()
+
+        # C only has d/x
+        rC = Repository.clone(C, A)
+        rC.pull_files(['d/x'], A)
+
+        # B knows what C has, so the directory only stands for d/x
+        rB = Repository.clone(B, C)
+        statistics = rB.pull_files(['d'], C)
+        assert (statistics.files, statistics.failed) == (1, 0)
+        assert (B / 'd/x').read_text() == 'd/x'
+
+        # Explicitly requested files that C does not have fail on their
+        # own, without creating directories
+        statistics = rB.pull_files(['d/y', 'e/z'], C)
+        assert (statistics.files, statistics.failed) == (0, 2)
+        assert sorted(p.name for p in B.iterdir()) == ['.harmony', 'd']
+        assert sorted(p.name for p in (B / 'd').iterdir()) == ['x']
+
+        # What arrived is committed even if other files fail
+        statistics = rB.pull_files(['e/z', 'd/nonexistent'], A)
+        assert (statistics.files, statistics.failed) == (1, 1)
+        assert rB.location_states.get_file_state(rB.id, Path('e/z')).exists()
+
+
+def test_pull_files_does_not_hide_errors(monkeypatch):
+
+    with TempDir() as A, TempDir() as B:
+
+        rA = Repository.init(A)
+        for p in ('x', 'y', 'z'):
+            (A / p).write_text(p)
+        rA.commit()
+        rB = Repository.clone(B, A)
+
+        # Lost connections count as failed files
+        def pull_working_files(self, paths, *args, **kws):
+            raise ConnectionResetError('connection lost')
+        with monkeypatch.context() as m:
+            m.setattr(protocols.FileProtocol, 'pull_working_files', pull_working_files)
+            statistics = rB.pull_files(['x', 'y', 'z'], A, jobs = 2)
+        assert (statistics.files, statistics.failed) == (0, 3)
+
+        # Bugs are not
+        def receive_file(self, path, destination, hasher_name):
+            raise TypeError('bug')
+        monkeypatch.setattr(protocols.FileProtocol, 'receive_file', receive_file)
+        for jobs in (1, 2):
+            with pytest.raises(TypeError):
+                rB.pull_files(['x', 'y', 'z'], A, jobs = jobs)
+
+def test_pull_files_hashes_while_copying(monkeypatch):
+
+    with TempDir() as A, TempDir() as B:
+
+        rA = Repository.init(A)
+        (A / 'x.txt').write_text('Hello, World')
+        rA.commit()
+        rB = Repository.clone(B, A)
+
+        def hash_file(path, hasher_name = 'default'):
+            raise AssertionError('{} was read back for hashing'.format(path))
+        monkeypatch.setattr(working_directory, 'hash_file', hash_file)
+
+        rB.pull_files(['x.txt'], A)
+        assert rB.location_states.get_file_state(rB.id, Path('x.txt')).digest \
+            == rA.repository_state['x.txt'].digest
+
+
+def test_pull_files_keeps_permissions():
+
+    with TempDir() as A, TempDir() as B:
+
+        umask = os.umask(0o022)
+        try:
+            rA = Repository.init(A)
+            (A / 'd').mkdir()
+            (A / 'd' / 'x.txt').write_text('x')
+            rA.commit()
+            rB = Repository.clone(B, A)
+
+            rB.pull_files(['d/x.txt'], A)
+        finally:
+            os.umask(umask)
+
+        assert (B / 'd' / 'x.txt').stat().st_mode & 0o777 == 0o644
+        # Files are received in the harmony directory, never next to
+        # tracked ones
+        assert sorted(p.name for p in B.iterdir()) == ['.harmony', 'd']
+        assert list(rB.get_temporary_directory().iterdir()) == []
+
+def test_pull_files_transfer_strategies():
+
+    with TempDir() as A, TempDir() as B:
+
+        rA = Repository.init(A)
+        (A / 'x.txt').write_text('x')
+        (A / 'y.txt').write_text('y')
+        (A / 'z.txt').write_text('z')
+        rA.commit()
+        rB = Repository.clone(B, A)
+        rB.pull_files(['x.txt'], A)
+        assert (B / 'x.txt').stat().st_ino != (A / 'x.txt').stat().st_ino
+
+        rB.settings['transfer_strategies'] = ['hardlink', 'copy']
+        rB.pull_files(['y.txt'], A)
+        assert (B / 'y.txt').stat().st_ino == (A / 'y.txt').stat().st_ino
+
+        rB.settings['transfer_strategies'] = ['teleport']
+        with pytest.raises(ValueError):
+            rB.pull_files(['z.txt'], A)
+
+def test_pull_files_verifies_digest():
+
+    with TempDir() as A, TempDir() as B:
+
+        rA = Repository.init(A)
+        (A / 'x.txt').write_text('Hello, World')
+        (A / 'y.txt').write_text('y')
+        rA.commit()
+        rB = Repository.clone(B, A)
+
+        # B does not know about this version yet
+        (A / 'x.txt').write_text('Changed')
+        rA.commit()
+
+        statistics = rB.pull_files(['x.txt', 'y.txt'], A)
+        assert (statistics.files, statistics.failed) == (1, 1)
+        assert (B / 'y.txt').read_text() == 'y'
+        assert not (B / 'x.txt').exists()
+        assert sorted(p.name for p in B.iterdir()) == ['.harmony', 'y.txt']
+        assert not rB.location_states.get_file_state(rB.id, Path('x.txt')).exists()
+
+
 def test_pull_state_autodetects_rename():
 
     with TempDir() as A, TempDir() as B:
@@ -379,6 +555,49 @@ def test_rename_updates_location_state():
         assert (A / 'y.txt').read_bytes() == (C / 'y.txt').read_bytes()
 
 
+def test_paths_are_shared_between_components():
+    with TempDir() as A:
+        (A / 'x.txt').write_text('x')
+        rA = Repository.init(A)
+        rA.commit()
+        rA = Repository.load(rA.harmony_directory)
+
+        paths = rA.repository_state.get_paths()
+        assert paths == (Path('x.txt'), )
+        entry = rA.repository_state['x.txt']
+        file_state = rA.location_states.get_file_state(rA.id, 'x.txt')
+        assert entry.path is paths[0]
+        assert file_state.path is paths[0]
+        assert next(iter(rA.repository_state.files)) is str(paths[0])
+        assert rA.repository_state.get_paths() is paths
+
+
+def test_interned_paths_go_with_the_states():
+    with TempDir() as A:
+        (A / 'only-here.txt').write_text('x')
+        rA = Repository.init(A)
+        rA.commit()
+        assert 'only-here.txt' in util._paths
+
+        del rA
+        gc.collect()
+        assert 'only-here.txt' not in util._paths
+
+
+def test_under_replicated():
+    with TempDir() as A, TempDir() as B:
+        (A / 'x.txt').write_text('x')
+        (A / 'y.txt').write_text('y')
+        rA = Repository.init(A)
+        rA.commit()
+        rB = Repository.clone(B, A)
+        rB.pull_file('x.txt', A)
+
+        assert rB.get_sources('x.txt') == { rA.id: 1, rB.id: 1 }
+        assert rB.get_sources('y.txt') == { rA.id: 1 }
+        assert rB.get_under_replicated() == [(Path('y.txt'), { rA.id: 1 })]
+
+
 # TODO:
 # - file deletion
 # - multiple files with same contents
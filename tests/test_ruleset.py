@@ -3,7 +3,8 @@
 import sys
 import logging
 
-from harmony.ruleset import Ruleset
+from tests.utils import *
+from harmony.ruleset import Ruleset, ALWAYS, NEVER, MAYBE
 
 def test_match_path():
     f = Ruleset.match_path
@@ -21,6 +22,10 @@ def test_match_path():
     assert f('singlestar/should/match/single/file.only', '**/should/**')
     assert f('singlestar/should/match/single/file.only', '**/should/**/*.only')
 
+    # Paths that are shorter than the pattern do not match
+    assert not f('foo', 'foo/bar')
+    assert not f('foo', 'foo/**')
+
 
 def test_match_directory():
     f = Ruleset.match_directory
@@ -34,6 +39,67 @@ def test_match_directory():
     assert f('foo/bar/baz/bang.txt', 'b*')
     assert not f('foo/bar/baz/bang.txt', '*x*')
 
+def test_match_path_below():
+    f = Ruleset.match_path_below
+
+    assert f('.harmony', '/.harmony/**') == ALWAYS
+    assert f('.harmony/location_states', '/.harmony/**') == ALWAYS
+    assert f('foo', '/.harmony/**') == NEVER
+    assert f('foo/bar', '**') == ALWAYS
+    assert f('foo/bar', '**/bar/**') == ALWAYS
+    assert f('foo', '**/bar/**') == MAYBE
+    assert f('foo/bar', 'foo/*.txt') == NEVER
+    assert f('foo', 'foo/*.txt') == MAYBE
+    assert f('foo', 'foo/bar/**') == MAYBE
+
+def test_directory_excluded():
+    with TempDir() as d:
+        rules = Ruleset.init(d / 'rules')
+        assert rules.directory_excluded('.harmony')
+        assert rules.directory_excluded('.harmony/location_states')
+        assert not rules.directory_excluded('foo')
+
+        rules.add_rule(match = {'dirname': 'node_modules'}, commit = False, action = 'continue')
+        assert rules.directory_excluded('node_modules')
+        assert rules.directory_excluded('foo/node_modules/bar')
+
+        # A later rule might include some files again
+        rules.add_rule(match = {'filename': '*.keep'}, commit = True, action = 'stop')
+        assert not rules.directory_excluded('foo/node_modules/bar')
+        assert rules.directory_excluded('.harmony')
+
+def test_get_rule():
+    with TempDir() as d:
+        rules = Ruleset.init(d / 'rules')
+        assert rules.get_rule('foo/bar.txt')['commit']
+        assert not rules.get_rule('.harmony/config')['commit']
+        assert not rules.get_rule('foo/bar.txt.bak')['commit']
+        assert not rules.get_rule('foo/bar.txt~')['commit']
+
+        # Adding rules invalidates memoized results
+        rules.add_rule(match = {'path': 'foo/*.txt', 'filename': '[a-c]*'}, commit = False, action = 'stop')
+        assert not rules.get_rule('foo/bar.txt')['commit']
+        assert rules.get_rule('foo/zap.txt')['commit']
+        assert rules.get_rule('foo/x/bar.txt')['commit']
+
+def test_iterate_committable_files_prunes():
+    with TempDir() as d:
+        rules = Ruleset.init(d / 'rules')
+        rules.add_rule(match = {'dirname': 'cache'}, commit = False, action = 'stop')
+
+        for fn in ('a.txt', 'cache/x.txt', 'sub/cache/y.txt', 'sub/z.txt', 'w.bak'):
+            (d / fn).parent.mkdir(parents = True, exist_ok = True)
+            (d / fn).write_text(fn)
+
+        committable = set(f.relative_filename for f in rules.iterate_committable_files(d))
+        assert committable == {'a.txt', 'sub/z.txt', 'rules'}
+
+        unpruned = set(
+            f.relative_filename for f in rules.iterate_files(d)
+            if f.rule['commit']
+        )
+        assert unpruned == committable
+
 if __name__ == '__main__':
     logging.basicConfig(level = logging.DEBUG, format = '{levelname:7s} {module:15s}:{funcName:15s} | {message:s}', style = '{')
     unittest.main()
@@ -1,6 +1,13 @@
 
 import logging
-from harmony.serialization import Serializable
+
+import pytest
+
+from tests.utils import *
+from harmony import serialization
+from harmony.serialization import Serializable, SerializationException
+from harmony.repository_state import RepositoryState, RepositoryFileState
+from harmony.clock import Clock
 
 
 logger = logging.getLogger(__name__)
@@ -37,3 +44,147 @@ def test_dict_conversion():
 
     assert t1 == t2
 
+def test_formats_roundtrip():
+    d = {
+        'files': {
+            'a/b.txt': { 'digest': 'sha1:1', 'clock': { 'x': 1 }, 'wipe': False },
+            'ümlaut': { 'digest': None, 'clock': {}, 'wipe': True },
+        },
+        'entries': [[1, 2, 'sha1:3']],
+    }
+    with TempDir() as t:
+        for name in serialization.FORMATS:
+            serialization.write(d, t / name, name)
+            assert serialization.read(t / name) == d
+
+        assert (t / 'json').read_text().startswith('{"harmony_format": "json", "version": 1}\n')
+
+def test_default_format_is_used_for_state():
+    with TempDir() as t:
+        rs = RepositoryState(t / 'repository_state', files = {
+            'x': RepositoryFileState(path = 'x', digest = 'sha1:x', clock = Clock(a = 1)),
+        })
+        rs.save()
+        header = (t / 'repository_state').read_text().split('\n')[0]
+        assert serialization.detect_format(header).name == serialization.DEFAULT_FORMAT
+
+def test_legacy_yaml_is_migrated():
+    with TempDir() as t:
+        # State file as written before format headers existed
+        (t / 'repository_state').write_text(
+            'files:\n'
+            '  x:\n'
+            '    clock: {a: 1}\n'
+            '    digest: sha1:x\n'
+            '    path: x\n'
+            '    wipe: false\n'
+        )
+        rs = RepositoryState.load(t / 'repository_state')
+        assert rs['x'].digest == 'sha1:x'
+        assert rs['x'].clock.values == { 'a': 1 }
+
+        # The state file is rewritten (in the current format) on the next
+        # compaction of the journal
+        rs.COMPACT_JOURNAL_RECORDS = 1
+        rs['y'] = RepositoryFileState(path = 'y', digest = 'sha1:y')
+        rs.save()
+        assert serialization.detect_format((t / 'repository_state').read_text()).name == 'json'
+        assert RepositoryState.load(t / 'repository_state')['x'].digest == 'sha1:x'
+
+def test_unsupported_version():
+    with pytest.raises(SerializationException):
+        serialization.loads('{"harmony_format": "json", "version": 99}\n{}\n')
+
+def test_unchanged_components_are_not_written():
+    from harmony.repository import Repository
+
+    with TempDir() as d:
+        r = Repository.init(d)
+        (d / 'x.txt').write_text('x')
+        r.commit()
+
+        r = Repository.load(r.harmony_directory)
+        serialization.statistics.reset()
+        r.save()
+        assert serialization.statistics.bytes_ == 0
+        assert serialization.statistics.skipped > 0
+
+        # The journals and the hash cache (for the new digest)
+        (d / 'x.txt').write_text('changed')
+        serialization.statistics.reset()
+        r.commit()
+        assert 0 < serialization.statistics.bytes_ < 1000
+        assert serialization.statistics.files == 3
+
+def test_compaction_writes_changed_locations_only():
+    from harmony.location_states import LocationStates
+    from harmony.working_directory import FileState
+
+    with TempDir() as d:
+        ls = LocationStates.init(d / 'ls')
+        ls.COMPACT_JOURNAL_RECORDS = 1
+        for id_ in ('a', 'b', 'c'):
+            ls.update_file_state(id_, FileState(path = 'x', digest = 'sha1:x', size = 1))
+        ls.save()
+        assert not serialization.Journal.path_for(d / 'ls').exists()
+
+        ls = LocationStates.load(d / 'ls')
+        ls.COMPACT_JOURNAL_RECORDS = 1
+        ls.update_file_state('b', FileState(path = 'y', digest = 'sha1:y', size = 1))
+        mtimes = { id_: (d / 'ls' / id_).stat().st_mtime_ns for id_ in 'ac' }
+        serialization.statistics.reset()
+        ls.save()
+
+        assert { id_: (d / 'ls' / id_).stat().st_mtime_ns for id_ in 'ac' } == mtimes
+        assert not ls.items.is_loaded('a')
+        assert LocationStates.load(d / 'ls').get_file_state('b', 'y').exists()
+
+def test_interrupted_write_keeps_old_contents(monkeypatch):
+    with TempDir() as d:
+        serialization.write({ 'a': 1 }, d / 'f')
+
+        def fail(fd):
+            raise OSError('disk gone')
+        monkeypatch.setattr(serialization.os, 'fsync', fail)
+        with pytest.raises(OSError):
+            serialization.write({ 'a': 2 }, d / 'f')
+
+        assert serialization.read(d / 'f') == { 'a': 1 }
+
+def test_group_commit():
+    from harmony.location_states import LocationStates
+    from harmony.working_directory import FileState
+
+    with TempDir() as d:
+        ls = LocationStates.init(d / 'ls')
+        for id_ in ('a', 'b', 'c'):
+            ls.update_file_state(id_, FileState(path = 'x', digest = 'sha1:x', size = 1))
+        ls.save()
+
+        ls = LocationStates.load(d / 'ls')
+        ls.COMPACT_JOURNAL_RECORDS = 1
+        for id_ in ('a', 'b', 'c'):
+            ls.update_file_state(id_, FileState(path = 'y', digest = 'sha1:y', size = 1))
+
+        journal = serialization.Journal.path_for(d / 'ls')
+        serialization.statistics.reset()
+        with serialization.group_commit():
+            ls.save()
+            # Nothing is in place yet, but reads see the new contents
+            assert journal.exists()
+            assert 'y' not in serialization.loads((d / 'ls' / 'a').read_text())['files']
+            assert 'y' in serialization.read(d / 'ls' / 'a')['files']
+            assert LocationStates.load(d / 'ls').get_file_state('a', 'y').exists()
+
+        assert not journal.exists()
+        assert not list(d.glob('**/*.tmp'))
+        # Three locations and the summary (not the journal, which is
+        # removed), the two directories, then the one of the journal
+        assert serialization.statistics.fsyncs == 3 + 1 + 2 + 1
+
+        # The summary recorded the stat of the temporary files, which still
+        # holds after the rename
+        ls = LocationStates.load(d / 'ls')
+        assert [ls.get_clock(id_) for id_ in 'abc'] == [2, 2, 2]
+        assert not any(ls.items.is_loaded(id_) for id_ in 'abc')
+        assert ls.get_file_state('b', 'y').exists()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+import pytest
+
+from tests.utils import *
+from harmony import sharded_state
+from harmony.clock import Clock
+from harmony.repository import Repository
+from harmony.repository_state import RepositoryFileState
+from harmony.sharded_state import ShardedRepositoryState
+
+logger = logging.getLogger(__name__)
+
+def make_sharded_state(path, files):
+    """
+    Create a sharded repository state in $path from $files = { path: digest }.
+    """
+    rs = ShardedRepositoryState.init(path)
+    for p, digest in files.items():
+        rs[p] = RepositoryFileState(path = p, digest = digest, clock = Clock(a = 1))
+    rs.save()
+    return rs
+
+def test_sharded_repository_roundtrip():
+    with TempDir() as d:
+        r = Repository.init(d, state_backend = 'sharded')
+        assert isinstance(r.repository_state, ShardedRepositoryState)
+
+        for i in range(50):
+            (d / 'file{}.txt'.format(i)).write_text('file {}'.format(i))
+        assert r.commit()
+
+        r = Repository.load(r.harmony_directory)
+        rs = r.repository_state
+        assert len(rs.get_paths()) == 50
+        assert rs['file7.txt'].digest \
+            == r.location_states.get_file_state(r.id, Path('file7.txt')).digest
+
+        # Changing one file rewrites its shard (and the manifest) only
+        r = Repository.load(r.harmony_directory)
+        (d / 'file7.txt').write_text('changed')
+        shards_before = set(p.name for p in rs.path.iterdir())
+        assert r.commit()
+        shards_after = set(p.name for p in rs.path.iterdir())
+
+        assert len(shards_after - shards_before) == 1
+        assert len(shards_before - shards_after) == 1
+        assert sum(
+            r.repository_state.shards.is_loaded(key)
+            for key in r.repository_state.shards
+        ) == 1
+
+        r = Repository.load(r.harmony_directory)
+        assert r.repository_state['file7.txt'].clock.values == { r.id: 2 }
+        assert len(r.repository_state.get_paths()) == 50
+
+def test_merge_skips_identical_shards():
+    with TempDir() as d:
+        files = { 'file{}.txt'.format(i): 'sha1:{}'.format(i) for i in range(50) }
+        make_sharded_state(d / 'local', files)
+        remote = make_sharded_state(d / 'remote', files)
+        remote['file7.txt'] = remote['file7.txt'].replace(
+            digest = 'sha1:changed', clock = Clock(a = 2)
+        )
+        remote.save()
+
+        local = ShardedRepositoryState.load(d / 'local')
+        remote = ShardedRepositoryState.load(d / 'remote')
+        assert sharded_state.can_merge(local, remote)
+
+        conflicts, merged = sharded_state.merge(local, remote, 'b')
+        assert conflicts == {}
+        key = local.shard_key('file7.txt')
+        assert [k for k in local.shards if local.shards.is_loaded(k)] == [key]
+        assert [k for k in remote.shards if remote.shards.is_loaded(k)] == [key]
+
+        local.overwrite(merged)
+        local.save()
+
+        local = ShardedRepositoryState.load(d / 'local')
+        assert local['file7.txt'].digest == 'sha1:changed'
+        assert local['file8.txt'].digest == 'sha1:8'
+        assert len(local.get_paths()) == 50
+        assert local.fingerprints == remote.fingerprints
+
+@pytest.mark.parametrize('backends', [('files', 'sharded'), ('sharded', 'files'), ('sharded', 'sharded')])
+def test_pull_state_between_backends(backends):
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A, state_backend = backends[0])
+        (A / 'x.txt').write_text('x')
+        rA.commit()
+
+        rB = Repository.clone(B, A, state_backend = backends[1])
+        assert set(rB.repository_state.get_paths()) == { Path('x.txt') }
+
+        (A / 'x.txt').write_text('changed x')
+        rA.commit()
+        (B / 'y.txt').write_text('y')
+        rB.commit()
+
+        assert len(rB.pull_state(A)) == 0
+        assert rB.repository_state['x.txt'].digest == rA.repository_state['x.txt'].digest
+
+        assert len(rA.pull_state(B)) == 0
+        assert set(rA.repository_state.get_paths()) == { Path('x.txt'), Path('y.txt') }
+
+        rA = Repository.load(rA.harmony_directory)
+        assert set(rA.repository_state.get_paths()) == { Path('x.txt'), Path('y.txt') }
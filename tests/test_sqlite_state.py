@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+
+import pytest
+
+from tests.utils import *
+from harmony.repository import Repository
+from harmony.repository_state import RepositoryState
+from harmony.sqlite_state import StateDatabase, SqliteLocationStates, SqliteRepositoryState
+from harmony.working_directory import FileState
+
+logger = logging.getLogger(__name__)
+
+def test_sqlite_repository_roundtrip():
+    with TempDir() as d:
+        r = Repository.init(d, state_backend = 'sqlite')
+        assert isinstance(r.repository_state, SqliteRepositoryState)
+        assert isinstance(r.location_states, SqliteLocationStates)
+
+        (d / 'x.txt').write_text('x')
+        (d / 'y.txt').write_text('y')
+        assert r.commit()
+        assert not r.commit()
+        assert r.location_states.get_clock(r.id) == 1
+
+        (d / 'x.txt').write_text('changed')
+        assert r.commit()
+
+        r = Repository.load(r.harmony_directory)
+        assert r.settings['state_backend'] == 'sqlite'
+        assert r.location_states.get_clock(r.id) == 2
+        assert set(r.repository_state.get_paths()) == { Path('x.txt'), Path('y.txt') }
+        assert r.repository_state['x.txt'].clock.values == { r.id: 2 }
+        assert r.location_states.get_file_state(r.id, 'x.txt').size == len('changed')
+
+        stats = { str(f.path): f for f in r.get_file_stats() }
+        assert stats['x.txt'].is_most_recent
+        assert not stats['x.txt'].maybe_modified
+
+@pytest.mark.parametrize('backends', [('files', 'sqlite'), ('sqlite', 'files'), ('sqlite', 'sqlite')])
+def test_pull_state_between_backends(backends):
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A, state_backend = backends[0])
+        (A / 'x.txt').write_text('x')
+        rA.commit()
+
+        rB = Repository.clone(B, A, state_backend = backends[1])
+        assert set(rB.repository_state.get_paths()) == { Path('x.txt') }
+
+        (A / 'x.txt').write_text('changed x')
+        rA.commit()
+        (B / 'y.txt').write_text('y')
+        rB.commit()
+
+        assert len(rB.pull_state(A)) == 0
+        assert rB.repository_state['x.txt'].digest == rA.repository_state['x.txt'].digest
+        assert rB.location_states.get_clock(rA.id) == rA.location_states.get_clock(rA.id)
+
+        assert len(rA.pull_state(B)) == 0
+        assert set(rA.repository_state.get_paths()) == { Path('x.txt'), Path('y.txt') }
+
+def test_locations_with_digest():
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A, state_backend = 'sqlite')
+        (A / 'x.txt').write_text('x')
+        (A / 'z.txt').write_text('zz')
+        rA.commit()
+
+        rB = Repository.clone(B, A, state_backend = 'sqlite')
+        (B / 'x.txt').write_text('x')
+        rB.commit()
+        rA.pull_state(B)
+
+        digest = rA.repository_state['x.txt'].digest
+        assert rA.location_states.locations_with_digest(digest) == { rA.id: 1, rB.id: 1 }
+
+        digest = rA.repository_state['z.txt'].digest
+        assert rA.location_states.locations_with_digest(digest) == { rA.id: 2 }
+
+def test_update_file_state_records_deletion_once():
+    with TempDir() as d:
+        r = Repository.init(d, state_backend = 'sqlite')
+        ls = r.location_states
+        assert ls.update_file_state('a', FileState(path = 'x', digest = 'sha1:x', size = 1))
+        assert ls.update_file_state('a', FileState(path = 'x'))
+        assert not ls.update_file_state('a', FileState(path = 'x'))
+        assert not ls.get_file_state('a', 'x').exists()
+
+def test_overwrite_writes_differences_only():
+    with TempDir() as d:
+        r = Repository.init(d, state_backend = 'sqlite')
+        (d / 'x.txt').write_text('x')
+        (d / 'y.txt').write_text('y')
+        r.commit()
+
+        other = RepositoryState(None)
+        other['y.txt'] = r.repository_state['y.txt'].replace(digest = 'sha1:y2')
+        other['z.txt'] = r.repository_state['y.txt'].replace(path = 'z.txt')
+        changed = []
+        r.repository_state.observe(changed.append)
+        r.repository_state.overwrite(other)
+
+        assert sorted(changed) == ['x.txt', 'y.txt', 'z.txt']
+        assert set(r.repository_state.get_paths()) == { Path('y.txt'), Path('z.txt') }
+        assert r.repository_state['y.txt'].digest == 'sha1:y2'
+
+        changed.clear()
+        r.repository_state.overwrite(other)
+        assert changed == []
+
+def test_remote_database_is_closed(monkeypatch):
+    closed = []
+    close = StateDatabase.close
+    def record_close(self):
+        closed.append(self.path)
+        close(self)
+    monkeypatch.setattr(StateDatabase, 'close', record_close)
+
+    with TempDir() as A, TempDir() as B:
+        rA = Repository.init(A, state_backend = 'sqlite')
+        (A / 'x.txt').write_text('x')
+        rA.commit()
+        rB = Repository.init(B, state_backend = 'sqlite')
+
+        assert len(rB.pull_state(A)) == 0
+        assert closed == [rA.repository_state.db.path]
+        assert set(rB.repository_state.get_paths()) == { Path('x.txt') }
@@ -50,6 +50,17 @@ def test_get_filenames_normalized():
         filenames = wd.get_filenames()
         assert set(real_filenames) == set(filenames)
 
+def test_scan_returns_stats():
+    with TempDir() as d:
+        real_filenames, _ = make_mess(d)
+        wd = WorkingDirectory(d, ruleset_all(d))
+
+        stats = wd.scan()
+        assert set(stats.keys()) == set(real_filenames)
+        for fn, st in stats.items():
+            assert st.st_size == (d / fn).stat().st_size
+            assert st.st_mtime == (d / fn).stat().st_mtime
+
 def test_contains_normalized():
     with TempDir() as d:
         real_filenames, symlinks = make_mess(d)
@@ -85,6 +96,29 @@ def test_generate_file_state_normalized():
             state = wd.generate_file_state(fn)
             assert Path(state.path) == Path(real_fn)
 
+def test_generate_file_states_parallel_equals_serial():
+    with TempDir() as d:
+        paths = []
+        for i in range(20):
+            p = Path('dir{}'.format(i % 3)) / 'file{}.txt'.format(i)
+            (d / p).parent.mkdir(exist_ok = True)
+            (d / p).write_text('content {}'.format(i) * i)
+            paths.append(p)
+        paths.append(Path('does_not_exist.txt'))
+
+        serial = WorkingDirectory(d, ruleset_all(d)).generate_file_states(paths)
+
+        for executor in ('thread', 'process'):
+            wd = WorkingDirectory(d, ruleset_all(d), jobs = 4, executor = executor)
+            parallel = wd.generate_file_states(paths)
+
+            assert set(parallel.keys()) == set(serial.keys())
+            for path in paths:
+                assert parallel[path].to_dict() == serial[path].to_dict()
+
+            assert wd.hash_statistics.files == 20
+            assert wd.hash_statistics.bytes == sum((d / p).stat().st_size for p in paths[:-1])
+
 
 #  vim: set ts=4 sw=4 tw=79 expandtab :
 